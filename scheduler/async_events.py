@@ -0,0 +1,451 @@
+"""
+Asynchronous access to calendar events in Postgres using asyncpg
+"""
+import asyncio
+import functools
+import heapq
+import asyncpg
+from psycopg2.extensions import parse_dsn
+from datetime import datetime
+from events import Event, NonExistantIdError, BookingConflictError, BOOKING_TYPES, appointments, remove_conflicting, as_datetime, availability_events, \
+                   earliest_open_slots, daily_slot_counts, affected_days, merge_ranges, window_args, batch_conflicts, \
+                   OVERLAPPING_EVENTS_QUERY, LOCK_PEOPLE_QUERY, PARTICIPANTS_QUERY, FETCH_EVENT_QUERY, LOCK_EVENT_QUERY, \
+                   EVENTS_BETWEEN_QUERY, INSERT_EVENT_QUERY, UPDATE_EVENT_QUERY, DELETE_EVENT_QUERY, INSERT_PARTICIPANT_QUERY, \
+                   DELETE_PARTICIPANT_QUERY, TOUCH_QUERY, AVAILABILITY_RULES_QUERY, COACHES_QUERY, VERSIONS_QUERY, \
+                   EVENT_PEOPLE_QUERY, COACH_EVENTS_QUERY, COACH_RULES_QUERY, DELETE_ROLLUP_QUERY, SYNC_STATE_QUERY, \
+                   CHANGES_QUERY, CHANGED_EVENTS_QUERY, UTILIZATION_QUERY, ROLLUP_PERIODS, ConflictIndex, summarize_changes
+from prepared import Statement
+from recurrence import AvailabilityRule
+
+
+def asyncpg_connect_args(connect_string):
+    """
+    Translate a libpq connection string, as used in config.json, into
+    keyword arguments for asyncpg, which only understands URIs
+    """
+    args = parse_dsn(connect_string)
+    if 'dbname' in args:
+        args['database'] = args.pop('dbname')
+    if 'port' in args:
+        args['port'] = int(args['port'])
+    return args
+
+
+@functools.lru_cache(maxsize=None)
+def _statement(query):
+    return Statement('async', query)
+
+
+def positional(query, **args):
+    """
+    One of the queries shared with PostgresDataStore, written with
+    %(name)s placeholders, as asyncpg takes it: the query with $n
+    placeholders followed by the arguments in order
+    """
+    statement = _statement(query)
+    return [statement.positional] + statement.positional_args(args)
+
+
+def positional_many(query, args):
+    """
+    A shared query and a list of dicts of arguments for executemany
+    """
+    statement = _statement(query)
+    return statement.positional, [statement.positional_args(a) for a in args]
+
+
+async def load_participants(conn, events):
+    """
+    Fill in the participants of a list of events using one batched query
+    """
+    by_id = {}
+    for event in events:
+        event.participants = []
+        by_id[event.id] = event
+    if by_id:
+        rows = await conn.fetch(*positional(PARTICIPANTS_QUERY, event_ids=list(by_id),
+                                            first_start_time=min(event.start_time for event in events),
+                                            last_start_time=max(event.start_time for event in events)))
+        for row in rows:
+            by_id[row['event_id']].participants.append(row['person_id'])
+    return events
+
+
+async def fetch_event(conn, id, lock=False):
+    """
+    Read an event and its participants or raise NonExistantIdError,
+    locking it first if lock is True, as events.fetch_event does
+    """
+    if lock and await conn.fetchrow(*positional(LOCK_EVENT_QUERY, id=id)) is None:
+        raise NonExistantIdError("no event exists with id %s" % id)
+    row = await conn.fetchrow(*positional(FETCH_EVENT_QUERY, id=id))
+    if row is None:
+        raise NonExistantIdError("no event exists with id %s" % id)
+    return (await load_participants(conn, [Event(**row)]))[0]
+
+
+async def check_booking(conn, event, also_lock=()):
+    """
+    Raise BookingConflictError if a booking clashes with anything its
+    participants have on, locking their person rows, and those of
+    also_lock, as events.check_booking does
+    """
+    if event.type not in BOOKING_TYPES or not event.participants:
+        return
+    participants = sorted(set(event.participants))
+    await conn.execute(*positional(LOCK_PEOPLE_QUERY, person_ids=sorted(set(participants) | set(also_lock))))
+    rows = await conn.fetch(*positional(OVERLAPPING_EVENTS_QUERY,
+                                        **window_args(as_datetime(event.start_time), as_datetime(event.end_time),
+                                                      participants=participants, event_id=event.id)))
+    if rows:
+        raise BookingConflictError("%s to %s is already booked" % (event.start_time, event.end_time),
+                                   [row['id'] for row in rows])
+
+
+async def check_bookings(conn, events):
+    """
+    Check the bookings among a batch of events to be created together, as
+    events.check_bookings does
+    """
+    bookings = [event for event in events if event.type in BOOKING_TYPES and event.participants]
+    if not bookings:
+        return
+    await conn.execute(*positional(LOCK_PEOPLE_QUERY, person_ids=sorted({person_id for event in events
+                                                                         for person_id in event.participants})))
+    clashes = batch_conflicts(events)
+    if clashes:
+        event, clashing = clashes[0]
+        raise BookingConflictError("%s to %s clashes with another event of the batch" %
+                                   (event.start_time, event.end_time), [other.id for other in clashing])
+    for event in bookings:
+        rows = await conn.fetch(*positional(OVERLAPPING_EVENTS_QUERY,
+                                            **window_args(as_datetime(event.start_time), as_datetime(event.end_time),
+                                                          participants=sorted(set(event.participants)),
+                                                          event_id=event.id)))
+        if rows:
+            raise BookingConflictError("%s to %s is already booked" % (event.start_time, event.end_time),
+                                       [row['id'] for row in rows])
+
+
+class AsyncPostgresDataStore:
+    """
+    The same interface as events.PostgresDataStore with coroutine methods,
+    for use from an asyncio web service. Call open() before use and close()
+    when done.
+
+    Independent queries run concurrently: get_calendar fetches the client's
+    and the coach's events at the same time on two pooled connections.
+    """
+    def __init__(self, connect_string, min_size=2, max_size=10, availability_cache=None):
+        self.connect_string = connect_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.availability_cache = availability_cache
+        self.pool = None
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(min_size=self.min_size, max_size=self.max_size,
+                                              **asyncpg_connect_args(self.connect_string))
+        return self
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def _changed(self, *events):
+        if self.availability_cache is not None:
+            for event in events:
+                self.availability_cache.invalidate_event(event)
+
+    async def _record(self, conn, op, *events):
+        """
+        Log the change to each participant's calendar and bump their change
+        versions within a write's transaction, as PostgresDataStore does
+        """
+        rows = [(person_id, event.id, op, as_datetime(event.start_time), as_datetime(event.end_time))
+                for event in events for person_id in event.participants]
+        await conn.executemany("""\
+            INSERT INTO event_change (person_id, event_id, op, start_time, end_time)
+            VALUES ($1, $2, $3, $4, $5);""", rows)
+        coach_ids = await self._touch(conn, (row[0] for row in rows))
+        for coach_id in coach_ids:
+            days = merge_ranges(affected_days(event) for event in events if coach_id in event.participants)
+            for first_day, end_day in days:
+                await self._refresh_rollup(conn, coach_id, first_day, end_day)
+
+    async def _touch(self, conn, person_ids):
+        """
+        Bump the change version of the given people within a write's
+        transaction, as PostgresDataStore does
+
+        :return: the IDs of those of the people who are coaches
+        """
+        person_ids = sorted(set(person_ids))
+        if not person_ids:
+            return []
+        rows = await conn.fetch(*positional(TOUCH_QUERY, person_ids=person_ids))
+        return sorted(row['id'] for row in rows if row['coach'])
+
+    async def _refresh_rollup(self, conn, person_id, first_day, end_day):
+        """
+        Recompute a coach's rows of the utilization rollup for a range of
+        days, as PostgresDataStore does
+        """
+        start_time = datetime.combine(first_day, datetime.min.time())
+        end_time = datetime.combine(end_day, datetime.min.time())
+        rows = await conn.fetch(*positional(EVENTS_BETWEEN_QUERY, **window_args(start_time, end_time, person_id=person_id)))
+        events = [Event(**row) for row in rows]
+        rules = await conn.fetch(*positional(AVAILABILITY_RULES_QUERY, person_id=person_id))
+        events.extend(availability_events([AvailabilityRule(**row) for row in rules], start_time, end_time))
+        counts = daily_slot_counts(events, start_time, end_time)
+        await conn.execute(*positional(DELETE_ROLLUP_QUERY, person_id=person_id, first_day=first_day, end_day=end_day))
+        await conn.executemany("""\
+            INSERT INTO coach_daily_rollup (person_id, day, open_slots, booked_slots)
+            VALUES ($1, $2, $3, $4);""", [(person_id, day, o, b) for day, (o, b) in sorted(counts.items())])
+
+    async def get_versions(self, person_ids):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(VERSIONS_QUERY, person_ids=list(person_ids)))
+            return {row['id']: row['version'] for row in rows}
+
+    async def get_sync_state(self, person_ids):
+        """
+        A sync token for get_changes along with the change versions of the
+        given people, as PostgresDataStore.get_sync_state returns
+        """
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(SYNC_STATE_QUERY, person_ids=list(person_ids)))
+        return rows[0]['token'], {row['id']: row['version'] for row in rows if row['id'] is not None}
+
+    async def get_utilization(self, start_time, end_time, period='day', coach_id=None):
+        """
+        Coaches' open and booked appointment slots per day, week or month,
+        as PostgresDataStore.get_utilization returns
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError("unknown period %r" % period)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(UTILIZATION_QUERY, period=period,
+                                                first_day=as_datetime(start_time).date(),
+                                                end_day=as_datetime(end_time).date(), coach_id=coach_id))
+        return [dict(row, utilization=row['booked_slots'] / ((row['open_slots'] + row['booked_slots']) or 1))
+                for row in rows]
+
+    async def get_coaches(self):
+        """
+        Return a list of dict's each representing a coach
+        """
+        async with self.pool.acquire() as conn:
+            return [dict(row) for row in await conn.fetch(*positional(COACHES_QUERY))]
+
+    async def get_participants(self, event_id):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(EVENT_PEOPLE_QUERY, event_id=event_id))
+            if not rows:
+                raise NonExistantIdError("no participants for event id %s" % event_id)
+            return [dict(row) for row in rows]
+
+    async def get_events_between(self, person_id, start_time, end_time):
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        if end_time < start_time:
+            return []
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(EVENTS_BETWEEN_QUERY,
+                                                **window_args(start_time, end_time, person_id=person_id)))
+            return await load_participants(conn, [Event(**row) for row in rows])
+
+    async def get_availability_rules(self, person_id):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(*positional(AVAILABILITY_RULES_QUERY, person_id=person_id))
+            return [AvailabilityRule(**row) for row in rows]
+
+    async def get_appointments(self, person_id, start_time, end_time):
+        cache = self.availability_cache
+        if cache is not None:
+            blocks = cache.get(person_id, start_time, end_time)
+            if blocks is not None:
+                return blocks
+            version = cache.version(person_id)
+        events, rules = await asyncio.gather(self.get_events_between(person_id, start_time, end_time),
+                                             self.get_availability_rules(person_id))
+        blocks = appointments(list(heapq.merge(events, availability_events(rules, start_time, end_time),
+                                               key=lambda event: event.start_time)))
+        if cache is not None:
+            cache.put(person_id, start_time, end_time, blocks, version=version)
+        return blocks
+
+    async def get_calendar(self, person_id, coach_id, start_time, end_time):
+        """
+        The client's events plus the coach's appointment slots that don't
+        conflict with them, fetching both calendars concurrently
+        """
+        user_events, coach_blocks = await asyncio.gather(
+            self.get_events_between(person_id, start_time, end_time),
+            self.get_appointments(coach_id, start_time, end_time))
+        return remove_conflicting(coach_blocks, user_events) + user_events
+
+    async def get_changes(self, person_id, coach_id, start_time, end_time, token=None):
+        """
+        What changed in a client's view of a coach's calendar since the
+        sync token was handed out, as PostgresDataStore.get_changes returns
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        changes = []
+        async with self.pool.acquire() as conn:
+            new_token = await conn.fetchval(*positional(SYNC_STATE_QUERY, person_ids=[]))
+            if token is not None:
+                changes = await conn.fetch(*positional(CHANGES_QUERY, person_ids=[person_id, coach_id], token=token))
+        if token is None or any(change['op'] == 'rule' for change in changes):
+            return {'token': new_token, 'reset': True,
+                    'events': await self.get_calendar(person_id, coach_id, start_time, end_time)}
+
+        changed_ids, ranges = summarize_changes(changes, person_id, start_time, end_time)
+        events = []
+        if changed_ids:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(*positional(CHANGED_EVENTS_QUERY,
+                                                    **window_args(start_time, end_time, person_id=person_id,
+                                                                  changed_ids=changed_ids)))
+                events = await load_participants(conn, [Event(**row) for row in rows])
+        user_events = await self.get_events_between(person_id, ranges[0][0], ranges[-1][1]) if ranges else []
+        index = ConflictIndex(user_events)
+        slots = []
+        for s, e in ranges:
+            slots.extend(block for block in await self.get_appointments(coach_id, s, e)
+                         if block.start_time < e and block.end_time > s and not index.conflicts(block))
+        current = {event.id for event in events}
+        return {'token': new_token, 'reset': False,
+                'events': events,
+                'deleted': [id for id in changed_ids if id not in current],
+                'ranges': ranges,
+                'slots': slots}
+
+    async def search_availability(self, start_time, end_time, limit=10, person_id=None):
+        """
+        Find the earliest open appointment slots with any coach, reading the
+        coaches' events, their availability rules and the client's events
+        concurrently
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        if end_time < start_time:
+            return []
+
+        async def coach_events():
+            async with self.pool.acquire() as conn:
+                return await conn.fetch(*positional(COACH_EVENTS_QUERY, **window_args(start_time, end_time)))
+
+        async def coach_rules():
+            async with self.pool.acquire() as conn:
+                return await conn.fetch(*positional(COACH_RULES_QUERY))
+
+        async def no_events():
+            return []
+
+        event_rows, rule_rows, busy = await asyncio.gather(
+            coach_events(), coach_rules(),
+            self.get_events_between(person_id, start_time, end_time) if person_id else no_events())
+        calendars = {}
+        for row in event_rows:
+            row = dict(row)
+            calendars.setdefault(row.pop('coach_id'), []).append(Event(**row))
+        rules = {}
+        for row in rule_rows:
+            rules.setdefault(row['person_id'], []).append(AvailabilityRule(**row))
+        for coach_id, person_rules in rules.items():
+            calendars.setdefault(coach_id, []).extend(availability_events(person_rules, start_time, end_time))
+        return earliest_open_slots(calendars, start_time, end_time, limit=limit, busy=busy)
+
+    async def create_event(self, start_time, end_time, name=None, notes=None, type='event', participants=None):
+        if participants is None:
+            participants = []
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await check_booking(conn, Event(start_time=start_time, end_time=end_time, type=type,
+                                                participants=participants))
+                event_id, stored_start_time = await conn.fetchrow(*positional(
+                    INSERT_EVENT_QUERY, start_time=as_datetime(start_time), end_time=as_datetime(end_time),
+                    name=name, notes=notes, type=type))
+                await conn.executemany(*positional_many(INSERT_PARTICIPANT_QUERY, [
+                    {'event_id': event_id, 'person_id': participant_id, 'start_time': stored_start_time}
+                    for participant_id in participants]))
+                event = Event(id=event_id,
+                              start_time=start_time,
+                              end_time=end_time,
+                              name=name,
+                              notes=notes,
+                              type=type,
+                              participants=participants)
+                await self._record(conn, 'create', event)
+        self._changed(event)
+        return event
+
+    async def create_events(self, events):
+        """
+        Create many events in a single transaction, loading them with COPY,
+        checking the bookings among them as create_event does
+
+        :param events: an iterable of Event objects or of dicts of create_event's arguments
+        :return: a list of the new events, with their IDs, in the order given
+        """
+        events = [Event(**event.as_dict()) if isinstance(event, Event) else Event(**dict({'type': 'event'}, **event))
+                  for event in events]
+        if not events:
+            return []
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                ids = await conn.fetch("SELECT nextval('event_id_seq') FROM generate_series(1, $1)", len(events))
+                for event, row in zip(events, ids):
+                    event.id = row[0]
+                await check_bookings(conn, events)
+                await conn.copy_records_to_table(
+                    'event', columns=('id', 'start_time', 'end_time', 'name', 'notes', 'type'),
+                    records=[(e.id, as_datetime(e.start_time), as_datetime(e.end_time), e.name, e.notes, e.type)
+                             for e in events])
+                await conn.copy_records_to_table(
+                    'participant', columns=('event_id', 'person_id', 'start_time'),
+                    records=[(e.id, person_id, as_datetime(e.start_time)) for e in events for person_id in e.participants])
+                await self._record(conn, 'create', *events)
+        self._changed(*events)
+        return events
+
+    async def update_event(self, id, start_time, end_time, name, notes, type, participants=None):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                old_event = await fetch_event(conn, id, lock=True)
+                await check_booking(conn, Event(id=id, start_time=start_time, end_time=end_time, type=type,
+                                                participants=old_event.participants if participants is None
+                                                else participants),
+                                    also_lock=old_event.participants)
+                stored_start_time = await conn.fetchval(*positional(
+                    UPDATE_EVENT_QUERY, start_time=as_datetime(start_time), end_time=as_datetime(end_time),
+                    name=name, notes=notes, type=type, id=id, old_start_time=old_event.start_time))
+
+                ## update participants by adding or deleting participants as necessary
+                if participants is not None:
+                    current_participants = old_event.participants
+                    await conn.executemany(*positional_many(INSERT_PARTICIPANT_QUERY, [
+                        {'event_id': id, 'person_id': participant_id, 'start_time': stored_start_time}
+                        for participant_id in participants if participant_id not in current_participants]))
+                    await conn.executemany(*positional_many(DELETE_PARTICIPANT_QUERY, [
+                        {'event_id': id, 'person_id': participant_id, 'start_time': stored_start_time}
+                        for participant_id in current_participants if participant_id not in participants]))
+
+                ## construct newly modified event from database
+                event = await fetch_event(conn, id)
+                await self._record(conn, 'update', old_event, event)
+        self._changed(old_event, event)
+        return event
+
+    async def delete_event(self, id):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                event = await fetch_event(conn, id, lock=True)
+                await conn.execute(*positional(DELETE_EVENT_QUERY, id=id, start_time=event.start_time))
+                await self._record(conn, 'delete', event)
+        self._changed(event)
+        return event
+
+    async def get_event(self, id):
+        async with self.pool.acquire() as conn:
+            return await fetch_event(conn, id)
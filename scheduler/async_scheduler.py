@@ -0,0 +1,193 @@
+"""
+Asynchronous (ASGI) web service endpoints for the Scheduler app.
+
+Serves the endpoints of scheduler.py using Quart, Flask's asyncio
+counterpart, over an asyncpg backed data store, except that /calendar
+doesn't stream (the stream argument is ignored) and there is no /metrics,
+as request instrumentation hooks into Flask. Run with:
+
+    cd scheduler
+    hypercorn async_scheduler:app
+"""
+import json
+import os
+from quart import Quart, request, send_file, send_from_directory
+from utils import week_window_to_show, events_to_json, calendar_etag, ScheldulerJSONEncoder
+from events import NonExistantIdError, BookingConflictError
+from async_events import AsyncPostgresDataStore
+from cache import AvailabilityCache
+
+app = Quart(__name__, static_url_path='/static/')
+
+
+## read config file
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+with open(config_path) as f:
+    config = json.loads(f.read())
+
+availability_cache = None
+if 'availability_cache' in config:
+    availability_cache = AvailabilityCache(**config['availability_cache'])
+
+pool_config = config.get('pool', {})
+db = AsyncPostgresDataStore(config['db_connect'],
+                            min_size=pool_config.get('min_size', 2),
+                            max_size=pool_config.get('max_size', 10),
+                            availability_cache=availability_cache)
+
+
+@app.before_serving
+async def open_db():
+    await db.open()
+
+
+@app.after_serving
+async def close_db():
+    await db.close()
+
+
+def json_response(obj, status=200):
+    return app.response_class(json.dumps(obj, cls=ScheldulerJSONEncoder),
+                              status=status, mimetype='application/json')
+
+
+## hack for development purposes: serve static content
+@app.route('/', methods=['GET'])
+async def root():
+    return await send_file('static/index.html')
+
+## hack for development purposes: serve static content
+@app.route('/js/<path:path>', methods=['GET'])
+async def send_js(path):
+    return await send_from_directory('static', path)
+
+
+@app.route('/coaches/', methods=['GET'])
+async def api_coaches():
+    """
+    Get the list of all coaches for populating menu
+    """
+    response = json_response(await db.get_coaches())
+    await response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = config.get('coaches_max_age', 60)
+    return await response.make_conditional(request)
+
+
+@app.route('/participants/<int:event_id>/', methods=['GET'])
+async def api_participants(event_id):
+    """
+    Get the list of people participating in the given event
+    """
+    return json_response(await db.get_participants(event_id))
+
+
+@app.route('/calendar/<int:person_id>/<int:coach_id>/', methods=['GET'])
+async def api_schedule_with_coach(person_id, coach_id):
+    """
+    Client's view of a coach's schedule for browsing available appointments.
+    The Sync-Token header is for getting later changes from /sync/.
+    """
+    s,e = week_window_to_show(request.args)
+    token, versions = await db.get_sync_state((person_id, coach_id))
+    etag = calendar_etag(versions, person_id, coach_id, s, e, None)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class('', status=304)
+    else:
+        response = app.response_class(events_to_json(await db.get_calendar(person_id, coach_id, s, e)),
+                                      mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Sync-Token'] = str(token)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/sync/<int:person_id>/<int:coach_id>/', methods=['GET'])
+async def api_sync(person_id, coach_id):
+    """
+    Changes to the client's view of a coach's schedule since the given
+    token, see AsyncPostgresDataStore.get_changes
+    """
+    s,e = week_window_to_show(request.args)
+    token = request.args.get('token', type=int)
+    return json_response(await db.get_changes(person_id, coach_id, s, e, token=token))
+
+
+@app.route('/availability/search/', methods=['GET'])
+async def api_search_availability():
+    """
+    The earliest open appointment slots with any coach
+    """
+    s,e = week_window_to_show(request.args)
+    limit = request.args.get('limit', 10, type=int)
+    person_id = request.args.get('person_id', type=int)
+    return app.response_class(events_to_json(await db.search_availability(s, e, limit=limit, person_id=person_id)),
+                              mimetype='application/json')
+
+
+@app.route('/reports/utilization/', methods=['GET'])
+async def api_utilization():
+    """
+    Coaches' open and booked appointment slots and the fraction booked, per
+    day, week or month, read from the daily rollups
+    """
+    s,e = week_window_to_show(request.args)
+    period = request.args.get('period', 'day')
+    coach_id = request.args.get('coach_id', type=int)
+    try:
+        rows = await db.get_utilization(s, e, period=period, coach_id=coach_id)
+    except ValueError as ex:
+        return json_response({'error-message':str(ex)}, status=400)
+    return json_response([dict(row, period=row['period'].isoformat()) for row in rows])
+
+
+@app.route('/event/', methods=['POST', 'PUT', 'DELETE'])
+@app.route('/event/<int:event_id>/', methods=['GET', 'DELETE'])
+async def api_event(event_id=None):
+    """
+    CRUD for events.
+    Post=book a new event, Put=update an existing event
+    Delete can have a JSON body or just refer to an event by its ID in the URL
+    """
+    if request.method=='POST':
+        ap_request = await request.get_json()
+        return json_response(await db.create_event(**ap_request))
+    elif request.method=='GET':
+        return json_response(await db.get_event(event_id))
+    elif request.method=='PUT':
+        ap_request = await request.get_json()
+        return json_response(await db.update_event(**ap_request))
+    elif request.method=='DELETE':
+        if not event_id:
+            ap_request = await request.get_json()
+            event_id = ap_request['id']
+        return json_response(await db.delete_event(event_id))
+    else:
+        raise ValueError('Unsupported method '+request.method)
+
+
+@app.route('/events/batch/', methods=['POST'])
+async def api_events_batch():
+    """
+    Create many events at once from a JSON list of events, in one transaction
+    """
+    return json_response(await db.create_events(await request.get_json()))
+
+
+@app.route('/stats/', methods=['GET'])
+async def api_stats():
+    """
+    Operational counters for sizing the availability cache
+    """
+    return json_response({'availability_cache': availability_cache.stats() if availability_cache else None})
+
+
+@app.errorhandler(NonExistantIdError)
+async def handle_bad_request(ex):
+    return json_response({'error-message':str(ex)}, status=404)
+
+
+@app.errorhandler(BookingConflictError)
+async def handle_booking_conflict(ex):
+    return json_response({'error-message':str(ex), 'conflicts':ex.conflicts}, status=409)
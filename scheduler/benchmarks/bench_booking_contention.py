@@ -0,0 +1,148 @@
+"""
+Measure booking throughput on a single hot coach. Client threads race to
+book one hour slots with the same coach, retrying another slot whenever
+theirs was taken first, until every slot is booked. Reports bookings and
+conflicts per second, booking latency, and checks that no slot was booked
+twice. Then the same clients each create and delete events with the coach
+as fast as they can, checking that writes sharing a participant never
+deadlock.
+
+Needs a database set up as described in the readme. Run from the
+scheduler directory:
+
+    python benchmarks/bench_booking_contention.py [threads] [slots] [events]
+
+A throwaway coach and clients are created and removed again afterwards.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2 import errorcodes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import PostgresDataStore, BookingConflictError
+from pool import ConnectionPool
+
+
+def create_person(db, name, coach=False):
+    with db._cursor() as curs:
+        curs.execute("INSERT INTO person (first_name, last_name, coach, client) VALUES (%s, %s, %s, %s) RETURNING id;",
+                     ('Benchmark', name, coach, not coach))
+        return curs.fetchone()[0]
+
+
+def delete_people(db, person_ids):
+    with db._cursor() as curs:
+        curs.execute("DELETE FROM event WHERE id IN (SELECT event_id FROM participant WHERE person_id = ANY(%s))",
+                     (person_ids,))
+        curs.execute("DELETE FROM person WHERE id = ANY(%s)", (person_ids,))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p/100))]
+
+
+def churn(db, coach_id, client_ids, n_events, start):
+    """
+    Have a thread per client create and delete n_events plain events, none
+    of them bookings, with both the client and the coach
+
+    :return: the elapsed time and the number of deadlocks
+    """
+    lock = threading.Lock()
+    deadlocks = [0]
+
+    def client(client_id):
+        for i in range(n_events):
+            slot = start + timedelta(minutes=i)
+            try:
+                event = db.create_event(start_time=slot, end_time=slot+timedelta(minutes=30), type='event',
+                                        name='Meeting', participants=[coach_id, client_id])
+                db.delete_event(event.id)
+            except psycopg2.Error as ex:
+                if ex.pgcode != errorcodes.DEADLOCK_DETECTED:
+                    raise
+                with lock:
+                    deadlocks[0] += 1
+
+    workers = [threading.Thread(target=client, args=(client_id,)) for client_id in client_ids]
+    t = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - t, deadlocks[0]
+
+
+def main(threads, n_slots, n_events):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')) as f:
+        config = json.loads(f.read())
+    pool = ConnectionPool(config['db_connect'], max_size=threads)
+    db = PostgresDataStore(config['db_connect'], pool=pool)
+
+    start = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(days=1, hours=8)
+    slots = [start + timedelta(hours=i) for i in range(n_slots)]
+
+    coach_id = create_person(db, 'Coach', coach=True)
+    client_ids = [create_person(db, 'Client %d' % i) for i in range(threads)]
+    lock = threading.Lock()
+    booked = []
+    conflicts = [0]
+    latencies = []
+
+    def client(client_id):
+        rng = random.Random(client_id)
+        free = list(slots)
+        while free:
+            slot = free.pop(rng.randrange(len(free)))
+            t = time.perf_counter()
+            try:
+                event = db.create_event(start_time=slot, end_time=slot+timedelta(hours=1), type='coaching',
+                                        name='Coaching session', participants=[coach_id, client_id])
+            except BookingConflictError:
+                with lock:
+                    conflicts[0] += 1
+                    latencies.append(time.perf_counter() - t)
+                continue
+            with lock:
+                booked.append(event)
+                latencies.append(time.perf_counter() - t)
+
+    try:
+        workers = [threading.Thread(target=client, args=(client_id,)) for client_id in client_ids]
+        t = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - t
+
+        starts = sorted(event.start_time for event in booked)
+        assert len(starts) == len(set(starts)) == n_slots, "double booked!"
+
+        print("%d clients booking %d slots with one coach" % (threads, n_slots))
+        print("  %7.1f bookings/s, %7.1f conflicts/s (%d conflicts)" % (
+            len(booked)/elapsed, conflicts[0]/elapsed, conflicts[0]))
+        print("  latency p50 %6.2f ms, p95 %6.2f ms, p99 %6.2f ms" % tuple(
+            percentile(latencies, p)*1000 for p in (50, 95, 99)))
+        print("  pool waits: %(waits)d, longest wait %(wait_time_max).3f s" % pool.stats())
+
+        elapsed, deadlocks = churn(db, coach_id, client_ids, n_events, start + timedelta(days=1))
+        print("%d clients creating and deleting %d events each with one coach" % (threads, n_events))
+        print("  %7.1f events/s, %d deadlocks" % (threads*n_events/elapsed, deadlocks))
+        assert deadlocks == 0, "deadlocked!"
+    finally:
+        delete_people(db, [coach_id] + client_ids)
+        pool.closeall()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 50)
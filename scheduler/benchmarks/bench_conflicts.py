@@ -0,0 +1,95 @@
+"""
+Compare the ConflictIndex based slot engine against the original linear
+scan, on synthetic coach calendars of 1k, 10k and 100k events.
+
+Run from the scheduler directory:
+
+    python benchmarks/bench_conflicts.py
+
+The linear scan is quadratic, so at large sizes it's timed on a sample of
+blocks and extrapolated; those figures are marked with a ~.
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import Event, divide_into_blocks, appointments, remove_conflicting
+
+
+def linear_has_conflicts(event, events):
+    """
+    has_conflicts as it was before ConflictIndex
+    """
+    for other_event in events:
+        if other_event.type != 'schedulable' and \
+           other_event.start_time < event.end_time and \
+           other_event.end_time > event.start_time:
+            return True
+    return False
+
+
+def make_calendar(n, seed=42):
+    """
+    Make n events: a morning and afternoon schedulable block on each weekday,
+    with coaching sessions booked into roughly half of the hours.
+    """
+    rng = random.Random(seed)
+    events = []
+    day = datetime(2020, 1, 6)
+    while len(events) < n:
+        if day.weekday() < 5:
+            for start_hour in (8, 13):
+                start = day + timedelta(hours=start_hour)
+                events.append(Event(start_time=start, end_time=start+timedelta(hours=4), type='schedulable'))
+                for hour in range(4):
+                    if len(events) < n and rng.random() < 0.5:
+                        s = start + timedelta(hours=hour)
+                        events.append(Event(start_time=s, end_time=s+timedelta(hours=1), type='coaching'))
+        day += timedelta(days=1)
+    return events[:n]
+
+
+def time_it(f, *args):
+    t = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t
+
+
+def time_linear(blocks, events, sample_size=2000):
+    """
+    Time the linear scan over all blocks, or estimate it from a sample
+    """
+    sample = blocks if len(blocks) <= sample_size else random.Random(0).sample(blocks, sample_size)
+    t = time.perf_counter()
+    for block in sample:
+        linear_has_conflicts(block, events)
+    elapsed = time.perf_counter() - t
+    return elapsed * len(blocks) / max(len(sample), 1), len(sample) < len(blocks)
+
+
+def main():
+    print("%8s %8s %18s %14s %8s" % ('events', 'blocks', 'linear (s)', 'indexed (s)', 'speedup'))
+    for n in (1000, 10000, 100000):
+        events = make_calendar(n)
+        blocks = [block for event in events if event.type == 'schedulable'
+                        for block in divide_into_blocks(event)]
+
+        linear, estimated = time_linear(blocks, events)
+        indexed = time_it(appointments, events)
+
+        ## remove_conflicting is the same shape of work against a client's calendar
+        client_events = make_calendar(n // 10 or 1, seed=7)
+        linear_rc, estimated_rc = time_linear(blocks, client_events)
+        indexed_rc = time_it(remove_conflicting, blocks, client_events)
+
+        print("%8d %8d %17s%s %14.4f %7.0fx  appointments" % (
+            n, len(blocks), '%.4f' % linear, '~' if estimated else ' ', indexed, linear / indexed))
+        print("%8d %8d %17s%s %14.4f %7.0fx  remove_conflicting" % (
+            n, len(blocks), '%.4f' % linear_rc, '~' if estimated_rc else ' ', indexed_rc, linear_rc / indexed_rc))
+
+
+if __name__ == '__main__':
+    main()
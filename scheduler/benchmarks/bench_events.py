@@ -0,0 +1,101 @@
+"""
+Measure memory and serialization throughput of Event objects, comparing
+the __slots__ Event and events_to_json against the original __dict__
+based Event serialized through ScheldulerJSONEncoder.
+
+Run from the scheduler directory:
+
+    python benchmarks/bench_events.py [n_events]
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import Event
+from utils import ScheldulerJSONEncoder, events_to_json
+
+ATTRS = ['id', 'start_time', 'end_time', 'name', 'type', 'notes', 'participants']
+
+
+class DictEvent:
+    """
+    Event as it was before __slots__
+    """
+    def __init__(self, start_time, end_time, type, id=None, name=None, notes=None, participants=[]):
+        self.id = id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.name = name
+        self.type = type
+        self.notes = notes
+        self.participants = participants
+
+
+class DictEventEncoder(ScheldulerJSONEncoder):
+    """
+    ScheldulerJSONEncoder as it was, building a dict per event
+    """
+    def default(self, obj):
+        if isinstance(obj, DictEvent):
+            return {attr:getattr(obj,attr) for attr in ATTRS if getattr(obj,attr)}
+        return super().default(obj)
+
+
+def make_events(cls, n):
+    t0 = datetime(2020, 1, 6, 8)
+    events = []
+    for i in range(n):
+        start = t0 + timedelta(hours=i)
+        if i % 3:
+            events.append(cls(start_time=start, end_time=start+timedelta(hours=1),
+                              name='Available', type='open slot'))
+        else:
+            events.append(cls(id=i, start_time=start, end_time=start+timedelta(hours=1),
+                              name='Coaching', type='coaching', participants=[1, 100+i%50]))
+    return events
+
+
+def measure_memory(cls, n):
+    gc.collect()
+    tracemalloc.start()
+    events = make_events(cls, n)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del events
+    return current
+
+
+def measure_throughput(f, events, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f(events)
+        best = min(best, time.perf_counter() - t)
+    return len(events) / best
+
+
+def main(n):
+    old_memory = measure_memory(DictEvent, n)
+    new_memory = measure_memory(Event, n)
+    print("memory for %d events" % n)
+    print("  __dict__ Event: %8.1f MB  (%d bytes/event)" % (old_memory/1e6, old_memory//n))
+    print("  __slots__ Event: %7.1f MB  (%d bytes/event)" % (new_memory/1e6, new_memory//n))
+
+    old_events = make_events(DictEvent, n)
+    new_events = make_events(Event, n)
+    old_rate = measure_throughput(lambda events: json.dumps(events, cls=DictEventEncoder), old_events)
+    encoder_rate = measure_throughput(lambda events: json.dumps(events, cls=ScheldulerJSONEncoder), new_events)
+    fast_rate = measure_throughput(events_to_json, new_events)
+    print("serialization throughput")
+    print("  original encoder:        %9.0f events/s" % old_rate)
+    print("  encoder, __slots__ Event: %8.0f events/s" % encoder_rate)
+    print("  events_to_json:          %9.0f events/s  (%.1fx)" % (fast_rate, fast_rate/old_rate))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,111 @@
+"""
+Compare the data store's queries run as prepared statements against the
+same queries sent as plain text: the latency of get_events_between,
+get_event and update_event as the app sees it, and the time Postgres
+spends planning and executing the window query, from EXPLAIN ANALYZE.
+
+Needs a database set up as described in the readme. Run from the
+scheduler directory:
+
+    python benchmarks/bench_prepared.py [repeat]
+
+A throwaway coach with a few weeks of events is created and removed again
+afterwards.
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import PostgresDataStore, EVENTS_BETWEEN_QUERY, PREPARED, window_args
+from pool import ConnectionPool
+from report import percentile
+
+
+def create_coach(db):
+    with db._cursor() as curs:
+        curs.execute("INSERT INTO person (first_name, last_name, coach) VALUES (%s, %s, %s) RETURNING id;",
+                     ('Benchmark', 'Prepared', True))
+        return curs.fetchone()[0]
+
+
+def delete_coach(db, coach_id):
+    with db._cursor() as curs:
+        curs.execute("DELETE FROM event WHERE id IN (SELECT event_id FROM participant WHERE person_id=%s)", (coach_id,))
+        curs.execute("DELETE FROM person WHERE id=%s", (coach_id,))
+
+
+def time_calls(f, repeat):
+    latencies = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        latencies.append(time.perf_counter() - t)
+    return min(latencies), percentile(latencies, 50)
+
+
+def explain(db, query, args, repeat):
+    """
+    Median planning and execution time in seconds Postgres reports for a query
+    """
+    planning, execution = [], []
+    with db._cursor() as curs:
+        for _ in range(repeat):
+            curs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, args)
+            plan = curs.fetchone()[0][0]
+            planning.append(plan['Planning Time'] / 1000.0)
+            execution.append(plan['Execution Time'] / 1000.0)
+    return percentile(planning, 50), percentile(execution, 50)
+
+
+def main(repeat):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')) as f:
+        config = json.loads(f.read())
+    ## one connection, so every call runs on the connection prepared on the first
+    pool = ConnectionPool(config['db_connect'], max_size=1)
+    plain = PostgresDataStore(config['db_connect'], pool=pool)
+    prepared = PostgresDataStore(config['db_connect'], pool=pool, prepared_statements=True)
+
+    monday = datetime.combine(datetime.now().date(), datetime.min.time())
+    monday -= timedelta(days=monday.weekday())
+    coach_id = create_coach(plain)
+    try:
+        events = plain.create_events({'start_time': monday + timedelta(days=d, weeks=w, hours=h),
+                                      'end_time': monday + timedelta(days=d, weeks=w, hours=h+1),
+                                      'type': 'event',
+                                      'participants': [coach_id]}
+                                     for w in range(8) for d in range(5) for h in range(9, 17))
+        event = events[len(events)//2]
+        start_time, end_time = monday, monday + timedelta(weeks=1)
+
+        def update(db):
+            db.update_event(event.id, event.start_time, event.end_time, 'Moved', None, event.type)
+            db.update_event(event.id, event.start_time, event.end_time, event.name, event.notes, event.type)
+
+        print("latency over %d calls, best / median" % repeat)
+        for name, f in (('get_events_between', lambda db: db.get_events_between(coach_id, start_time, end_time)),
+                        ('get_event', lambda db: db.get_event(event.id)),
+                        ('update_event x2', update)):
+            for label, db in (('plain', plain), ('prepared', prepared)):
+                best, median = time_calls(lambda: f(db), repeat)
+                print("  %-20s %-9s %8.3f ms %8.3f ms" % (name, label, best*1000, median*1000))
+
+        ## plain queries are planned every time, prepared ones settle on a
+        ## generic plan after five runs, if it's not much worse
+        args = window_args(start_time, end_time, person_id=coach_id)
+        statement = PREPARED.statements['events_between']
+        print("events_between on the server, median of %d, planning / execution" % repeat)
+        for label, db, query in (('plain', plain, EVENTS_BETWEEN_QUERY.rstrip().rstrip(';')),
+                                 ('prepared', prepared, statement.execute_sql)):
+            planning, execution = explain(db, query, args, repeat)
+            print("  %-29s %8.3f ms %8.3f ms" % (label, planning*1000, execution*1000))
+        print("prepared statements", prepared.prepared.stats())
+    finally:
+        delete_coach(plain, coach_id)
+        pool.closeall()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,94 @@
+"""
+Compare availability stored as recurrence rules against availability
+materialized as one 'schedulable' event per block: rows stored and the
+time get_appointments takes over windows of different widths.
+
+Needs a database set up as described in the readme. Run from the
+scheduler directory:
+
+    python benchmarks/bench_recurrence.py [weeks]
+
+Two throwaway coaches are created and removed again afterwards.
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import PostgresDataStore
+
+DAYS = ('MO', 'TU', 'WE', 'TH', 'FR')
+
+
+def create_coach(db, name):
+    with db._cursor() as curs:
+        curs.execute("INSERT INTO person (first_name, last_name, coach) VALUES (%s, %s, %s) RETURNING id;",
+                     ('Benchmark', name, True))
+        return curs.fetchone()[0]
+
+
+def delete_coach(db, coach_id):
+    with db._cursor() as curs:
+        curs.execute("DELETE FROM event WHERE id IN (SELECT event_id FROM participant WHERE person_id=%s)", (coach_id,))
+        curs.execute("DELETE FROM person WHERE id=%s", (coach_id,))
+
+
+def count_rows(db, coach_id):
+    with db._cursor() as curs:
+        curs.execute("SELECT count(*) FROM participant WHERE person_id=%s", (coach_id,))
+        events = curs.fetchone()[0]
+        curs.execute("SELECT count(*) FROM availability_rule WHERE person_id=%s", (coach_id,))
+        return events, curs.fetchone()[0]
+
+
+def time_appointments(db, coach_id, start_time, weeks, repeat=20):
+    end_time = start_time + timedelta(weeks=weeks)
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        blocks = db.get_appointments(coach_id, start_time, end_time)
+        best = min(best, time.perf_counter() - t)
+    return best, len(blocks)
+
+
+def main(weeks):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')) as f:
+        config = json.loads(f.read())
+    db = PostgresDataStore(config['db_connect'])
+
+    ## Monday 8 AM and 1 PM, four hour blocks, every weekday
+    monday = datetime.combine(datetime.now().date(), datetime.min.time())
+    monday -= timedelta(days=monday.weekday())
+    until = monday + timedelta(weeks=weeks)
+
+    materialized = create_coach(db, 'Materialized')
+    recurring = create_coach(db, 'Recurring')
+    try:
+        db.create_events({'start_time': monday + timedelta(days=d, weeks=w, hours=h),
+                          'end_time': monday + timedelta(days=d, weeks=w, hours=h+4),
+                          'type': 'schedulable',
+                          'participants': [materialized]}
+                         for w in range(weeks) for d in range(5) for h in (8, 13))
+        for h in (8, 13):
+            db.create_availability_rule(recurring, dtstart=monday + timedelta(hours=h), duration=timedelta(hours=4),
+                                        rrule='FREQ=WEEKLY;BYDAY=%s;UNTIL=%s' % (','.join(DAYS), until.strftime('%Y%m%dT%H%M%S')))
+
+        print("rows stored for %d weeks of availability" % weeks)
+        print("  materialized: %5d events, %d rules" % count_rows(db, materialized))
+        print("  recurring:    %5d events, %d rules" % count_rows(db, recurring))
+        print("get_appointments, best of 20")
+        for window in (1, 4, weeks):
+            t_m, n_m = time_appointments(db, materialized, monday, window)
+            t_r, n_r = time_appointments(db, recurring, monday, window)
+            assert n_m == n_r
+            print("  %3d week window, %5d blocks: materialized %7.2f ms, recurring %7.2f ms" % (
+                window, n_m, t_m*1000, t_r*1000))
+    finally:
+        delete_coach(db, materialized)
+        delete_coach(db, recurring)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 26)
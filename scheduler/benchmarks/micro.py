@@ -0,0 +1,92 @@
+"""
+Microbenchmarks of the slot engine and JSON serialization at scaled
+calendar sizes: divide_into_blocks, appointments, stream_appointments,
+the NumPy engine in vectorized.py, remove_conflicting,
+ScheldulerJSONEncoder and events_to_json.
+
+Run from the scheduler directory:
+
+    python benchmarks/micro.py [--sizes 1000 10000 100000] [--repeat 5]
+
+Save the results as a baseline with --save and check a later run against
+it with --compare, which exits non-zero if anything got slower by more
+than --threshold:
+
+    python benchmarks/micro.py --save baseline-micro.json
+    python benchmarks/micro.py --compare baseline-micro.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from events import divide_into_blocks, appointments, stream_appointments, remove_conflicting
+from utils import ScheldulerJSONEncoder, events_to_json
+from bench_conflicts import make_calendar
+import vectorized
+from report import save_results, load_results, compare_results
+
+
+def time_best(f, repeat):
+    """
+    Best of repeat runs, being the least disturbed by whatever else the
+    machine is doing
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t)
+    return {'best_s': best}
+
+
+def run(sizes, repeat):
+    results = {}
+    for n in sizes:
+        events = make_calendar(n)
+        schedulable = [event for event in events if event.type == 'schedulable']
+        blocks = appointments(events)
+        client_events = make_calendar(n // 10 or 1, seed=7)
+
+        benchmarks = [
+            ('divide_into_blocks', lambda: [block for event in schedulable for block in divide_into_blocks(event)]),
+            ('appointments', lambda: appointments(events)),
+            ('stream_appointments', lambda: list(stream_appointments(events))),
+            ('vectorized.appointment_arrays', lambda: vectorized.appointment_arrays(events)),
+            ('vectorized.appointments', lambda: vectorized.appointments(events)),
+            ('remove_conflicting', lambda: remove_conflicting(blocks, client_events)),
+            ('ScheldulerJSONEncoder', lambda: json.dumps(blocks, cls=ScheldulerJSONEncoder)),
+            ('events_to_json', lambda: events_to_json(blocks)),
+        ]
+        for name, f in benchmarks:
+            key = '%s n=%d' % (name, n)
+            results[key] = time_best(f, repeat)
+            print("%-40s %10.4f s" % (key, results[key]['best_s']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="numbers of events in the coach's calendar")
+    parser.add_argument('--repeat', type=int, default=5, help="times to run each benchmark")
+    parser.add_argument('--save', metavar='PATH', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare the results against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="fraction by which a time may grow before it counts as a regression")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    if args.save:
+        save_results(args.save, results, params={'sizes': args.sizes, 'repeat': args.repeat})
+    if args.compare:
+        regressions = compare_results(results, load_results(args.compare)['results'], args.threshold)
+        if regressions:
+            print("slower than baseline: %s" % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
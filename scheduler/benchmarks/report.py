@@ -0,0 +1,67 @@
+"""
+Summarizing benchmark results, saving them as a baseline and comparing
+later runs against it. Shared by micro.py and scenario.py.
+
+Results are a dict from the name of what was measured to a dict of
+metrics. Metrics ending in _s are times, where lower is better; all
+others, such as rps, are rates where higher is better.
+"""
+import json
+
+
+def percentile(values, p):
+    """
+    The p-th percentile of values, by the nearest rank method
+    """
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, max(0, int(round(len(values)*p/100.0))-1))]
+
+
+def summarize(latencies, elapsed, errors=0):
+    """
+    Latency percentiles and throughput of a set of timed requests
+
+    :param latencies: seconds each request took
+    :param elapsed: seconds the whole run took
+    """
+    return {'count': len(latencies),
+            'errors': errors,
+            'rps': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_s': percentile(latencies, 50),
+            'p95_s': percentile(latencies, 95),
+            'p99_s': percentile(latencies, 99)}
+
+
+def save_results(path, results, params=None):
+    with open(path, 'w') as f:
+        json.dump({'params': params or {}, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """
+    Print each metric next to its baseline value and return the names of
+    the metrics that got worse by more than threshold, as a fraction
+    """
+    regressions = []
+    print("%-40s %14s %14s %9s" % ('', 'baseline', 'current', 'change'))
+    for name in sorted(results):
+        for metric, value in sorted(results[name].items()):
+            if metric in ('count', 'errors') or name not in baseline or metric not in baseline[name]:
+                continue
+            old = baseline[name][metric]
+            if not old:
+                continue
+            change = (value - old) / old
+            worse = change > threshold if metric.endswith('_s') else change < -threshold
+            if worse:
+                regressions.append('%s %s' % (name, metric))
+            print("%-40s %14.6g %14.6g %+8.1f%%%s" % (
+                '%s %s' % (name, metric), old, value, change*100, '  <- worse' if worse else ''))
+    return regressions
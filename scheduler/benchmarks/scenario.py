@@ -0,0 +1,178 @@
+"""
+Load test of the web service: concurrent clients browsing coaches'
+calendars, booking appointments and cancelling them again, reporting
+p50/p95/p99 latency and requests per second for each endpoint.
+
+Start the app first (see the readme), then run from the scheduler
+directory:
+
+    python benchmarks/scenario.py --concurrency 16 --duration 30
+
+To run against a fresh data set of a given size, recreate the tables and
+have the runner seed them through populate_db.py:
+
+    psql -f ../scripts/create_tables.sql scheduler
+    python benchmarks/scenario.py --populate --coaches 50 --clients 2000 --weeks 12 --seed 1
+
+As with micro.py, --save keeps the results as a baseline and --compare
+checks a run against one, exiting non-zero on a regression.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from report import summarize, save_results, load_results, compare_results
+
+SCHEDULER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POPULATE_DB = os.path.join(os.path.dirname(SCHEDULER_DIR), 'scripts', 'populate_db.py')
+
+
+def populate(args):
+    command = [sys.executable, POPULATE_DB, '--coaches', str(args.coaches), '--clients', str(args.clients),
+               '--weeks', str(args.weeks), '--seed', str(args.seed)]
+    if args.recurring:
+        command.append('--recurring')
+    print(' '.join(command))
+    subprocess.run(command, check=True)
+
+
+def people():
+    """
+    IDs of the coaches and clients in the database, with each client's coach
+    """
+    with open(os.path.join(SCHEDULER_DIR, 'config.json')) as f:
+        config = json.loads(f.read())
+    conn = psycopg2.connect(config['db_connect'])
+    try:
+        with conn.cursor() as curs:
+            curs.execute("SELECT coach_id, client_id FROM relationship")
+            return curs.fetchall()
+    finally:
+        conn.close()
+
+
+class Scenario:
+    """
+    The requests a simulated client makes, picked at random by weight
+    """
+    def __init__(self, url, relationships, weights, seed):
+        self.url = url.rstrip('/')
+        self.relationships = relationships
+        self.weights = weights
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def request(self, session, name, method, path, **kwargs):
+        t = time.perf_counter()
+        response = session.request(method, self.url + path, **kwargs)
+        ## a booking that lost a race for its slot is a normal outcome
+        self.record(name, time.perf_counter() - t, response.ok or response.status_code == 409)
+        return response
+
+    def coaches(self, session, rng):
+        self.request(session, 'GET /coaches/', 'GET', '/coaches/')
+
+    def calendar(self, session, rng):
+        coach_id, client_id = rng.choice(self.relationships)
+        week = date.today() + timedelta(weeks=rng.randrange(4))
+        self.request(session, 'GET /calendar/', 'GET', '/calendar/%d/%d/' % (client_id, coach_id),
+                     params={'from': week.isoformat(), 'to': (week + timedelta(weeks=1)).isoformat()})
+
+    def book(self, session, rng):
+        coach_id, client_id = rng.choice(self.relationships)
+        start = datetime.combine(date.today(), datetime.min.time()) + \
+            timedelta(days=rng.randrange(1, 28), hours=rng.randrange(8, 17))
+        response = self.request(session, 'POST /event/', 'POST', '/event/',
+                                json={'start_time': start.isoformat(),
+                                      'end_time': (start + timedelta(hours=1)).isoformat(),
+                                      'name': 'Load test', 'type': 'coaching',
+                                      'participants': [coach_id, client_id]})
+        if response.ok:
+            self.request(session, 'DELETE /event/', 'DELETE', '/event/%d/' % response.json()['id'])
+
+    def run(self, concurrency, duration):
+        actions = [getattr(self, name) for name in self.weights]
+        weights = list(self.weights.values())
+        deadline = time.perf_counter() + duration
+
+        def client(i):
+            rng = random.Random(self.seed + i)
+            with requests.Session() as session:
+                while time.perf_counter() < deadline:
+                    rng.choices(actions, weights)[0](session, rng)
+
+        workers = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        t = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - t
+
+        results = {name: summarize(latencies, elapsed, self.errors.get(name, 0))
+                   for name, latencies in self.latencies.items()}
+        results['all'] = summarize([l for latencies in self.latencies.values() for l in latencies],
+                                   elapsed, sum(self.errors.values()))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="where the app is running")
+    parser.add_argument('--concurrency', type=int, default=8, help="number of simulated clients")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run for")
+    parser.add_argument('--mix', default='calendar=70,coaches=10,book=20',
+                        help="relative weights of calendar views, coach list fetches and bookings")
+    parser.add_argument('--populate', action='store_true', help="seed the database with populate_db.py first")
+    parser.add_argument('--coaches', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=89)
+    parser.add_argument('--weeks', type=int, default=26)
+    parser.add_argument('--recurring', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='PATH', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare the results against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="fraction by which a metric may get worse before it counts as a regression")
+    args = parser.parse_args()
+
+    if args.populate:
+        populate(args)
+    weights = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    scenario = Scenario(args.url, people(), weights, args.seed)
+    results = scenario.run(args.concurrency, args.duration)
+
+    print("%-18s %8s %7s %9s %9s %9s %9s" % ('', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name in sorted(results):
+        r = results[name]
+        print("%-18s %8d %7d %9.1f %9.2f %9.2f %9.2f" % (
+            name, r['count'], r['errors'], r['rps'], r['p50_s']*1000, r['p95_s']*1000, r['p99_s']*1000))
+
+    if args.save:
+        save_results(args.save, results, params=vars(args))
+    if args.compare:
+        regressions = compare_results(results, load_results(args.compare)['results'], args.threshold)
+        if regressions:
+            print("worse than baseline: %s" % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+In-process cache of coaches' appointment availability
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from events import as_datetime
+
+
+class AvailabilityCache:
+    """
+    Cache the appointment blocks computed for a person over a time window,
+    keyed by (person_id, start_time, end_time).
+
+    Entries expire ttl seconds after they are stored, and the least recently
+    used entries are evicted to keep the total number of cached blocks under
+    max_blocks. Writes to a person's calendar must call invalidate() with the
+    time range they touched, which drops that person's entries whose blocks
+    could have changed.
+
+    The cache is safe to share between threads. It only sees writes made
+    through this process, so deployments running several worker processes
+    should keep the ttl short.
+    """
+
+    def __init__(self, max_blocks=100000, ttl=300.0, clock=time.monotonic):
+        """
+        :param max_blocks: upper bound on the number of blocks held, counting empty entries as one
+        :param ttl: seconds an entry stays fresh
+        :param clock: function returning the current time in seconds
+        """
+        self.max_blocks = max_blocks
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()        # key -> (blocks, lo, hi, expires_at), oldest first
+        self._by_person = defaultdict(set)   # person_id -> keys
+        self._versions = defaultdict(int)    # person_id -> number of invalidations
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+        self._listeners = []
+
+    @staticmethod
+    def _cost(blocks):
+        return max(len(blocks), 1)
+
+    def _remove(self, key):
+        blocks = self._entries.pop(key)[0]
+        self._size -= self._cost(blocks)
+        keys = self._by_person[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._by_person[key[0]]
+
+    def _fresh(self, key):
+        """
+        The entry for a key, dropping it if it has expired
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] <= self.clock():
+            self._remove(key)
+            self._expirations += 1
+            entry = None
+        return entry
+
+    def get(self, person_id, start_time, end_time):
+        """
+        Return the cached blocks for a window or None. Failing an entry for
+        exactly the window, one for a window containing it will do, such as
+        those the prewarm.Prewarmer fills, and its blocks overlapping the
+        window are returned.
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        key = (person_id, start_time, end_time)
+        with self._lock:
+            entry = self._fresh(key)
+            blocks = None if entry is None else entry[0]
+            if entry is None:
+                for other in list(self._by_person.get(person_id, ())):
+                    if other[1] <= start_time and end_time <= other[2]:
+                        entry = self._fresh(other)
+                        if entry is not None:
+                            key = other
+                            blocks = [block for block in entry[0]
+                                      if block.start_time < end_time and start_time < block.end_time]
+                            break
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return list(blocks)
+
+    def expires_in(self, person_id, start_time, end_time):
+        """
+        Seconds until the entry for a window expires, or None if there is
+        none. Doesn't count as a hit or miss or make the entry recently used.
+        """
+        key = (person_id, as_datetime(start_time), as_datetime(end_time))
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[3] - self.clock()
+
+    def version(self, person_id):
+        """
+        A counter that changes whenever the person's entries are invalidated.
+        Pass it to put() to avoid storing blocks computed from stale data.
+        """
+        with self._lock:
+            return self._versions[person_id]
+
+    def put(self, person_id, start_time, end_time, blocks, version=None):
+        """
+        Store the blocks computed for a window. If version is given and the
+        person has been invalidated since it was read, the blocks are dropped.
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        key = (person_id, start_time, end_time)
+        blocks = list(blocks)
+        cost = self._cost(blocks)
+        if cost > self.max_blocks:
+            return
+
+        ## blocks can extend outside the window, so remember the span they
+        ## cover for matching invalidations against
+        lo = min([start_time] + [block.start_time for block in blocks])
+        hi = max([end_time] + [block.end_time for block in blocks])
+
+        with self._lock:
+            if version is not None and version != self._versions[person_id]:
+                return
+            if key in self._entries:
+                self._remove(key)
+            while self._size + cost > self.max_blocks:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+            self._entries[key] = (blocks, lo, hi, self.clock() + self.ttl)
+            self._by_person[person_id].add(key)
+            self._size += cost
+
+    def get_or_compute(self, person_id, start_time, end_time, compute):
+        """
+        Return the cached blocks for a window, calling compute() to fill the
+        cache on a miss.
+        """
+        blocks = self.get(person_id, start_time, end_time)
+        if blocks is None:
+            version = self.version(person_id)
+            blocks = compute()
+            self.put(person_id, start_time, end_time, blocks, version=version)
+        return blocks
+
+    def invalidate(self, person_id, start_time=None, end_time=None):
+        """
+        Drop the person's entries whose blocks overlap the given time range,
+        or all of the person's entries if no range is given.
+        """
+        if start_time is not None:
+            start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        with self._lock:
+            self._versions[person_id] += 1
+            for key in list(self._by_person.get(person_id, ())):
+                _, lo, hi, _ = self._entries[key]
+                if start_time is None or (start_time <= hi and end_time >= lo):
+                    self._remove(key)
+                    self._invalidations += 1
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(person_id, start_time, end_time)
+
+    def add_listener(self, listener):
+        """
+        Have listener(person_id, start_time, end_time) called after each
+        invalidation, with start_time and end_time None if the whole person
+        was invalidated. It's called on the invalidating thread, so should
+        return quickly.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def invalidate_event(self, event):
+        """
+        Invalidate entries for every participant of an event over its time range
+        """
+        for person_id in event.participants:
+            self.invalidate(person_id, event.start_time, event.end_time)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_person.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Return a dict of hit, miss and eviction counters and current size
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'blocks': self._size,
+                'max_blocks': self.max_blocks,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
@@ -1,10 +1,19 @@
 """
 Represent and manipulate calendar events
 """
+import heapq
 import psycopg2
-from psycopg2.extras import DictCursor
+from bisect import bisect_left
+from itertools import accumulate, count, islice
+from operator import attrgetter
+from psycopg2.extras import DictCursor, execute_values
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta, SU, MO, TU, WE, TH, FR, SA
+from dateutil.parser import parse
+from dateutil.tz import UTC
+from recurrence import AvailabilityRule, expand_rules
+from instrumentation import span
+from prepared import PreparedStatements
 
 
 class Event:
@@ -14,9 +23,13 @@ class Event:
     Type should be one of a limited set of event type strings. The type
     'schedulable' signifies a block of time during which a coach is
     available for appointments.
+
+    Calendars can hold many thousands of events, so attributes are kept in
+    slots rather than a per-instance __dict__.
     """
+    __slots__ = ('id', 'start_time', 'end_time', 'name', 'type', 'notes', 'participants')
 
-    def __init__(self, start_time, end_time, type, id=None, name=None, notes=None, participants=[]):
+    def __init__(self, start_time, end_time, type, id=None, name=None, notes=None, participants=None):
         """
         :param start_time: a datetime
         :param end_time: a datetime
@@ -32,7 +45,7 @@ class Event:
         self.name = name
         self.type = type
         self.notes = notes
-        self.participants = participants
+        self.participants = [] if participants is None else participants
 
     def __repr__(self):
         return "Event(start_time="+str(self.start_time)+\
@@ -44,7 +57,32 @@ class Event:
                     (", participants="+str(self.participants) if self.participants else '')+")"
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Event):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in Event.__slots__)
+
+    def as_dict(self):
+        """
+        Return the event's attributes as a dict, suitable for passing as
+        keyword arguments to PostgresDataStore.update_event
+        """
+        return {attr: getattr(self, attr) for attr in Event.__slots__}
+
+
+def as_datetime(value):
+    """
+    Coerce a date, datetime or ISO 8601 string into a naive datetime in UTC,
+    the form in which times are stored in the database
+    """
+    if isinstance(value, str):
+        value = parse(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(UTC).replace(tzinfo=None)
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    return value
 
 
 def divide_into_blocks(event, block_len=timedelta(hours=1)):
@@ -69,25 +107,55 @@ def divide_into_blocks(event, block_len=timedelta(hours=1)):
         et = st + block_len
 
 
+class ConflictIndex:
+    """
+    Index a list of events for fast conflict detection.
+
+    Two events conflict if they overlap, that is if each starts strictly
+    before the other ends. Schedulable events never cause a conflict.
+
+    Busy events are sorted by start time alongside a running maximum of
+    their end times. The busy events that start before a query event ends
+    form a prefix of that order, found by bisection, and the query conflicts
+    if the latest end time in that prefix is after the query's start. Each
+    query is O(log n) after an O(n log n) build.
+    """
+
+    def __init__(self, events):
+        busy = sorted((event.start_time, event.end_time) for event in events
+                      if event.type != 'schedulable')
+        self.starts = [start_time for start_time, _ in busy]
+        self.max_ends = list(accumulate((end_time for _, end_time in busy), max))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def conflicts(self, event):
+        """
+        True if any indexed busy event overlaps the given event
+        """
+        i = bisect_left(self.starts, event.end_time)
+        return i > 0 and self.max_ends[i-1] > event.start_time
+
+
 def has_conflicts(event, events):
     """
     Detect the precence of conflicting events
 
     :param event: an event
-    :param events: a list of events that potentially conflict with the first event
+    :param events: a list of events that potentially conflict with the first event,
+                   or a ConflictIndex built from them
     """
-    for other_event in events:
-        if other_event.type != 'schedulable' and \
-           other_event.start_time < event.end_time and \
-           other_event.end_time > event.start_time:
-            return True
-    return False
+    if not isinstance(events, ConflictIndex):
+        events = ConflictIndex(events)
+    return events.conflicts(event)
 
 def remove_conflicting(events, potential_conflicts):
     """
     Purge a list of events of those which have a conflict.
     """
-    return [event for event in events if not has_conflicts(event, potential_conflicts)]
+    index = ConflictIndex(potential_conflicts)
+    return [event for event in events if not index.conflicts(event)]
 
 def appointments(events):
     """
@@ -96,92 +164,920 @@ def appointments(events):
     """
     blocks = [block for event in events if event.type=='schedulable'
                     for block in divide_into_blocks(event)]
+    index = ConflictIndex(events)
     for block in blocks:
-        if has_conflicts(block, events):
+        if index.conflicts(block):
             block.name = 'Booked'
             block.type = 'unavailable slot'
     return blocks
 
 
+def stream_appointments(events, block_len=timedelta(hours=1)):
+    """
+    Like appointments(), but for events sorted by start time, yielding the
+    blocks in start time order as the events are read. Only the busy events
+    that could still overlap a pending block are kept, so a long calendar
+    can be streamed without holding it all in memory.
+
+    A block can be labeled once an event starting at or after its end has
+    been read, as no later event can overlap it.
+
+    :param events: events sorted by start time, e.g. straight from a DB cursor
+    :param block_len: length of the blocks schedulable periods are divided into
+    :return: a generator of Event objects
+    """
+    pending = []    ## heap of (start_time, seq, block) not yet labeled
+    busy = []       ## (start_time, end_time) of busy events that may still overlap a block
+    seq = count()
+
+    def label(block):
+        for s, e in busy:
+            if s < block.end_time and e > block.start_time:
+                block.name = 'Booked'
+                block.type = 'unavailable slot'
+                break
+        return block
+
+    for event in events:
+        while pending and pending[0][2].end_time <= event.start_time:
+            yield label(heapq.heappop(pending)[2])
+        if event.type == 'schedulable':
+            for block in divide_into_blocks(event, block_len):
+                heapq.heappush(pending, (block.start_time, next(seq), block))
+        else:
+            busy.append((event.start_time, event.end_time))
+        ## later blocks start no earlier than this, so busy events ending by then are done with
+        horizon = min(pending[0][0], event.start_time) if pending else event.start_time
+        busy = [(s, e) for s, e in busy if e > horizon]
+    while pending:
+        yield label(heapq.heappop(pending)[2])
+
+
+def merge_ranges(ranges):
+    """
+    Merge (start, end) ranges that overlap or touch
+
+    :return: a list of disjoint ranges in order
+    """
+    merged = []
+    for s, e in sorted(ranges):
+        if merged and s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
+
+
+def earliest_open_slots(calendars, start_time, end_time, limit=None, busy=()):
+    """
+    Find the earliest open appointment slots across many coaches at once,
+    merging each coach's slots in time order and stopping after limit.
+
+    :param calendars: a dict mapping coach IDs to the events on their calendars
+    :param start_time: only slots starting at or after this time are returned
+    :param end_time: only slots starting before this time are returned
+    :param limit: the maximum number of slots to return, or None for all of them
+    :param busy: events on the client's calendar, slots conflicting with them are left out
+    :return: a list of open slot events, earliest first, with the coach as participant
+    """
+    start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+    index = ConflictIndex(busy)
+
+    def open_slots(coach_id, events):
+        for block in sorted(appointments(events), key=attrgetter('start_time')):
+            if block.type == 'open slot' and start_time <= block.start_time < end_time \
+               and not index.conflicts(block):
+                block.participants = [coach_id]
+                yield block
+
+    merged = heapq.merge(*[open_slots(coach_id, calendars[coach_id]) for coach_id in sorted(calendars)],
+                         key=attrgetter('start_time'))
+    return list(islice(merged, limit))
+
+
+def availability_events(rules, start_time, end_time):
+    """
+    Lazily expand availability rules into schedulable events overlapping
+    a window, in start time order
+
+    :param rules: recurrence.AvailabilityRule objects
+    :return: a generator of Event objects
+    """
+    for s, e, person_id in expand_rules(rules, as_datetime(start_time), as_datetime(end_time)):
+        yield Event(start_time=s, end_time=e, type='schedulable', participants=[person_id])
+
+
+def daily_slot_counts(events, start_time, end_time):
+    """
+    Count a coach's open and booked appointment slots per day, in UTC, by
+    the day each slot starts on
+
+    :param events: the coach's events overlapping the window, including
+                   schedulable time expanded from availability rules
+    :return: a dict from date to a tuple of open and booked slot counts,
+             for days between start_time and end_time that have any slots
+    """
+    counts = {}
+    for block in appointments(events):
+        if start_time <= block.start_time < end_time:
+            day = block.start_time.date()
+            open_slots, booked_slots = counts.get(day, (0, 0))
+            if block.type == 'open slot':
+                counts[day] = (open_slots + 1, booked_slots)
+            else:
+                counts[day] = (open_slots, booked_slots + 1)
+    return counts
+
+
+def affected_days(event, block_len=timedelta(hours=1)):
+    """
+    The days whose slot counts an event can change: those of any block it
+    overlaps, which starts at most a block before it
+
+    :return: the first day and the day after the last
+    """
+    return (as_datetime(event.start_time) - block_len).date(), as_datetime(event.end_time).date() + timedelta(days=1)
+
+
+def rule_days(rule, today=None):
+    """
+    The days whose slot counts an availability rule can change: those
+    around its first and last occurrences, from the day before it starts up
+    to ROLLUP_HORIZON ahead of today
+
+    :return: the first day and the day after the last, or None if it has
+             no occurrences then
+    """
+    first_day = as_datetime(rule.dtstart).date() - timedelta(days=1)
+    end_day = max(first_day, today or date.today()) + ROLLUP_HORIZON
+    first = last = None
+    for occurrence in rule.occurrences(datetime.combine(first_day, datetime.min.time()),
+                                       datetime.combine(end_day, datetime.min.time())):
+        first = first or occurrence
+        last = occurrence
+    if first is None:
+        return None
+    return (affected_days(Event(start_time=first[0], end_time=first[1], type='schedulable'))[0],
+            min(end_day, affected_days(Event(start_time=last[0], end_time=last[1], type='schedulable'))[1]))
+
+
+## how far ahead the utilization rollup is kept up to date after a change
+## to a coach's availability rules, which may recur indefinitely
+ROLLUP_HORIZON = timedelta(days=366)
+
+## how many days of the rollup are recomputed per transaction after a
+## change to a rule, so the coach isn't locked for the whole horizon
+ROLLUP_CHUNK = timedelta(days=31)
+
+ROLLUP_PERIODS = ('day', 'week', 'month')
+
+
 class NonExistantIdError(ValueError):
     pass
 
 
+class BookingConflictError(ValueError):
+    """
+    Raised when booking a time one of the participants already has taken
+    """
+    def __init__(self, message, conflicts=()):
+        super().__init__(message)
+        self.conflicts = list(conflicts)
+
+
+## types of event that take up the participants' time exclusively
+BOOKING_TYPES = ('coaching',)
+
+
+def batch_conflicts(events):
+    """
+    The clashes among a batch of events to be created together that
+    check_booking would find if they were created one at a time: each
+    booking with the other events of the batch, other than schedulable
+    ones, that share a participant with it and overlap it.
+
+    Each person's events are swept in start time order, keeping those not
+    yet ended, so the cost is O(n log n) plus the number of overlaps.
+
+    :param events: a list of events
+    :return: a list of (booking, list of clashing events), in the order given
+    """
+    times = [(as_datetime(event.start_time), as_datetime(event.end_time)) for event in events]
+    by_person = {}
+    for i, event in enumerate(events):
+        if event.type != 'schedulable':
+            for person_id in set(event.participants):
+                by_person.setdefault(person_id, []).append(i)
+    clashes = {}
+    for indices in by_person.values():
+        indices.sort(key=lambda i: times[i][0])
+        active = []
+        for i in indices:
+            start_time, end_time = times[i]
+            active = [j for j in active if times[j][1] > start_time]
+            for j in active:
+                if times[j][0] < end_time:
+                    if events[i].type in BOOKING_TYPES:
+                        clashes.setdefault(i, set()).add(j)
+                    if events[j].type in BOOKING_TYPES:
+                        clashes.setdefault(j, set()).add(i)
+            active.append(i)
+    return [(events[i], [events[j] for j in sorted(clashes[i])]) for i in sorted(clashes)]
+
+## the longest an event may last, enforced by the event_span_check
+## constraint. Events overlapping a window then start at most this long
+## before it, which bounds their start_time, the key event and participant
+## are partitioned by month on.
+MAX_EVENT_SPAN = timedelta(days=31)
+
+
+def window_args(start_time, end_time, **args):
+    """
+    Named arguments for a query of the events overlapping a time window,
+    including the max_span that lets it bound the events' start times so
+    Postgres can skip partitions that can't hold any
+    """
+    return dict(args, start_time=start_time, end_time=end_time, max_span=MAX_EVENT_SPAN)
+
+## events overlapping a time range that any of a set of people take part in,
+## other than the time they're available and the event being changed
+OVERLAPPING_EVENTS_QUERY = """\
+    SELECT DISTINCT e.id
+    FROM event e
+    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+    WHERE p.person_id = ANY(%(participants)s)
+    AND e.type IS DISTINCT FROM 'schedulable'
+    AND e.id IS DISTINCT FROM %(event_id)s
+    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+    ORDER BY e.id;"""
+
+## FOR NO KEY UPDATE rather than FOR UPDATE: inserting a participant takes a
+## KEY SHARE lock on the person row it refers to, which FOR UPDATE waits on,
+## so two transactions adding the same person to events and then locking
+## them would deadlock. NO KEY UPDATE doesn't conflict with KEY SHARE but
+## still makes writers to the same people take turns.
+LOCK_PEOPLE_QUERY = "SELECT id FROM person WHERE id = ANY(%(person_ids)s) ORDER BY id FOR NO KEY UPDATE"
+
+
+def check_booking(curs, event, also_lock=()):
+    """
+    Make sure a booking doesn't clash with anything its participants have
+    on, raising BookingConflictError if it does. Does nothing for events
+    that aren't of one of the BOOKING_TYPES.
+
+    The participants' person rows are locked, in ID order so concurrent
+    bookings can't deadlock, for the rest of the transaction. A concurrent
+    booking for any of the same people waits for this transaction to
+    finish before its own check, so two can't both take the same time.
+
+    :param also_lock: the IDs of anyone else the write touches, such as
+                      the people an update takes off the event, to lock in
+                      the same statement. Locking them afterwards could
+                      take the locks out of ID order.
+    """
+    if event.type not in BOOKING_TYPES or not event.participants:
+        return
+    participants = sorted(set(event.participants))
+    PREPARED.execute(curs, 'lock_people', {'person_ids': sorted(set(participants) | set(also_lock))})
+    PREPARED.execute(curs, 'overlapping_events', window_args(as_datetime(event.start_time), as_datetime(event.end_time),
+                                                             participants=participants, event_id=event.id))
+    conflicts = [row[0] for row in curs]
+    if conflicts:
+        raise BookingConflictError("%s to %s is already booked" % (event.start_time, event.end_time), conflicts)
+
+
+def check_bookings(curs, events):
+    """
+    check_booking for a batch of events to be created together, which
+    have their IDs already. The bookings among them are checked against
+    the rest of the batch and against what's in the database, after
+    locking the participants of every event in the batch in ID order.
+    """
+    bookings = [event for event in events if event.type in BOOKING_TYPES and event.participants]
+    if not bookings:
+        return
+    PREPARED.execute(curs, 'lock_people', {'person_ids': sorted({person_id for event in events
+                                                                 for person_id in event.participants})})
+    clashes = batch_conflicts(events)
+    if clashes:
+        event, clashing = clashes[0]
+        raise BookingConflictError("%s to %s clashes with another event of the batch" %
+                                   (event.start_time, event.end_time), [other.id for other in clashing])
+    for event in bookings:
+        PREPARED.execute(curs, 'overlapping_events',
+                         window_args(as_datetime(event.start_time), as_datetime(event.end_time),
+                                     participants=sorted(set(event.participants)), event_id=event.id))
+        conflicts = [row[0] for row in curs]
+        if conflicts:
+            raise BookingConflictError("%s to %s is already booked" % (event.start_time, event.end_time), conflicts)
+
+
+## bounding start_time limits the lookup to the partitions the events are in
+PARTICIPANTS_QUERY = """\
+    SELECT event_id, person_id FROM participant
+    WHERE event_id = ANY(%(event_ids)s)
+    AND start_time BETWEEN %(first_start_time)s AND %(last_start_time)s"""
+
+## an event by ID, found through event_start, which maps IDs to the start
+## times event is partitioned on, so only the event's partition is read
+FETCH_EVENT_QUERY = """\
+    SELECT e.id, e.type, e.start_time, e.end_time, e.name, e.notes
+    FROM event_start s
+    JOIN event e ON e.id=s.id AND e.start_time=s.start_time
+    WHERE s.id=%(id)s"""
+
+## locks an event against other writes by its event_start row, which stays
+## put when a change of start time moves the event to another partition
+LOCK_EVENT_QUERY = "SELECT start_time FROM event_start WHERE id=%(id)s FOR UPDATE"
+
+
+def load_participants(curs, events):
+    """
+    Fill in the participants of a list of events using one batched query
+    rather than one query per event.
+
+    :param curs: an open cursor
+    :param events: a list of Event objects that have IDs
+    :return: the same list of events
+    """
+    by_id = {}
+    for event in events:
+        event.participants = []
+        by_id[event.id] = event
+    if by_id:
+        PREPARED.execute(curs, 'participants', {'event_ids': list(by_id),
+                                                'first_start_time': min(event.start_time for event in events),
+                                                'last_start_time': max(event.start_time for event in events)})
+        for row in curs:
+            by_id[row['event_id']].participants.append(row['person_id'])
+    return events
+
+
+def fetch_event(curs, id, lock=False):
+    """
+    Read an event and its participants or raise NonExistantIdError
+
+    :param lock: lock the event for the rest of the transaction first, as
+                 a write that goes on to change it must. A concurrent write
+                 to the event is waited for, and what it left is read.
+    """
+    if lock:
+        PREPARED.execute(curs, 'lock_event', {'id': id})
+        if curs.rowcount < 1:
+            raise NonExistantIdError("no event exists with id %s" % id)
+    PREPARED.execute(curs, 'fetch_event', {'id': id})
+    if curs.rowcount < 1:
+        raise NonExistantIdError("no event exists with id %s" % id)
+    return load_participants(curs, [Event(**curs.fetchone())])[0]
+
+
 class PostgresCursor:
     """
     A context manager for Postgres cursors
+
+    The transaction is committed on a clean exit and rolled back if an
+    exception escapes. If a pool is given, the connection is borrowed from
+    it and handed back afterwards rather than opened and closed, even if
+    the commit fails, and a connection that broke is closed rather than
+    pooled again. If
+    prepared statements are given, they're prepared on the connection
+    unless they already are. If a replicas.ReplicaRouter is given, the
+    connection comes from a replica when the router allows, for reads
+    about the given people.
     """
-    def __init__(self, connect_string):
+    def __init__(self, connect_string, pool=None, cursor_factory=DictCursor, prepared=None,
+                 replicas=None, person_ids=()):
         self.connect_string = connect_string
+        self.pool = pool
+        self.cursor_factory = cursor_factory
+        self.prepared = prepared
+        self.replicas = replicas
+        self.person_ids = person_ids
+        self.conn = None
+        self.conn_pool = None
+        self.cursor = None
 
     def __enter__(self):
-        self.conn = psycopg2.connect(self.connect_string, cursor_factory=DictCursor)
-        self.cursor = self.conn.cursor()
+        with span('connect'):
+            if self.replicas is not None:
+                self.conn_pool, self.conn = self.replicas.getconn(self.person_ids)
+            if self.conn is None and self.pool:
+                self.conn_pool = self.pool
+                self.conn = self.pool.getconn()
+            elif self.conn is None:
+                self.conn = psycopg2.connect(self.connect_string)
+            if self.prepared is not None:
+                try:
+                    self.prepared.prepare(self.conn)
+                except psycopg2.Error:
+                    ## the statements then run as plain queries
+                    self.conn.rollback()
+        self.cursor = self.conn.cursor(cursor_factory=self.cursor_factory)
         return self.cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is None:
-            if self.conn:
-                self.conn.commit()
-        else:
+        broken = exc_type is not None and issubclass(exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        try:
+            try:
+                if self.conn:
+                    if exc_type is None:
+                        self.conn.commit()
+                    else:
+                        self.conn.rollback()
+            finally:
+                if self.cursor:
+                    self.cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
             if self.conn:
-                self.conn.rollback()
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
+                if self.conn_pool:
+                    self.conn_pool.putconn(self.conn, close=broken)
+                else:
+                    self.conn.close()
         return False
 
 
+## A person's events overlapping a time window, taking window_args. The &&
+## test on time_range can use the event_time_range_idx GiST index and the
+## person_id test the participant_person_idx index, and the bounds on
+## start_time prune the monthly partitions, see scripts/check_query_plans.py
+EVENTS_BETWEEN_QUERY = """\
+    SELECT e.id, e.type, e.start_time, e.end_time, e.name, e.notes
+    FROM event e
+    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+    WHERE p.person_id=%(person_id)s
+    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+    ORDER BY e.start_time;"""
+
+INSERT_EVENT_QUERY = """\
+    INSERT INTO event
+    (start_time, end_time, name, notes, type)
+    VALUES
+    (%(start_time)s, %(end_time)s, %(name)s, %(notes)s, %(type)s)
+    RETURNING id, start_time;"""
+
+## a new start_time cascades to the participants, moving both to another
+## partition if it's in another month
+UPDATE_EVENT_QUERY = """\
+    UPDATE event
+    SET (start_time, end_time, name, notes, type) = (%(start_time)s, %(end_time)s, %(name)s, %(notes)s, %(type)s)
+    WHERE id=%(id)s AND start_time=%(old_start_time)s
+    RETURNING start_time"""
+
+DELETE_EVENT_QUERY = "DELETE FROM event WHERE id=%(id)s AND start_time=%(start_time)s"
+
+INSERT_PARTICIPANT_QUERY = """\
+    INSERT INTO participant (event_id, person_id, start_time)
+    VALUES (%(event_id)s, %(person_id)s, %(start_time)s);"""
+
+DELETE_PARTICIPANT_QUERY = """\
+    DELETE FROM participant
+    WHERE event_id=%(event_id)s AND person_id=%(person_id)s AND start_time=%(start_time)s;"""
+
+## bump people's change versions, see PostgresDataStore._touch, locking the
+## rows as LOCK_PEOPLE_QUERY does
+TOUCH_QUERY = """\
+    UPDATE person SET version = version + 1
+    WHERE id IN (SELECT id FROM person WHERE id = ANY(%(person_ids)s) ORDER BY id FOR NO KEY UPDATE)
+    RETURNING id, coach;"""
+
+## the statements behind nearly every request, which PostgresDataStore
+## prepares on its pooled connections if asked to
+PREPARED = PreparedStatements({
+    'events_between': EVENTS_BETWEEN_QUERY,
+    'overlapping_events': OVERLAPPING_EVENTS_QUERY,
+    'lock_people': LOCK_PEOPLE_QUERY,
+    'participants': PARTICIPANTS_QUERY,
+    'fetch_event': FETCH_EVENT_QUERY,
+    'lock_event': LOCK_EVENT_QUERY,
+    'insert_event': INSERT_EVENT_QUERY,
+    'update_event': UPDATE_EVENT_QUERY,
+    'delete_event': DELETE_EVENT_QUERY,
+    'insert_participant': INSERT_PARTICIPANT_QUERY,
+    'delete_participant': DELETE_PARTICIPANT_QUERY,
+    'touch': TOUCH_QUERY,
+})
+
+## the rest of the queries the sync and async data stores have in common
+AVAILABILITY_RULES_QUERY = """\
+    SELECT id, person_id, dtstart, duration, rrule, tzid, exdates
+    FROM availability_rule
+    WHERE person_id=%(person_id)s
+    ORDER BY id;"""
+
+COACHES_QUERY = """\
+    SELECT *
+    FROM person p
+    WHERE p.coach;"""
+
+VERSIONS_QUERY = "SELECT id, version FROM person WHERE id = ANY(%(person_ids)s)"
+
+EVENT_PEOPLE_QUERY = """\
+    SELECT person.*
+    FROM person
+    JOIN participant on person.id=participant.person_id
+    WHERE participant.event_id=%(event_id)s"""
+
+## every coach's events overlapping a time window, taking window_args
+COACH_EVENTS_QUERY = """\
+    SELECT p.person_id AS coach_id, e.id, e.type, e.start_time, e.end_time, e.name, e.notes
+    FROM event e
+    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+    JOIN person c on c.id=p.person_id
+    WHERE c.coach
+    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+    ORDER BY p.person_id, e.start_time;"""
+
+COACH_RULES_QUERY = """\
+    SELECT r.id, r.person_id, r.dtstart, r.duration, r.rrule, r.tzid, r.exdates
+    FROM availability_rule r
+    JOIN person c on c.id=r.person_id
+    WHERE c.coach
+    ORDER BY r.person_id, r.id;"""
+
+DELETE_ROLLUP_QUERY = """\
+    DELETE FROM coach_daily_rollup
+    WHERE person_id=%(person_id)s AND day >= %(first_day)s AND day < %(end_day)s"""
+
+## a sync token is the oldest transaction still running, as every change
+## logged by a transaction older than that is visible
+SYNC_STATE_QUERY = """\
+    SELECT t.token, p.id, p.version
+    FROM (SELECT txid_snapshot_xmin(txid_current_snapshot()) AS token) t
+    LEFT JOIN person p ON p.id = ANY(%(person_ids)s);"""
+
+## the changes logged for some people since a sync token
+CHANGES_QUERY = """\
+    SELECT person_id, event_id, op, start_time, end_time
+    FROM event_change
+    WHERE person_id = ANY(%(person_ids)s)
+    AND xid >= %(token)s;"""
+
+## those of a person's events overlapping a time window that are among
+## changed_ids, taking window_args
+CHANGED_EVENTS_QUERY = """\
+    SELECT e.id, e.type, e.start_time, e.end_time, e.name, e.notes
+    FROM event e
+    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+    WHERE p.person_id=%(person_id)s
+    AND e.id = ANY(%(changed_ids)s)
+    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+    ORDER BY e.start_time;"""
+
+UTILIZATION_QUERY = """\
+    SELECT person_id AS coach_id, date_trunc(%(period)s, day)::date AS period,
+           sum(open_slots)::integer AS open_slots, sum(booked_slots)::integer AS booked_slots
+    FROM coach_daily_rollup
+    WHERE day >= %(first_day)s AND day < %(end_day)s
+    AND (%(coach_id)s::integer IS NULL OR person_id = %(coach_id)s)
+    GROUP BY 1, 2
+    ORDER BY 1, 2;"""
+
+
+def summarize_changes(changes, person_id, start_time, end_time):
+    """
+    What a list of logged changes to a client's and a coach's calendars
+    means for the client's view of a window, see PostgresDataStore.get_changes
+
+    :param changes: rows of CHANGES_QUERY
+    :return: the IDs of the client's events that changed, and the merged
+             ranges of the window in which the coach's slots may have
+    """
+    changed_ids = sorted({change['event_id'] for change in changes if change['person_id'] == person_id})
+    ranges = merge_ranges((max(change['start_time'], start_time), min(change['end_time'], end_time))
+                          for change in changes
+                          if change['start_time'] < end_time and change['end_time'] > start_time)
+    return changed_ids, ranges
+
+
 class PostgresDataStore:
     """
     Layer that represents our data store
+
+    Pass a pool.ConnectionPool to reuse connections across calls instead of
+    connecting for each one. Rows are read through cursor_factory, which
+    must return dict-like rows.
+
+    slot_engine selects where get_calendar computes appointment slots:
+    'python' fetches the raw events and expands them with appointments(),
+    'numpy' does the same with the array based vectorized.appointments(),
+    'sql' has Postgres expand and label the slots itself.
+
+    If an availability_cache (cache.AvailabilityCache) is given, the Python
+    engine's appointment blocks are cached and the write methods invalidate
+    them for every participant and time range they touch.
+
+    With prepared_statements, the queries in PREPARED are prepared once on
+    each pooled connection and then run by name, saving Postgres parsing
+    and planning them on every call. Call PREPARED.invalidate() after a
+    schema change. Without a pool, connections don't live long enough for
+    this to pay off, so it's ignored.
+
+    With replicas (replicas.ReplicaRouter), reads go to read replicas,
+    except for people written in the last few seconds, and writes to the
+    primary. Wrap series of reads that must agree, such as a sync token
+    and the calendar it goes with, in replicas.begin() and end().
     """
-    def __init__(self, connect_string):
+    def __init__(self, connect_string, pool=None, cursor_factory=DictCursor, slot_engine='python',
+                 availability_cache=None, prepared_statements=False, replicas=None):
+        if slot_engine not in ('python', 'numpy', 'sql'):
+            raise ValueError("unknown slot engine %r" % slot_engine)
+        self._appointments = appointments
+        if slot_engine == 'numpy':
+            ## NumPy is only needed for this engine
+            import vectorized
+            self._appointments = vectorized.appointments
         self.connect_string = connect_string
+        self.pool = pool
+        self.cursor_factory = cursor_factory
+        self.slot_engine = slot_engine
+        self.availability_cache = availability_cache
+        self.prepared = PREPARED if prepared_statements and pool is not None else None
+        self.replicas = replicas
+
+    def _cursor(self):
+        return PostgresCursor(self.connect_string, pool=self.pool, cursor_factory=self.cursor_factory,
+                              prepared=self.prepared)
+
+    def _read_cursor(self, *person_ids):
+        """
+        A cursor for reads that can go to a replica, given the people
+        whose calendars they read
+        """
+        return PostgresCursor(self.connect_string, pool=self.pool, cursor_factory=self.cursor_factory,
+                              prepared=self.prepared, replicas=self.replicas, person_ids=person_ids)
+
+    def _changed(self, *events):
+        """
+        Called after a write commits with the events as they were before
+        and after it
+        """
+        if self.replicas is not None:
+            self.replicas.wrote({person_id for event in events for person_id in event.participants})
+        if self.availability_cache is not None:
+            for event in events:
+                self.availability_cache.invalidate_event(event)
+
+    def _record(self, curs, op, *events):
+        """
+        Bookkeeping shared by the event write methods, done within the
+        write's transaction: log the change to each participant's calendar,
+        for get_changes, and bump their change versions
+        """
+        rows = [(person_id, event.id, op, as_datetime(event.start_time), as_datetime(event.end_time))
+                for event in events for person_id in event.participants]
+        if rows:
+            execute_values(curs,
+                           "INSERT INTO event_change (person_id, event_id, op, start_time, end_time) VALUES %s",
+                           rows, page_size=1000)
+        coach_ids = self._touch(curs, (row[0] for row in rows))
+        for coach_id in coach_ids:
+            days = merge_ranges(affected_days(event) for event in events if coach_id in event.participants)
+            for first_day, end_day in days:
+                self._refresh_rollup(curs, coach_id, first_day, end_day)
+
+    def _record_rule(self, curs, rule):
+        """
+        Log a change to an availability rule, which can move any of the
+        person's slots
+
+        :return: the days of the rollup the change can move, for
+                 _rule_changed to recompute once it commits, or None
+        """
+        curs.execute("INSERT INTO event_change (person_id, op) VALUES (%s, 'rule')", (rule.person_id,))
+        if self._touch(curs, [rule.person_id]):
+            return rule_days(rule)
+
+    def _touch(self, curs, person_ids):
+        """
+        Bump the change version of the given people within a write's
+        transaction, so that anything derived from their calendars, such
+        as an ETag, changes when it commits. The people's rows stay locked
+        until then, so writes to the same calendars take turns.
+
+        :return: the IDs of those of the people who are coaches
+        """
+        person_ids = sorted(set(person_ids))
+        if not person_ids:
+            return []
+        PREPARED.execute(curs, 'touch', {'person_ids': person_ids})
+        return sorted(row[0] for row in curs.fetchall() if row[1])
+
+    def _refresh_rollup(self, curs, person_id, first_day, end_day):
+        """
+        Recompute a coach's rows of the utilization rollup from their events
+        and availability rules, for the days from first_day up to but not
+        including end_day
+        """
+        start_time = datetime.combine(first_day, datetime.min.time())
+        end_time = datetime.combine(end_day, datetime.min.time())
+        PREPARED.execute(curs, 'events_between', window_args(start_time, end_time, person_id=person_id))
+        events = [Event(**row) for row in curs]
+        rules = self._availability_rules(curs, person_id)
+        events.extend(availability_events(rules, start_time, end_time))
+        counts = daily_slot_counts(events, start_time, end_time)
+        curs.execute(DELETE_ROLLUP_QUERY, {'person_id': person_id, 'first_day': first_day, 'end_day': end_day})
+        if counts:
+            execute_values(curs,
+                           "INSERT INTO coach_daily_rollup (person_id, day, open_slots, booked_slots) VALUES %s",
+                           [(person_id, day, o, b) for day, (o, b) in sorted(counts.items())], page_size=1000)
+
+    def _rule_changed(self, rule, days=None):
+        """
+        Called after an availability rule is created or deleted with the
+        days _record_rule returned. A year of a rule's slots is too much
+        to recompute while the write holds the coach's lock, so the rollup
+        catches up afterwards a chunk at a time.
+        """
+        if self.replicas is not None:
+            self.replicas.wrote([rule.person_id])
+        if self.availability_cache is not None:
+            self.availability_cache.invalidate(rule.person_id)
+        if days is not None:
+            self._rebuild_coach_rollup(rule.person_id, *days)
+
+    def _rebuild_coach_rollup(self, coach_id, first_day, end_day):
+        """
+        Recompute a coach's rows of the rollup from first_day up to but not
+        including end_day, in transactions of up to ROLLUP_CHUNK days
+        """
+        while first_day < end_day:
+            chunk_end = min(first_day + ROLLUP_CHUNK, end_day)
+            with self._cursor() as curs:
+                ## lock the coach's row, as the write methods do, so a write can't interleave
+                curs.execute(LOCK_PEOPLE_QUERY, {'person_ids': [coach_id]})
+                self._refresh_rollup(curs, coach_id, first_day, chunk_end)
+            first_day = chunk_end
+
+    def _availability_rules(self, curs, person_id):
+        curs.execute(AVAILABILITY_RULES_QUERY, {'person_id': person_id})
+        return [AvailabilityRule(**row) for row in curs]
+
+    def _events_between(self, curs, person_id, start_time, end_time):
+        if end_time < start_time:
+            return []
+        PREPARED.execute(curs, 'events_between', window_args(start_time, end_time, person_id=person_id))
+        return load_participants(curs, [Event(**e) for e in curs])
 
     def get_coaches(self):
         """
         Return a list of dict's each representing a coach
         """
-        with PostgresCursor(self.connect_string) as curs:
-            query = """\
-                SELECT *
-                FROM person p
-                WHERE p.coach;"""
-            curs.execute(query)
+        with self._read_cursor() as curs:
+            curs.execute(COACHES_QUERY)
             return [dict(row) for row in curs]
 
+    def get_versions(self, person_ids):
+        """
+        The change versions of the given people, as a dict from person ID
+        to version. A person's version goes up whenever an event they take
+        part in or one of their availability rules is written.
+        """
+        with self._read_cursor(*person_ids) as curs:
+            curs.execute(VERSIONS_QUERY, {'person_ids': list(person_ids)})
+            return {row['id']: row['version'] for row in curs}
+
+    def get_sync_state(self, person_ids):
+        """
+        A sync token for get_changes along with the change versions of the
+        given people, read in one statement so that they agree
+
+        :return: the token and a dict from person ID to version
+        """
+        with self._read_cursor(*person_ids) as curs:
+            curs.execute(SYNC_STATE_QUERY, {'person_ids': list(person_ids)})
+            rows = curs.fetchall()
+            return rows[0]['token'], {row['id']: row['version'] for row in rows if row['id'] is not None}
+
+    def get_utilization(self, start_time, end_time, period='day', coach_id=None):
+        """
+        Coaches' open and booked appointment slots per day, week or month,
+        read from the rollup the write methods keep up to date, so the cost
+        depends on the number of coaches and days but not of events
+
+        :param period: 'day', 'week' or 'month'
+        :param coach_id: optionally, just this coach
+        :return: a list of dicts with the coach_id, the first day of the
+                 period, the open_slots, booked_slots and utilization, the
+                 fraction of slots that are booked
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError("unknown period %r" % period)
+        with self._read_cursor() as curs:
+            curs.execute(UTILIZATION_QUERY, {'period': period, 'first_day': as_datetime(start_time).date(),
+                                             'end_day': as_datetime(end_time).date(), 'coach_id': coach_id})
+            return [dict(row, utilization=row['booked_slots'] / ((row['open_slots'] + row['booked_slots']) or 1))
+                    for row in curs]
+
+    def rebuild_rollup(self, start_time, end_time, coach_ids=None):
+        """
+        Recompute the utilization rollup for the days from start_time up to
+        but not including end_time from scratch, for example after loading
+        data without going through the write methods
+
+        :param coach_ids: the coaches to recompute, by default all of them
+        """
+        first_day, end_day = as_datetime(start_time).date(), as_datetime(end_time).date()
+        with self._cursor() as curs:
+            if coach_ids is None:
+                curs.execute("SELECT id FROM person WHERE coach ORDER BY id")
+                coach_ids = [row[0] for row in curs.fetchall()]
+        for coach_id in coach_ids:
+            self._rebuild_coach_rollup(coach_id, first_day, end_day)
+
+    def ensure_partitions(self, start_time, end_time):
+        """
+        Create the monthly partitions of event and participant for the
+        months from start_time to end_time that don't have one yet. Events
+        outside them go in the default partitions, where queries still find
+        them but can't prune.
+
+        :return: the names of the event partitions created
+        """
+        with self._cursor() as curs:
+            curs.execute("SELECT ensure_event_partitions(%s::date, %s::date)",
+                         (as_datetime(start_time).date(), as_datetime(end_time).date()))
+            return [row[0] for row in curs.fetchall()]
+
     def get_participants(self, event_id):
-        with PostgresCursor(self.connect_string) as curs:
-            query = """\
-                SELECT person.*
-                FROM person
-                JOIN participant on person.id=participant.person_id
-                WHERE participant.event_id=%s"""
-            curs.execute(query, (event_id,))
+        with self._read_cursor() as curs:
+            curs.execute(EVENT_PEOPLE_QUERY, {'event_id': event_id})
             if curs.rowcount < 1:
                 raise NonExistantIdError("no participants for event id %s" % event_id)
             return [dict(row) for row in curs]
 
     def get_events_between(self, person_id, start_time, end_time):
-        with PostgresCursor(self.connect_string) as curs:
+        with self._read_cursor(person_id) as curs:
+            return self._events_between(curs, person_id, start_time, end_time)
+
+    def get_availability_rules(self, person_id):
+        with self._read_cursor(person_id) as curs:
+            return self._availability_rules(curs, person_id)
+
+    def create_availability_rule(self, person_id, dtstart, duration, rrule, tzid='UTC', exdates=()):
+        """
+        Store a recurring block of availability for a person. See
+        recurrence.AvailabilityRule for the meaning of the arguments.
+        """
+        rule = AvailabilityRule(person_id=person_id, dtstart=as_datetime(dtstart), duration=duration,
+                                rrule=rrule, tzid=tzid, exdates=exdates)
+        ## fail on a malformed rule before storing it
+        next(iter(rule.occurrences(rule.dtstart, rule.dtstart)), None)
+        with self._cursor() as curs:
             query = """\
-                SELECT e.id, e.type, e.start_time, e.end_time, e.name, e.notes
-                FROM event e
-                JOIN participant p on e.id=p.event_id
-                WHERE p.person_id=%s
-                AND e.end_time>%s and e.start_time<%s
-                ORDER BY e.start_time;"""
-            curs.execute(query, (person_id, start_time, end_time))
-            events = [Event(**e) for e in curs]
-            for event in events:
-                curs.execute("SELECT person_id FROM participant WHERE event_id=%s", (event.id,))
-                event.participants = [row['person_id'] for row in curs]
-            return events
+                INSERT INTO availability_rule
+                (person_id, dtstart, duration, rrule, tzid, exdates)
+                VALUES
+                (%s, %s, %s, %s, %s, %s::date[])
+                RETURNING id;"""
+            curs.execute(query, (rule.person_id, rule.dtstart, rule.duration, rule.rrule, rule.tzid, rule.exdates))
+            rule.id = curs.fetchone()[0]
+            days = self._record_rule(curs, rule)
+        self._rule_changed(rule, days)
+        return rule
+
+    def delete_availability_rule(self, id):
+        with self._cursor() as curs:
+            curs.execute("""\
+                DELETE FROM availability_rule
+                WHERE id=%s
+                RETURNING id, person_id, dtstart, duration, rrule, tzid, exdates;""", (id,))
+            if curs.rowcount < 1:
+                raise NonExistantIdError("no availability rule exists with id %s" % id)
+            rule = AvailabilityRule(**curs.fetchone())
+            days = self._record_rule(curs, rule)
+        self._rule_changed(rule, days)
+        return rule
+
+    def compute_appointments(self, person_id, start_time, end_time):
+        """
+        A person's appointment blocks over a window, read from the DB
+        without going through the availability cache
+        """
+        with self._read_cursor(person_id) as curs:
+            events = self._events_between(curs, person_id, start_time, end_time)
+            rules = self._availability_rules(curs, person_id)
+        with span('slots'):
+            return self._appointments(list(heapq.merge(events, availability_events(rules, start_time, end_time),
+                                                       key=lambda event: event.start_time)))
 
     def get_appointments(self, person_id, start_time, end_time):
-        return appointments(self.get_events_between(person_id, start_time, end_time))
+        def compute():
+            return self.compute_appointments(person_id, start_time, end_time)
+        if self.availability_cache is None:
+            return compute()
+        return self.availability_cache.get_or_compute(person_id, start_time, end_time, compute)
 
     def get_calendar(self, person_id, coach_id, start_time, end_time):
         """
@@ -190,75 +1086,284 @@ class PostgresDataStore:
         for coaching sessions.
         """
         user_events = self.get_events_between(person_id, start_time, end_time)
-        coach_appointments = remove_conflicting(self.get_appointments(coach_id, start_time, end_time), user_events)
+        if self.slot_engine == 'sql':
+            coach_appointments = self.get_open_appointments(person_id, coach_id, start_time, end_time)
+        else:
+            coach_blocks = self.get_appointments(coach_id, start_time, end_time)
+            with span('slots'):
+                coach_appointments = remove_conflicting(coach_blocks, user_events)
         return coach_appointments + user_events
 
-    def create_event(self, start_time, end_time, name=None, notes=None, type='event', participants=[]):
-        with PostgresCursor(self.connect_string) as curs:
+    def search_availability(self, start_time, end_time, limit=10, person_id=None):
+        """
+        Find the earliest open appointment slots with any coach, reading
+        every coach's calendar for the window in one query.
+
+        :param person_id: optionally, a client whose own events rule slots out
+        :return: a list of open slot events, each with its coach as participant
+        """
+        if end_time < start_time:
+            return []
+        calendars = {}
+        with self._read_cursor(person_id) as curs:
+            curs.execute(COACH_EVENTS_QUERY, window_args(start_time, end_time))
+            for row in curs:
+                row = dict(row)
+                calendars.setdefault(row.pop('coach_id'), []).append(Event(**row))
+
+            curs.execute(COACH_RULES_QUERY)
+            rules = {}
+            for row in curs:
+                rules.setdefault(row['person_id'], []).append(AvailabilityRule(**row))
+            for coach_id, coach_rules in rules.items():
+                calendars.setdefault(coach_id, []).extend(availability_events(coach_rules, start_time, end_time))
+
+            busy = self._events_between(curs, person_id, start_time, end_time) if person_id else []
+        return earliest_open_slots(calendars, start_time, end_time, limit=limit, busy=busy)
+
+    def stream_calendar(self, person_id, coach_id, start_time, end_time, itersize=2000):
+        """
+        The same events as get_calendar, as a generator. The coach's events
+        are read in batches of itersize through a server-side cursor and
+        turned into slots as they arrive, so memory use doesn't grow with
+        the width of the window. The connection is held until the generator
+        is exhausted or closed.
+        """
+        user_events = self.get_events_between(person_id, start_time, end_time)
+        if end_time < start_time:
+            return
+        index = ConflictIndex(user_events)
+        with self._read_cursor(person_id, coach_id) as curs:
+            rules = self._availability_rules(curs, coach_id)
+            with curs.connection.cursor(name='stream_calendar', cursor_factory=self.cursor_factory) as stream:
+                stream.itersize = itersize
+                stream.execute(EVENTS_BETWEEN_QUERY, window_args(start_time, end_time, person_id=coach_id))
+                coach_events = heapq.merge((Event(**row) for row in stream),
+                                           availability_events(rules, start_time, end_time),
+                                           key=attrgetter('start_time'))
+                for block in stream_appointments(coach_events):
+                    if not index.conflicts(block):
+                        yield block
+        yield from user_events
+
+    def get_changes(self, person_id, coach_id, start_time, end_time, token=None):
+        """
+        What changed in a client's view of a coach's calendar, as returned
+        by get_calendar, since the sync token was handed out. The work done
+        is in proportion to the changes rather than to the calendars.
+
+        Without a token, or if one of the coach's availability rules
+        changed, the whole calendar is returned instead.
+
+        :param token: a token from get_changes or get_sync_state
+        :return: a dict with a new 'token' and either 'reset': True and the
+                 whole calendar as 'events', or 'reset': False, the client's
+                 new or changed 'events', the IDs of events that are
+                 'deleted' from the view, the 'ranges' of time in which
+                 slots changed and the coach's appointment 'slots' in those
+                 ranges, which replace any slots overlapping them
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        changes = []
+        with self._read_cursor(person_id, coach_id) as curs:
+            curs.execute(SYNC_STATE_QUERY, {'person_ids': []})
+            new_token = curs.fetchone()['token']
+            if token is not None:
+                curs.execute(CHANGES_QUERY, {'person_ids': [person_id, coach_id], 'token': token})
+                changes = curs.fetchall()
+        if token is None or any(change['op'] == 'rule' for change in changes):
+            return {'token': new_token, 'reset': True,
+                    'events': self.get_calendar(person_id, coach_id, start_time, end_time)}
+
+        changed_ids, ranges = summarize_changes(changes, person_id, start_time, end_time)
+        events = []
+        user_events = []
+        if changed_ids or ranges:
+            with self._read_cursor(person_id, coach_id) as curs:
+                if changed_ids:
+                    curs.execute(CHANGED_EVENTS_QUERY, window_args(start_time, end_time, person_id=person_id,
+                                                                   changed_ids=changed_ids))
+                    events = load_participants(curs, [Event(**row) for row in curs])
+                if ranges:
+                    user_events = self._events_between(curs, person_id, ranges[0][0], ranges[-1][1])
+        index = ConflictIndex(user_events)
+        slots = []
+        for s, e in ranges:
+            slots.extend(block for block in self.get_appointments(coach_id, s, e)
+                         if block.start_time < e and block.end_time > s and not index.conflicts(block))
+        current = {event.id for event in events}
+        return {'token': new_token, 'reset': False,
+                'events': events,
+                'deleted': [id for id in changed_ids if id not in current],
+                'ranges': ranges,
+                'slots': slots}
+
+    def get_open_appointments(self, person_id, coach_id, start_time, end_time, block_len=timedelta(hours=1)):
+        """
+        Compute in SQL the coach's appointment slots that don't conflict with
+        the client's calendar, the same slots that
+            remove_conflicting(get_appointments(coach_id, ...), get_events_between(person_id, ...))
+        would give, without shipping the coach's raw events to Python.
+        """
+        if end_time < start_time:
+            return []
+        with self._read_cursor(person_id, coach_id) as curs:
+            ## availability rules are expanded here and passed in as arrays
+            rule_events = list(availability_events(self._availability_rules(curs, coach_id), start_time, end_time))
             query = """\
-                INSERT INTO event
-                (start_time, end_time, name, notes, type)
-                VALUES
-                (%s, %s, %s, %s, %s)
-                RETURNING id;"""
-            curs.execute(query, (start_time, end_time, name, notes, type))
-            event_id = curs.fetchone()[0]
+                WITH coach_event AS (
+                    SELECT e.type, e.start_time, e.end_time
+                    FROM event e
+                    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+                    WHERE p.person_id=%(coach_id)s
+                    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+                    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+                    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+                    UNION ALL
+                    SELECT 'schedulable', r.start_time, r.end_time
+                    FROM unnest(%(rule_starts)s::timestamp[], %(rule_ends)s::timestamp[]) AS r(start_time, end_time)
+                ),
+                client_event AS (
+                    SELECT e.start_time, e.end_time
+                    FROM event e
+                    JOIN participant p on e.id=p.event_id AND e.start_time=p.start_time
+                    WHERE p.person_id=%(person_id)s
+                    AND e.type IS DISTINCT FROM 'schedulable'
+                    AND e.time_range && tsrange(%(start_time)s::timestamp, %(end_time)s::timestamp, '[)')
+                    AND e.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND e.start_time < %(end_time)s::timestamp
+                    AND p.start_time > %(start_time)s::timestamp - %(max_span)s::interval AND p.start_time < %(end_time)s::timestamp
+                ),
+                block AS (
+                    SELECT b.start_time, b.start_time + %(block_len)s AS end_time
+                    FROM coach_event s
+                    CROSS JOIN LATERAL generate_series(s.start_time, s.end_time - %(block_len)s, %(block_len)s) AS b(start_time)
+                    WHERE s.type='schedulable'
+                )
+                SELECT b.start_time, b.end_time,
+                       EXISTS (SELECT 1 FROM coach_event c
+                               WHERE c.type IS DISTINCT FROM 'schedulable'
+                               AND c.start_time<b.end_time and c.end_time>b.start_time) AS booked
+                FROM block b
+                WHERE NOT EXISTS (SELECT 1 FROM client_event c
+                                  WHERE c.start_time<b.end_time and c.end_time>b.start_time)
+                ORDER BY b.start_time;"""
+            curs.execute(query, window_args(start_time, end_time,
+                                            person_id=person_id,
+                                            coach_id=coach_id,
+                                            block_len=block_len,
+                                            rule_starts=[event.start_time for event in rule_events],
+                                            rule_ends=[event.end_time for event in rule_events]))
+            return [Event(start_time=row['start_time'], end_time=row['end_time'],
+                          name='Booked', type='unavailable slot') if row['booked'] else
+                    Event(start_time=row['start_time'], end_time=row['end_time'],
+                          name='Available', type='open slot')
+                    for row in curs]
+
+    def create_event(self, start_time, end_time, name=None, notes=None, type='event', participants=None):
+        """
+        Create an event. A coaching appointment is only booked if none of
+        its participants has anything else on at the time, otherwise
+        BookingConflictError is raised.
+        """
+        if participants is None:
+            participants = []
+        with self._cursor() as curs:
+            check_booking(curs, Event(start_time=start_time, end_time=end_time, type=type, participants=participants))
+            PREPARED.execute(curs, 'insert_event', {'start_time': start_time, 'end_time': end_time,
+                                                    'name': name, 'notes': notes, 'type': type})
+            event_id, stored_start_time = curs.fetchone()
             for participant_id in participants:
-                curs.execute("INSERT INTO participant (event_id, person_id) VALUES (%s, %s);", (event_id, participant_id))
-            return Event(id=event_id,
-                         start_time=start_time,
-                         end_time=end_time,
-                         name=name,
-                         notes=notes,
-                         type=type,
-                         participants=participants)
+                PREPARED.execute(curs, 'insert_participant', {'event_id': event_id, 'person_id': participant_id,
+                                                              'start_time': stored_start_time})
+            event = Event(id=event_id,
+                          start_time=start_time,
+                          end_time=end_time,
+                          name=name,
+                          notes=notes,
+                          type=type,
+                          participants=participants)
+            self._record(curs, 'create', event)
+        self._changed(event)
+        return event
+
+    def create_events(self, events):
+        """
+        Create many events in a single transaction with a few round trips,
+        rather than a couple of statements per event. Coaching appointments
+        are checked as create_event does, against each other as well, and
+        BookingConflictError raised if any clashes.
+
+        :param events: an iterable of Event objects or of dicts of create_event's arguments
+        :return: a list of the new events, with their IDs, in the order given
+        """
+        events = [Event(**event.as_dict()) if isinstance(event, Event) else Event(**dict({'type': 'event'}, **event))
+                  for event in events]
+        if not events:
+            return []
+        with self._cursor() as curs:
+            ## reserve IDs up front so each event's participants can refer to it
+            curs.execute("SELECT nextval('event_id_seq') FROM generate_series(1, %s)", (len(events),))
+            for event, row in zip(events, curs.fetchall()):
+                event.id = row[0]
+            check_bookings(curs, events)
+            execute_values(curs,
+                           "INSERT INTO event (id, start_time, end_time, name, notes, type) VALUES %s",
+                           [(e.id, e.start_time, e.end_time, e.name, e.notes, e.type) for e in events],
+                           page_size=1000)
+            execute_values(curs,
+                           "INSERT INTO participant (event_id, person_id, start_time) VALUES %s",
+                           [(e.id, person_id, e.start_time) for e in events for person_id in e.participants],
+                           page_size=1000)
+            self._record(curs, 'create', *events)
+        self._changed(*events)
+        return events
 
     def update_event(self, id, start_time, end_time, name, notes, type, participants=None):
-        with PostgresCursor(self.connect_string) as curs:
-            query = """\
-                UPDATE event
-                SET (start_time, end_time, name, notes, type) = (%s,%s,%s,%s,%s)
-                WHERE id=%s"""
-            curs.execute(query, (start_time, end_time, name, notes, type, id))
+        """
+        Update an event, checking a coaching appointment for clashes as
+        create_event does
+        """
+        with self._cursor() as curs:
+            old_event = fetch_event(curs, id, lock=True)
+            check_booking(curs, Event(id=id, start_time=start_time, end_time=end_time, type=type,
+                                      participants=old_event.participants if participants is None else participants),
+                          also_lock=old_event.participants)
+            PREPARED.execute(curs, 'update_event', {'start_time': start_time, 'end_time': end_time, 'name': name,
+                                                    'notes': notes, 'type': type, 'id': id,
+                                                    'old_start_time': old_event.start_time})
+            stored_start_time = curs.fetchone()[0]
 
             ## update participants by adding or deleting participants as necessary
             if participants is not None:
-                curs.execute("SELECT person_id FROM participant WHERE event_id=%s", (id,))
-                current_participants = [row[0] for row in curs.fetchall()]
+                current_participants = old_event.participants
                 for participant_id in participants:
                     if participant_id not in current_participants:
-                        curs.execute("INSERT INTO participant (event_id, person_id) VALUES (%s, %s);", (id, participant_id))
+                        PREPARED.execute(curs, 'insert_participant', {'event_id': id, 'person_id': participant_id,
+                                                                      'start_time': stored_start_time})
                 for participant_id in current_participants:
                     if participant_id not in participants:
-                        curs.execute("DELETE FROM participant WHERE event_id=%s and person_id=%s;", (id, participant_id))
+                        PREPARED.execute(curs, 'delete_participant', {'event_id': id, 'person_id': participant_id,
+                                                                      'start_time': stored_start_time})
 
             ## construct newly modified event from database
-            curs.execute("SELECT person_id FROM participant WHERE event_id=%s", (id,))
-            new_participants = [row[0] for row in curs.fetchall()]
-            curs.execute("SELECT * FROM event WHERE id=%s", (id,))
-            if curs.rowcount < 1:
-                raise NonExistantIdError("no event exists with id %s" % id)
-            return Event(participants=new_participants, **curs.fetchone())
+            event = fetch_event(curs, id)
+            self._record(curs, 'update', old_event, event)
+        self._changed(old_event, event)
+        return event
 
     def delete_event(self, id):
-        with PostgresCursor(self.connect_string) as curs:
+        with self._cursor() as curs:
             ## return deleted event
-            curs.execute("SELECT person_id FROM participant WHERE event_id=%s", (id,))
-            participants = [row[0] for row in curs.fetchall()]
-            curs.execute("SELECT * FROM event WHERE id=%s", (id,))
-            event = Event(participants=participants, **curs.fetchone())
+            event = fetch_event(curs, id, lock=True)
 
             ## delete
-            curs.execute("DELETE FROM event WHERE id=%s", (id,))
-            return event
+            PREPARED.execute(curs, 'delete_event', {'id': id, 'start_time': event.start_time})
+            self._record(curs, 'delete', event)
+        self._changed(event)
+        return event
 
     def get_event(self, id):
-        with PostgresCursor(self.connect_string) as curs:
-            curs.execute("SELECT person_id FROM participant WHERE event_id=%s", (id,))
-            participants = [row[0] for row in curs.fetchall()]
-            curs.execute("SELECT * FROM event WHERE id=%s", (id,))
-            if curs.rowcount < 1:
-                raise NonExistantIdError("no event exists with id %s" % id)
-            return Event(participants=participants, **curs.fetchone())
+        with self._read_cursor() as curs:
+            return fetch_event(curs, id)
 
 
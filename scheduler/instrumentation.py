@@ -0,0 +1,266 @@
+"""
+Opt-in instrumentation of requests: time spent connecting to the DB,
+running queries, computing slots and encoding JSON, reported per request
+in a Server-Timing header and accumulated for a Prometheus /metrics page,
+plus profiles of a sample of slow requests.
+
+Timing is kept per thread, so spans can be opened anywhere, for example
+in events.py, without passing anything around. Outside a request they
+cost next to nothing.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2.extras import DictCursor
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class RequestTimer:
+    """
+    Time spent in named spans during one request, in seconds, along with
+    the number of queries run and rows they returned
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.queries = 0
+        self.rows = 0
+
+    def add(self, name, elapsed):
+        self.spans[name] = self.spans.get(name, 0.0) + elapsed
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        The value of a Server-Timing header reporting the spans
+        """
+        metrics = ['%s;dur=%.2f' % (name, seconds*1000) for name, seconds in self.spans.items()]
+        if self.queries:
+            metrics.append('queries;desc="%d queries, %d rows"' % (self.queries, self.rows))
+        metrics.append('total;dur=%.2f' % (self.elapsed()*1000))
+        return ', '.join(metrics)
+
+
+def start_request():
+    """
+    Start timing a request on this thread
+    """
+    _local.timer = RequestTimer()
+    return _local.timer
+
+
+def finish_request():
+    """
+    Stop timing the request on this thread, returning its RequestTimer
+    """
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    return timer
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+def resume(timer):
+    """
+    Carry on timing a request on this thread with the RequestTimer that
+    current() returned, as when a response body is generated after the
+    view has returned
+    """
+    _local.timer = timer
+
+
+@contextmanager
+def span(name):
+    """
+    Add the time spent in a with block to the named span of the request
+    being timed on this thread, if any
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - t)
+
+
+class TimingCursor(DictCursor):
+    """
+    Cursor that counts its queries and rows and adds the time they take to
+    the 'db' span. Rows fetched later from a server-side cursor aren't
+    timed or counted.
+    """
+    def execute(self, query, vars=None):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return super().execute(query, vars)
+        t = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            timer.add('db', time.perf_counter() - t)
+            timer.queries += 1
+            timer.rows += max(self.rowcount, 0)
+
+    def executemany(self, query, vars_list):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return super().executemany(query, vars_list)
+        t = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            timer.add('db', time.perf_counter() - t)
+            timer.queries += 1
+            timer.rows += max(self.rowcount, 0)
+
+
+class Metrics:
+    """
+    Request counts, a latency histogram per endpoint and span totals,
+    rendered in the Prometheus text exposition format
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._requests = {}     ## (endpoint, method, status) -> count
+        self._durations = {}    ## endpoint -> [count per bucket..., +Inf count, sum]
+        self._spans = {}        ## span name -> seconds
+        self._queries = 0
+        self._rows = 0
+        self._slow = 0
+
+    def observe(self, endpoint, method, status, timer, slow=False):
+        """
+        Record a finished request
+
+        :param timer: the request's RequestTimer
+        """
+        elapsed = timer.elapsed()
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            counts = self._durations.setdefault(endpoint, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    counts[i] += 1
+            counts[len(self.buckets)] += 1
+            counts[-1] += elapsed
+            for name, seconds in timer.spans.items():
+                self._spans[name] = self._spans.get(name, 0.0) + seconds
+            self._queries += timer.queries
+            self._rows += timer.rows
+            self._slow += slow
+
+    def render(self, gauges=None):
+        """
+        :param gauges: dict from a name prefix to a dict of current values,
+                       such as the stats() of the connection pool
+        :return: the metrics as text
+        """
+        lines = []
+        with self._lock:
+            lines.append('# TYPE scheduler_requests_total counter')
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append('scheduler_requests_total{endpoint="%s",method="%s",status="%s"} %d' % (
+                    endpoint, method, status, count))
+            lines.append('# TYPE scheduler_request_duration_seconds histogram')
+            for endpoint, counts in sorted(self._durations.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('scheduler_request_duration_seconds_bucket{endpoint="%s",le="%g"} %d' % (
+                        endpoint, bound, count))
+                lines.append('scheduler_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (
+                    endpoint, counts[len(self.buckets)]))
+                lines.append('scheduler_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, counts[-1]))
+                lines.append('scheduler_request_duration_seconds_count{endpoint="%s"} %d' % (
+                    endpoint, counts[len(self.buckets)]))
+            lines.append('# TYPE scheduler_span_seconds_total counter')
+            for name, seconds in sorted(self._spans.items()):
+                lines.append('scheduler_span_seconds_total{span="%s"} %f' % (name, seconds))
+            lines.append('# TYPE scheduler_queries_total counter')
+            lines.append('scheduler_queries_total %d' % self._queries)
+            lines.append('# TYPE scheduler_query_rows_total counter')
+            lines.append('scheduler_query_rows_total %d' % self._rows)
+            lines.append('# TYPE scheduler_slow_requests_total counter')
+            lines.append('scheduler_slow_requests_total %d' % self._slow)
+        for prefix, values in sorted((gauges or {}).items()):
+            for name, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE scheduler_%s_%s gauge' % (prefix, name))
+                    lines.append('scheduler_%s_%s %g' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """
+    Profile a sample of requests with cProfile and keep the profiles of the
+    ones slower than a threshold, written to a directory as .prof files for
+    pstats or snakeviz, or else logged as text
+    """
+    def __init__(self, threshold=1.0, sample_rate=1.0, directory=None, rng=random.random):
+        """
+        :param threshold: seconds a request must take for its profile to be kept
+        :param sample_rate: fraction of requests to profile
+        :param directory: where to write profiles, logged if None
+        """
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.rng = rng
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """
+        Maybe start profiling the current request
+
+        :return: a profile to pass to finish, or None
+        """
+        if self.rng() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            ## another profiler is active on this thread
+            return None
+        return profile
+
+    def finish(self, profile, elapsed, label):
+        """
+        Stop profiling and keep the profile if the request was slow
+
+        :return: path of the profile written, if any
+        """
+        if profile is None:
+            return None
+        profile.disable()
+        if elapsed < self.threshold:
+            return None
+        if self.directory:
+            path = os.path.join(self.directory, '%s-%d.prof' % (label.strip('/').replace('/', '_') or 'root',
+                                                                 time.time() * 1000))
+            profile.dump_stats(path)
+            logger.warning("%s took %.3f s, profile written to %s", label, elapsed, path)
+            return path
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(30)
+        logger.warning("%s took %.3f s\n%s", label, elapsed, out.getvalue())
+        return None
@@ -0,0 +1,522 @@
+"""
+A data store that keeps everything in memory
+
+InMemoryDataStore has the same methods as events.PostgresDataStore, so the
+app, the slot engines and the benchmarks can run without Postgres, and
+tests can exercise the API against a fresh store each time. Nothing is
+persisted, and each process has a store of its own.
+"""
+import heapq
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from itertools import count
+from operator import attrgetter
+from recurrence import AvailabilityRule
+from events import Event, NonExistantIdError, BookingConflictError, BOOKING_TYPES, MAX_EVENT_SPAN, \
+                   ROLLUP_PERIODS, ConflictIndex, appointments, stream_appointments, divide_into_blocks, \
+                   merge_ranges, earliest_open_slots, availability_events, daily_slot_counts, as_datetime, batch_conflicts
+from instrumentation import span
+
+
+def _copy(event):
+    """
+    A copy of a stored event, for handing out, so callers can change it freely
+    """
+    return Event(**dict(event.as_dict(), participants=list(event.participants)))
+
+
+def _period_start(day, period):
+    """
+    The first day of the day, week or month a day is in, as date_trunc gives
+    """
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+class InMemoryDataStore:
+    """
+    Layer that represents our data store, held in memory
+
+    Each person's events are indexed by start time in a sorted list, so
+    the events overlapping a window are found by bisection: those starting
+    before the window ends and less than MAX_EVENT_SPAN before it starts,
+    as in the Postgres queries. Events know their participants, and the
+    per-person lists double as the participant index.
+
+    All reads and writes take one lock, so the store is safe to share
+    between request threads, and each write is atomic. Change tokens for
+    get_changes are sequence numbers of the writes rather than transaction
+    IDs.
+
+    slot_engine and availability_cache work as for PostgresDataStore,
+    with 'sql' computing the slots by get_open_appointments.
+    """
+    def __init__(self, slot_engine='python', availability_cache=None):
+        if slot_engine not in ('python', 'numpy', 'sql'):
+            raise ValueError("unknown slot engine %r" % slot_engine)
+        self._appointments = appointments
+        if slot_engine == 'numpy':
+            ## NumPy is only needed for this engine
+            import vectorized
+            self._appointments = vectorized.appointments
+        self.slot_engine = slot_engine
+        self.availability_cache = availability_cache
+        self._lock = threading.RLock()
+        self._people = {}           ## person_id -> dict of the person's fields
+        self._events = {}           ## event_id -> Event
+        self._by_person = {}        ## person_id -> sorted list of (start_time, event_id)
+        self._rules = {}            ## rule_id -> AvailabilityRule
+        self._changes = []          ## (token, person_id, event_id, op, start_time, end_time)
+        self._person_ids = count(1)
+        self._event_ids = count(1)
+        self._rule_ids = count(1)
+        self._token = 1
+
+    def add_person(self, first_name, last_name, coach=False, client=False, id=None):
+        """
+        Add a person, who can then take part in events
+
+        :return: the person's ID
+        """
+        with self._lock:
+            if id is None:
+                id = next(self._person_ids)
+                while id in self._people:
+                    id = next(self._person_ids)
+            self._people[id] = {'id': id, 'first_name': first_name, 'last_name': last_name,
+                                'client': client, 'coach': coach, 'version': 0}
+            self._by_person.setdefault(id, [])
+            return id
+
+    def load(self, data):
+        """
+        Add people, events and availability rules, such as from a JSON
+        fixture. The events are created together with create_events, so
+        BookingConflictError is raised if any of the bookings clash.
+
+        :param data: a dict with optional lists of dicts of 'people', of
+                     add_person's arguments, 'events', of create_event's,
+                     and 'availability_rules', of create_availability_rule's
+        """
+        for person in data.get('people', ()):
+            self.add_person(**person)
+        self.create_events(data.get('events', ()))
+        for rule in data.get('availability_rules', ()):
+            rule = dict(rule)
+            if not isinstance(rule['duration'], timedelta):
+                rule['duration'] = timedelta(seconds=rule['duration'])
+            self.create_availability_rule(**rule)
+
+    def _changed(self, *events):
+        """
+        Called after a write with the events as they were before and after it
+        """
+        if self.availability_cache is not None:
+            for event in events:
+                self.availability_cache.invalidate_event(event)
+
+    def _rule_changed(self, rule):
+        if self.availability_cache is not None:
+            self.availability_cache.invalidate(rule.person_id)
+
+    def _record(self, op, *events):
+        """
+        Log a write to each participant's calendar for get_changes and
+        bump their change versions, under the lock
+        """
+        for event in events:
+            for person_id in event.participants:
+                self._changes.append((self._token, person_id, event.id, op, event.start_time, event.end_time))
+                self._people[person_id]['version'] += 1
+        self._token += 1
+
+    def _check_event(self, event):
+        """
+        Normalize an event's times and participants and check it as the
+        database would
+        """
+        event.start_time, event.end_time = as_datetime(event.start_time), as_datetime(event.end_time)
+        event.participants = list(dict.fromkeys(event.participants))
+        if event.end_time - event.start_time > MAX_EVENT_SPAN:
+            raise ValueError("events can last at most %s" % MAX_EVENT_SPAN)
+        for person_id in event.participants:
+            if person_id not in self._people:
+                raise NonExistantIdError("no person exists with id %s" % person_id)
+
+    def _check_booking(self, event):
+        """
+        Raise BookingConflictError if a booking clashes with anything its
+        participants have on, like events.check_booking
+        """
+        if event.type not in BOOKING_TYPES or not event.participants:
+            return
+        conflicts = sorted({other.id for person_id in set(event.participants)
+                            for other in self._overlapping(person_id, event.start_time, event.end_time)
+                            if other.type != 'schedulable' and other.id != event.id})
+        if conflicts:
+            raise BookingConflictError("%s to %s is already booked" % (event.start_time, event.end_time), conflicts)
+
+    def _index(self, event):
+        for person_id in event.participants:
+            insort(self._by_person[person_id], (event.start_time, event.id))
+
+    def _unindex(self, event):
+        for person_id in event.participants:
+            index = self._by_person[person_id]
+            del index[bisect_left(index, (event.start_time, event.id))]
+
+    def _overlapping(self, person_id, start_time, end_time):
+        """
+        The stored events of a person's that overlap a window, in start time order
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        if not start_time < end_time:
+            return []
+        index = self._by_person.get(person_id, [])
+        lo = bisect_right(index, (start_time - MAX_EVENT_SPAN, float('inf')))
+        hi = bisect_left(index, (end_time,))
+        events = (self._events[event_id] for _, event_id in index[lo:hi])
+        ## an event with no duration overlaps nothing, as with tsrange's &&
+        ## in the SQL, where its range is empty
+        return [event for event in events
+                if start_time < event.end_time and event.start_time < end_time
+                and event.start_time < event.end_time]
+
+    def _fetch_event(self, id):
+        event = self._events.get(id)
+        if event is None:
+            raise NonExistantIdError("no event exists with id %s" % id)
+        return event
+
+    def _availability_rules(self, person_id):
+        return [rule for _, rule in sorted(self._rules.items()) if rule.person_id == person_id]
+
+    def get_coaches(self):
+        """
+        Return a list of dict's each representing a coach
+        """
+        with self._lock:
+            return [dict(person) for person in self._people.values() if person['coach']]
+
+    def get_versions(self, person_ids):
+        """
+        The change versions of the given people, as a dict from person ID
+        to version
+        """
+        with self._lock:
+            return {id: self._people[id]['version'] for id in person_ids if id in self._people}
+
+    def get_sync_state(self, person_ids):
+        """
+        A sync token for get_changes along with the change versions of the
+        given people
+        """
+        with self._lock:
+            return self._token, self.get_versions(person_ids)
+
+    def get_utilization(self, start_time, end_time, period='day', coach_id=None):
+        """
+        Coaches' open and booked appointment slots per day, week or month,
+        as from PostgresDataStore.get_utilization. Computed from the
+        calendars on each call, there being no rollup to keep.
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError("unknown period %r" % period)
+        first_day, end_day = as_datetime(start_time).date(), as_datetime(end_time).date()
+        start_time = datetime.combine(first_day, datetime.min.time())
+        end_time = datetime.combine(end_day, datetime.min.time())
+        totals = {}
+        with self._lock:
+            coach_ids = [coach_id] if coach_id is not None else \
+                        [id for id, person in self._people.items() if person['coach']]
+            for id in coach_ids:
+                events = list(self._overlapping(id, start_time, end_time))
+                events.extend(availability_events(self._availability_rules(id), start_time, end_time))
+                for day, (o, b) in daily_slot_counts(events, start_time, end_time).items():
+                    key = (id, _period_start(day, period))
+                    open_slots, booked_slots = totals.get(key, (0, 0))
+                    totals[key] = (open_slots + o, booked_slots + b)
+        return [{'coach_id': id, 'period': period_start, 'open_slots': o, 'booked_slots': b,
+                 'utilization': b / ((o + b) or 1)}
+                for (id, period_start), (o, b) in sorted(totals.items())]
+
+    def rebuild_rollup(self, start_time, end_time, coach_ids=None):
+        """
+        Nothing to do, as get_utilization reads the calendars themselves
+        """
+
+    def ensure_partitions(self, start_time, end_time):
+        """
+        Nothing to do, the store isn't partitioned
+
+        :return: an empty list, no partitions having been created
+        """
+        return []
+
+    def get_participants(self, event_id):
+        with self._lock:
+            event = self._events.get(event_id)
+            if event is None or not event.participants:
+                raise NonExistantIdError("no participants for event id %s" % event_id)
+            return [dict(self._people[person_id]) for person_id in event.participants]
+
+    def get_events_between(self, person_id, start_time, end_time):
+        with self._lock:
+            return [_copy(event) for event in self._overlapping(person_id, start_time, end_time)]
+
+    def get_availability_rules(self, person_id):
+        with self._lock:
+            return [AvailabilityRule(**vars(rule)) for rule in self._availability_rules(person_id)]
+
+    def create_availability_rule(self, person_id, dtstart, duration, rrule, tzid='UTC', exdates=()):
+        """
+        Store a recurring block of availability for a person. See
+        recurrence.AvailabilityRule for the meaning of the arguments.
+        """
+        rule = AvailabilityRule(person_id=person_id, dtstart=as_datetime(dtstart), duration=duration,
+                                rrule=rrule, tzid=tzid, exdates=[as_datetime(d).date() for d in exdates or ()])
+        ## fail on a malformed rule before storing it
+        next(iter(rule.occurrences(rule.dtstart, rule.dtstart)), None)
+        with self._lock:
+            if person_id not in self._people:
+                raise NonExistantIdError("no person exists with id %s" % person_id)
+            rule.id = next(self._rule_ids)
+            self._rules[rule.id] = rule
+            self._changes.append((self._token, person_id, None, 'rule', None, None))
+            self._people[person_id]['version'] += 1
+            self._token += 1
+        self._rule_changed(rule)
+        return AvailabilityRule(**vars(rule))
+
+    def delete_availability_rule(self, id):
+        with self._lock:
+            rule = self._rules.pop(id, None)
+            if rule is None:
+                raise NonExistantIdError("no availability rule exists with id %s" % id)
+            self._changes.append((self._token, rule.person_id, None, 'rule', None, None))
+            self._people[rule.person_id]['version'] += 1
+            self._token += 1
+        self._rule_changed(rule)
+        return rule
+
+    def compute_appointments(self, person_id, start_time, end_time):
+        """
+        A person's appointment blocks over a window, without going through
+        the availability cache
+        """
+        with self._lock:
+            events = [_copy(event) for event in self._overlapping(person_id, start_time, end_time)]
+            rules = self._availability_rules(person_id)
+        with span('slots'):
+            return self._appointments(list(heapq.merge(events, availability_events(rules, start_time, end_time),
+                                                       key=lambda event: event.start_time)))
+
+    def get_appointments(self, person_id, start_time, end_time):
+        def compute():
+            return self.compute_appointments(person_id, start_time, end_time)
+        if self.availability_cache is None:
+            return compute()
+        return self.availability_cache.get_or_compute(person_id, start_time, end_time, compute)
+
+    def get_calendar(self, person_id, coach_id, start_time, end_time):
+        """
+        All events within a window for both the coach and the client,
+        including slots available for coaching sessions
+        """
+        user_events = self.get_events_between(person_id, start_time, end_time)
+        if self.slot_engine == 'sql':
+            coach_appointments = self.get_open_appointments(person_id, coach_id, start_time, end_time)
+        else:
+            coach_blocks = self.get_appointments(coach_id, start_time, end_time)
+            with span('slots'):
+                index = ConflictIndex(user_events)
+                coach_appointments = [block for block in coach_blocks if not index.conflicts(block)]
+        return coach_appointments + user_events
+
+    def search_availability(self, start_time, end_time, limit=10, person_id=None):
+        """
+        Find the earliest open appointment slots with any coach
+
+        :param person_id: optionally, a client whose own events rule slots out
+        :return: a list of open slot events, each with its coach as participant
+        """
+        if end_time < start_time:
+            return []
+        calendars = {}
+        with self._lock:
+            for id, person in self._people.items():
+                if person['coach']:
+                    events = [_copy(event) for event in self._overlapping(id, start_time, end_time)]
+                    events.extend(availability_events(self._availability_rules(id), start_time, end_time))
+                    if events:
+                        calendars[id] = events
+            busy = [_copy(event) for event in self._overlapping(person_id, start_time, end_time)] if person_id else []
+        return earliest_open_slots(calendars, start_time, end_time, limit=limit, busy=busy)
+
+    def stream_calendar(self, person_id, coach_id, start_time, end_time, itersize=2000):
+        """
+        The same events as get_calendar, as a generator, for parity with
+        PostgresDataStore.stream_calendar. itersize is ignored.
+        """
+        user_events = self.get_events_between(person_id, start_time, end_time)
+        if end_time < start_time:
+            return
+        index = ConflictIndex(user_events)
+        with self._lock:
+            coach_events = [_copy(event) for event in self._overlapping(coach_id, start_time, end_time)]
+            rules = self._availability_rules(coach_id)
+        coach_events = heapq.merge(coach_events, availability_events(rules, start_time, end_time),
+                                   key=attrgetter('start_time'))
+        for block in stream_appointments(coach_events):
+            if not index.conflicts(block):
+                yield block
+        yield from user_events
+
+    def get_changes(self, person_id, coach_id, start_time, end_time, token=None):
+        """
+        What changed in a client's view of a coach's calendar since the sync
+        token was handed out, see PostgresDataStore.get_changes
+        """
+        start_time, end_time = as_datetime(start_time), as_datetime(end_time)
+        with self._lock:
+            new_token = self._token
+            changes = [change for change in self._changes
+                       if token is not None and change[0] >= token and change[1] in (person_id, coach_id)]
+        if token is None or any(change[3] == 'rule' for change in changes):
+            return {'token': new_token, 'reset': True,
+                    'events': self.get_calendar(person_id, coach_id, start_time, end_time)}
+
+        changed_ids = sorted({change[2] for change in changes if change[1] == person_id})
+        ranges = merge_ranges((max(change[4], start_time), min(change[5], end_time))
+                              for change in changes
+                              if change[4] < end_time and change[5] > start_time)
+        events = []
+        user_events = []
+        if changed_ids or ranges:
+            with self._lock:
+                if changed_ids:
+                    events = [_copy(event) for event in self._overlapping(person_id, start_time, end_time)
+                              if event.id in changed_ids]
+                if ranges:
+                    user_events = [_copy(event) for event in
+                                   self._overlapping(person_id, ranges[0][0], ranges[-1][1])]
+        index = ConflictIndex(user_events)
+        slots = []
+        for s, e in ranges:
+            slots.extend(block for block in self.get_appointments(coach_id, s, e)
+                         if block.start_time < e and block.end_time > s and not index.conflicts(block))
+        current = {event.id for event in events}
+        return {'token': new_token, 'reset': False,
+                'events': events,
+                'deleted': [id for id in changed_ids if id not in current],
+                'ranges': ranges,
+                'slots': slots}
+
+    def get_open_appointments(self, person_id, coach_id, start_time, end_time, block_len=timedelta(hours=1)):
+        """
+        The coach's appointment slots that don't conflict with the client's
+        calendar, the counterpart of the SQL slot engine
+        """
+        if end_time < start_time:
+            return []
+        with self._lock:
+            coach_events = [_copy(event) for event in self._overlapping(coach_id, start_time, end_time)]
+            coach_events.extend(availability_events(self._availability_rules(coach_id), start_time, end_time))
+            client_index = ConflictIndex(self._overlapping(person_id, start_time, end_time))
+        booked = ConflictIndex(coach_events)
+        blocks = []
+        for event in coach_events:
+            if event.type == 'schedulable':
+                for block in divide_into_blocks(event, block_len):
+                    if client_index.conflicts(block):
+                        continue
+                    if booked.conflicts(block):
+                        block.name = 'Booked'
+                        block.type = 'unavailable slot'
+                    blocks.append(block)
+        return sorted(blocks, key=attrgetter('start_time'))
+
+    def create_event(self, start_time, end_time, name=None, notes=None, type='event', participants=None):
+        """
+        Create an event. A coaching appointment is only booked if none of
+        its participants has anything else on at the time, otherwise
+        BookingConflictError is raised.
+        """
+        event = Event(start_time=start_time, end_time=end_time, name=name, notes=notes, type=type,
+                      participants=list(participants or []))
+        with self._lock:
+            self._check_event(event)
+            self._check_booking(event)
+            event.id = next(self._event_ids)
+            self._events[event.id] = event
+            self._index(event)
+            self._record('create', event)
+            event = _copy(event)
+        self._changed(event)
+        return event
+
+    def create_events(self, events):
+        """
+        Create many events at once, checking the bookings among them against
+        each other and the stored events as create_event does
+
+        :param events: an iterable of Event objects or of dicts of create_event's arguments
+        :return: a list of the new events, with their IDs, in the order given
+        """
+        events = [Event(**event.as_dict()) if isinstance(event, Event) else Event(**dict({'type': 'event'}, **event))
+                  for event in events]
+        with self._lock:
+            for event in events:
+                self._check_event(event)
+                event.id = next(self._event_ids)
+            clashes = batch_conflicts(events)
+            if clashes:
+                event, clashing = clashes[0]
+                raise BookingConflictError("%s to %s clashes with another event of the batch" %
+                                           (event.start_time, event.end_time), [other.id for other in clashing])
+            for event in events:
+                self._check_booking(event)
+            for event in events:
+                self._events[event.id] = event
+                self._index(event)
+            if events:
+                self._record('create', *events)
+            events = [_copy(event) for event in events]
+        self._changed(*events)
+        return events
+
+    def update_event(self, id, start_time, end_time, name, notes, type, participants=None):
+        """
+        Update an event, checking a coaching appointment for clashes as
+        create_event does
+        """
+        with self._lock:
+            old_event = self._fetch_event(id)
+            event = Event(id=id, start_time=start_time, end_time=end_time, name=name, notes=notes, type=type,
+                          participants=list(old_event.participants if participants is None else participants))
+            self._check_event(event)
+            self._check_booking(event)
+            self._unindex(old_event)
+            self._events[id] = event
+            self._index(event)
+            self._record('update', old_event, event)
+            event = _copy(event)
+        self._changed(old_event, event)
+        return event
+
+    def delete_event(self, id):
+        with self._lock:
+            event = self._fetch_event(id)
+            self._unindex(event)
+            del self._events[id]
+            self._record('delete', event)
+        self._changed(event)
+        return event
+
+    def get_event(self, id):
+        with self._lock:
+            return _copy(self._fetch_event(id))
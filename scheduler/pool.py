@@ -0,0 +1,204 @@
+"""
+A bounded, thread-safe pool of Postgres connections
+"""
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class PoolExhaustedError(RuntimeError):
+    pass
+
+
+class PoolClosedError(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Hand out Postgres connections to threads, creating at most max_size of
+    them. Threads that find the pool empty wait up to timeout seconds for a
+    connection to be returned.
+
+    Connections are health checked when they are checked out: closed or
+    broken connections are replaced, and connections that have sat idle
+    longer than check_interval seconds are pinged first. A connection older
+    than max_lifetime seconds is retired rather than reused.
+    """
+
+    def __init__(self, connect_string, min_size=0, max_size=10, max_lifetime=3600.0,
+                 timeout=30.0, check_interval=5.0, connect=psycopg2.connect, **connect_kwargs):
+        """
+        :param connect_string: libpq connection string
+        :param min_size: number of connections to open up front
+        :param max_size: upper bound on open connections
+        :param max_lifetime: seconds after which a connection is retired
+        :param timeout: seconds to wait for a free connection before giving up
+        :param check_interval: ping connections that have been idle longer than this
+        :param connect: function that opens a new connection
+        :param connect_kwargs: passed through to connect, e.g. cursor_factory
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.connect_string = connect_string
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._connect = connect
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []         # stack of (conn, returned_at), most recently used last
+        self._created = {}      # id(conn) -> time the connection was opened
+        self._size = 0          # open connections, idle or in use
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._opened = 0
+        self._discarded = 0
+        self._closed = False
+        for _ in range(min(min_size, max_size)):
+            conn = self._open()
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        conn = self._connect(self.connect_string, **self._connect_kwargs)
+        with self._cond:
+            self._created[id(conn)] = time.monotonic()
+            self._opened += 1
+        return conn
+
+    def _expired(self, conn):
+        created = self._created.get(id(conn))
+        return created is None or time.monotonic() - created > self.max_lifetime
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed or self._expired(conn):
+            return False
+        if time.monotonic() - returned_at > self.check_interval:
+            try:
+                with conn.cursor() as curs:
+                    curs.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """
+        Check out a connection, waiting for one to be returned if the pool
+        is at max_size. Raises PoolExhaustedError after timeout seconds.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            conn = None
+            with self._cond:
+                if self._closed:
+                    raise PoolClosedError("the pool has been closed")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(
+                            "no connection available after %.1f seconds" % self.timeout)
+                    waited = True
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise PoolClosedError("the pool has been closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                else:
+                    ## reserve a slot, then connect outside the lock
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn, returned_at):
+                self._close(conn)
+                continue
+
+            wait_time = time.monotonic() - start
+            with self._cond:
+                self._in_use += 1
+                self._checkouts += 1
+                if waited:
+                    self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. Broken or expired connections,
+        or any connection when close is True, are closed instead.
+        """
+        with self._cond:
+            self._in_use -= 1
+            close = close or self._closed
+        if not (close or conn.closed or self._expired(conn)):
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+            else:
+                with self._cond:
+                    if not self._closed:
+                        self._idle.append((conn, time.monotonic()))
+                        self._cond.notify()
+                        return
+        self._close(conn)
+
+    def closeall(self):
+        """
+        Close idle connections. Connections currently checked out are
+        closed when they're returned, and no more are handed out.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        """
+        Return a dict of pool metrics: connections in use and idle,
+        how often callers had to wait and for how long (in seconds).
+        """
+        with self._cond:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'wait_time_max': self._max_wait_time,
+                'opened': self._opened,
+                'discarded': self._discarded,
+            }
@@ -0,0 +1,140 @@
+"""
+Server-side prepared statements for a fixed set of queries
+
+Postgres parses and plans every query sent as text. For the handful of
+queries the data store runs on every request, that work can be done once
+per connection with PREPARE, after which EXECUTE runs the statement by
+name with just its arguments.
+
+Queries are written as for psycopg2, with %(name)s placeholders, so the
+same text runs either way: prepared on connections that have been through
+prepare(), as a plain query on any other.
+"""
+import re
+import threading
+import weakref
+import psycopg2
+from psycopg2 import errorcodes
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+## errors meaning a connection's prepared statements are gone or stale, as
+## after a DISCARD ALL, or a schema change that alters a statement's result
+_STALE = (errorcodes.INVALID_SQL_STATEMENT_NAME, errorcodes.FEATURE_NOT_SUPPORTED)
+
+
+class Statement:
+    """
+    A query with %(name)s placeholders and the PREPARE and EXECUTE
+    statements that run it by name, passing the arguments in the order
+    their placeholders first appear. The query with $n placeholders in
+    place of the names, as drivers such as asyncpg take it, is positional.
+    """
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        self.params = []
+        def number(match):
+            if match.group(1) not in self.params:
+                self.params.append(match.group(1))
+            return '$%d' % (self.params.index(match.group(1)) + 1)
+        self.positional = _PLACEHOLDER.sub(number, query).rstrip().rstrip(';')
+        self.prepare_sql = 'PREPARE %s AS %s' % (name, self.positional)
+        self.execute_sql = 'EXECUTE %s' % name
+        if self.params:
+            self.execute_sql += ' (%s)' % ', '.join('%%(%s)s' % param for param in self.params)
+
+    def positional_args(self, args):
+        """
+        A dict of arguments as a list in the order of the positional query
+        """
+        return [args[param] for param in self.params]
+
+
+class PreparedStatements:
+    """
+    A set of statements prepared on each connection they're used on
+
+    Call prepare() on a connection when it's checked out, outside of a
+    transaction. It prepares the statements the first time it sees the
+    connection, so a replacement connection after a reconnect is prepared
+    afresh, and again after invalidate(), e.g. following a schema change.
+    A connection whose statements turn out to be missing or stale is
+    forgotten, to be prepared again when next checked out.
+    """
+    def __init__(self, queries, prefix='scheduler_'):
+        """
+        :param queries: dict from a short name to a query with %(name)s placeholders
+        :param prefix: prefix of the names the statements are prepared under
+        """
+        self.statements = {name: Statement(prefix + name, query) for name, query in queries.items()}
+        self.generation = 0
+        self._prepared = weakref.WeakKeyDictionary()    ## connection -> generation prepared
+        self._lock = threading.Lock()
+        self._prepares = 0
+        self._executes = 0
+        self._discards = 0
+
+    def prepare(self, conn):
+        """
+        Prepare the statements on a connection unless they are already, in
+        a transaction of their own
+        """
+        with self._lock:
+            generation = self.generation
+            prepared = self._prepared.get(conn)
+        if prepared == generation:
+            return
+        with conn.cursor() as curs:
+            ## clear out any left from an earlier generation or a failed attempt
+            curs.execute("DEALLOCATE ALL")
+            for statement in self.statements.values():
+                curs.execute(statement.prepare_sql)
+        conn.commit()
+        with self._lock:
+            self._prepared[conn] = generation
+            self._prepares += 1
+
+    def is_prepared(self, conn):
+        with self._lock:
+            return self._prepared.get(conn) == self.generation
+
+    def execute(self, curs, name, args):
+        """
+        Run the named statement with a dict of arguments, by name if the
+        cursor's connection has it prepared, as a plain query if not
+        """
+        statement = self.statements[name]
+        if not self.is_prepared(curs.connection):
+            return curs.execute(statement.query, args)
+        try:
+            curs.execute(statement.execute_sql, args)
+        except psycopg2.Error as ex:
+            if ex.pgcode in _STALE:
+                self.discard(curs.connection)
+            raise
+        with self._lock:
+            self._executes += 1
+
+    def discard(self, conn):
+        """
+        Forget that a connection has the statements prepared
+        """
+        with self._lock:
+            if self._prepared.pop(conn, None) is not None:
+                self._discards += 1
+
+    def invalidate(self):
+        """
+        Have every connection prepare the statements again when next
+        checked out
+        """
+        with self._lock:
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'connections': sum(1 for generation in self._prepared.values() if generation == self.generation),
+                    'prepares': self._prepares,
+                    'executes': self._executes,
+                    'discards': self._discards}
@@ -0,0 +1,213 @@
+"""
+Background prewarming of coaches' availability
+
+The first client to open a coach's week pays for reading the coach's
+events and turning them into appointment blocks. Everyone opens the new
+week at about the same time, when week_window_to_show rolls the default
+window over, so a Prewarmer thread keeps every coach's blocks for the
+current and next windows in the AvailabilityCache instead: refreshed
+shortly after a booking invalidates them, and before they expire.
+
+The web UI asks for the week starting at midnight in the client's time
+zone, not at the UTC midnight week_window_to_show gives, so the windows
+are warmed WINDOW_MARGIN wider on each side. The cache answers a window
+from an entry for one containing it.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from utils import week_window_to_show
+
+logger = logging.getLogger(__name__)
+
+## local midnight is at most 14 hours from UTC midnight
+WINDOW_MARGIN = timedelta(days=1)
+
+
+def upcoming_windows(count=2, window=week_window_to_show, margin=WINDOW_MARGIN):
+    """
+    The default calendar window and the count-1 windows after it, each
+    widened by margin at both ends, as (start, end) pairs
+    """
+    start, end = window()
+    return [(start - margin + timedelta(weeks=i), end + margin + timedelta(weeks=i)) for i in range(count)]
+
+
+class Prewarmer:
+    """
+    A thread that keeps the availability cache filled for every coach over
+    the upcoming windows
+
+    Every interval seconds it sweeps the coaches from get_coaches(),
+    refreshing windows that aren't cached or would expire before the next
+    sweep, so the cache's ttl should be longer than the interval. In
+    between, people whose entries were invalidated are refreshed as soon
+    as they're noticed. At most concurrency refreshes run at once, each
+    taking a DB connection.
+
+    Lag is the time from a coach's entries being invalidated, or a sweep
+    starting, to them being cached again.
+    """
+    def __init__(self, db, cache, interval=60.0, concurrency=4, windows=2, clock=time.monotonic,
+                 window=week_window_to_show):
+        """
+        :param db: an events.PostgresDataStore
+        :param cache: the cache.AvailabilityCache db serves blocks from
+        :param interval: seconds between sweeps over all coaches
+        :param concurrency: maximum number of windows computed at once
+        :param windows: number of windows to keep warm, starting from the default one
+        :param window: function returning the default window
+        """
+        self.db = db
+        self.cache = cache
+        self.interval = interval
+        self.concurrency = concurrency
+        self.windows = windows
+        self.clock = clock
+        self.window = window
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._dirty = {}            ## person_id -> when first invalidated since last refreshed
+        self._coaches = set()
+        self._stopping = False
+        self._thread = None
+        self._next_sweep = None
+        self._refreshes = 0
+        self._errors = 0
+        self._sweeps = 0
+        self._last_sweep_seconds = 0.0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        cache.add_listener(self._invalidated)
+
+    def _invalidated(self, person_id, start_time, end_time):
+        with self._lock:
+            if person_id in self._coaches:
+                self._dirty.setdefault(person_id, self.clock())
+                self._wakeup.notify()
+
+    def refresh(self, coach_id, start_time, end_time):
+        """
+        Compute a coach's blocks for a window and cache them, unless the
+        coach was invalidated meanwhile, in which case they're refreshed
+        again on the next round
+        """
+        version = self.cache.version(coach_id)
+        blocks = self.db.compute_appointments(coach_id, start_time, end_time)
+        self.cache.put(coach_id, start_time, end_time, blocks, version=version)
+
+    def _run_all(self, jobs):
+        """
+        Refresh a list of (coach_id, start_time, end_time), at most
+        concurrency at a time
+        """
+        if not jobs:
+            return
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [(job, executor.submit(self.refresh, *job)) for job in jobs]
+            for job, future in futures:
+                try:
+                    future.result()
+                    refreshed = True
+                except Exception:
+                    logger.exception("prewarming coach %s %s to %s failed", *job)
+                    refreshed = False
+                with self._lock:
+                    if refreshed:
+                        self._refreshes += 1
+                    else:
+                        self._errors += 1
+
+    def _observe_lag(self, since):
+        lag = self.clock() - since
+        with self._lock:
+            self._last_lag = lag
+            self._max_lag = max(self._max_lag, lag)
+
+    def sweep(self):
+        """
+        Refresh every coach's windows that are missing or would expire
+        before the next sweep
+        """
+        started = self.clock()
+        coaches = [coach['id'] for coach in self.db.get_coaches()]
+        with self._lock:
+            self._coaches = set(coaches)
+        jobs = [(coach_id, start_time, end_time)
+                for start_time, end_time in upcoming_windows(self.windows, self.window)
+                for coach_id in coaches
+                if (self.cache.expires_in(coach_id, start_time, end_time) or 0) <= self.interval]
+        self._run_all(jobs)
+        elapsed = self.clock() - started
+        with self._lock:
+            self._sweeps += 1
+            self._last_sweep_seconds = elapsed
+        if jobs:
+            self._observe_lag(started)
+
+    def refresh_dirty(self):
+        """
+        Refresh the windows of the coaches invalidated since last time
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        windows = upcoming_windows(self.windows, self.window)
+        self._run_all([(coach_id, start_time, end_time)
+                       for coach_id in dirty for start_time, end_time in windows
+                       if self.cache.expires_in(coach_id, start_time, end_time) is None])
+        self._observe_lag(min(dirty.values()))
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not (self._stopping or self._dirty or self.clock() >= self._next_sweep):
+                    self._wakeup.wait(max(self._next_sweep - self.clock(), 0))
+                if self._stopping:
+                    return
+                sweep_due = self.clock() >= self._next_sweep
+                if sweep_due:
+                    self._next_sweep = self.clock() + self.interval
+            try:
+                if sweep_due:
+                    self.sweep()
+                self.refresh_dirty()
+            except Exception:
+                ## e.g. the DB being down for get_coaches, try again next sweep
+                logger.exception("prewarming failed")
+                with self._lock:
+                    self._errors += 1
+
+    def start(self):
+        self._next_sweep = self.clock()
+        self._thread = threading.Thread(target=self.run, name='prewarm', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Return a dict of refresh counters, the backlog of invalidated
+        coaches and how long refreshing has been taking
+        """
+        with self._lock:
+            oldest = min(self._dirty.values()) if self._dirty else None
+            return {
+                'coaches': len(self._coaches),
+                'sweeps': self._sweeps,
+                'refreshes': self._refreshes,
+                'errors': self._errors,
+                'pending': len(self._dirty),
+                'pending_lag_s': self.clock() - oldest if oldest is not None else 0.0,
+                'last_lag_s': self._last_lag,
+                'max_lag_s': self._max_lag,
+                'last_sweep_s': self._last_sweep_seconds,
+            }
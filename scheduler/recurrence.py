@@ -0,0 +1,92 @@
+"""
+Recurring availability, stored as rules and expanded on demand
+"""
+import heapq
+from datetime import timedelta
+from dateutil.rrule import rrulestr
+from dateutil.tz import gettz
+
+
+class AvailabilityRule:
+    """
+    A recurring block of time during which a person, typically a coach, is
+    available for appointments. Stands in for the many 'schedulable' events
+    it would otherwise take to represent the same availability.
+
+    Occurrences follow an RFC 5545 RRULE anchored at dtstart in the person's
+    local time zone, so they keep the same wall clock time across daylight
+    saving changes. Local dates in exdates, such as holidays, are skipped.
+    """
+
+    def __init__(self, person_id, dtstart, duration, rrule, tzid='UTC', exdates=(), id=None):
+        """
+        :param person_id: the person who is available
+        :param dtstart: a naive datetime, the local start time of the first occurrence
+        :param duration: a timedelta, the length of each occurrence
+        :param rrule: a recurrence rule such as 'FREQ=WEEKLY;BYDAY=MO,WE,FR'
+        :param tzid: name of the time zone dtstart is in
+        :param exdates: local dates on which there is no occurrence
+        :param id: primary key from DB
+        """
+        self.id = id
+        self.person_id = person_id
+        self.dtstart = dtstart
+        self.duration = duration
+        self.rrule = rrule
+        self.tzid = tzid
+        self.exdates = list(exdates or ())
+
+    def __repr__(self):
+        return "AvailabilityRule(person_id=%s, dtstart=%s, duration=%s, rrule=%s, tzid=%s%s)" % (
+            self.person_id, self.dtstart, self.duration, self.rrule, self.tzid,
+            ", exdates=%s" % self.exdates if self.exdates else '')
+
+    def __eq__(self, other):
+        if not isinstance(other, AvailabilityRule):
+            return NotImplemented
+        return self.__dict__ == other.__dict__
+
+    def occurrences(self, start_time, end_time):
+        """
+        Generate, in order, the (start, end) times in UTC of the occurrences
+        that overlap the given window
+
+        :param start_time: a naive datetime in UTC
+        :param end_time: a naive datetime in UTC
+        """
+        tz = gettz(self.tzid)
+        if tz is None:
+            raise ValueError("unknown time zone %r" % self.tzid)
+        exdates = set(self.exdates)
+        rule = rrulestr(self.rrule, dtstart=self.dtstart)
+
+        ## local time is within a day of UTC, so start looking a day (plus
+        ## an occurrence) early and stop a day late
+        lo = start_time - self.duration - timedelta(days=1)
+        hi = end_time + timedelta(days=1)
+        for local_start in rule.xafter(lo, inc=True):
+            if local_start > hi:
+                break
+            if local_start.date() in exdates:
+                continue
+            local_end = local_start + self.duration
+            s = local_start - tz.utcoffset(local_start)
+            e = local_end - tz.utcoffset(local_end)
+            if e > start_time and s < end_time:
+                yield s, e
+
+
+def expand_rules(rules, start_time, end_time):
+    """
+    Lazily expand availability rules into the occurrences that overlap a
+    window, merged into start time order
+
+    :param rules: AvailabilityRule objects
+    :param start_time: a naive datetime in UTC
+    :param end_time: a naive datetime in UTC
+    :return: a generator of (start, end, person_id) tuples
+    """
+    def occurrences(rule):
+        for s, e in rule.occurrences(start_time, end_time):
+            yield s, e, rule.person_id
+    return heapq.merge(*[occurrences(rule) for rule in rules])
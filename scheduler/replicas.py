@@ -0,0 +1,150 @@
+"""
+Routing reads to read replicas
+
+Reads that can tolerate a little replication lag go to replica connection
+pools in turn, skipping any that recently failed, while writes and any
+read that must see them go to the primary. A read is sent to the primary
+instead when:
+
+ - the thread is pinned to it with begin(), as the app does for a while
+   after a client writes, so the client sees its own booking
+ - it concerns someone whose calendar was written through this process in
+   the last pin_seconds, so what it reads, and the availability cache, is
+   never older than the write
+ - no replica is up
+
+Within begin() and end(), as around a request, every read on the thread
+goes to the same replica, which only moves forward in time, so a sync
+token or version read early in a request is never newer than the data
+read after it. Outside of them each read picks a replica of its own.
+"""
+import threading
+import time
+import psycopg2
+
+_local = threading.local()
+
+
+class ReplicaRouter:
+    """
+    Health-checked round robin over replica pools
+
+    A replica whose pool fails to hand out a connection is marked down and
+    skipped for retry_after seconds, after which the next read tries it
+    again. Thread safe.
+    """
+    def __init__(self, pools, pin_seconds=5.0, retry_after=30.0, clock=time.monotonic):
+        """
+        :param pools: a pool.ConnectionPool for each replica
+        :param pin_seconds: how long after a write reads about the people written go to the primary
+        :param retry_after: seconds a failed replica is skipped for
+        :param clock: function returning the current time in seconds
+        """
+        self.pools = list(pools)
+        self.pin_seconds = pin_seconds
+        self.retry_after = retry_after
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down_until = {}       ## index of a pool -> when to try it again
+        self._written = {}          ## person_id -> when reads may go to replicas again
+        self._reads = [0] * len(self.pools)
+        self._primary_reads = 0
+        self._failures = 0
+
+    def begin(self, pinned=False):
+        """
+        Start a series of reads on this thread that should see a consistent
+        state, all on the primary if pinned, else on one replica
+        """
+        _local.pinned = pinned
+        _local.sticky = True
+        _local.pool = None
+
+    def end(self):
+        _local.pinned = False
+        _local.sticky = False
+        _local.pool = None
+
+    def save(self):
+        """
+        This thread's routing between begin() and end(), to restore() where
+        the same series of reads carries on, as in a streamed response body
+        """
+        return getattr(_local, 'pinned', False), getattr(_local, 'sticky', False), getattr(_local, 'pool', None)
+
+    def restore(self, state):
+        _local.pinned, _local.sticky, _local.pool = state
+
+    def wrote(self, person_ids):
+        """
+        Note that the people's calendars were just written
+        """
+        until = self.clock() + self.pin_seconds
+        with self._lock:
+            now = self.clock()
+            for person_id in person_ids:
+                self._written[person_id] = until
+            ## forget writes old enough not to matter
+            if len(self._written) > 1000:
+                self._written = {person_id: t for person_id, t in self._written.items() if t > now}
+
+    def choose(self, person_ids=()):
+        """
+        The pool of the replica to read from, or None to read from the primary
+        """
+        now = self.clock()
+        with self._lock:
+            if getattr(_local, 'pinned', False) or any(self._written.get(person_id, 0) > now
+                                                     for person_id in person_ids):
+                self._primary_reads += 1
+                return None
+            pool = getattr(_local, 'pool', None)
+            if pool is not None:
+                index = self.pools.index(pool)
+                if self._down_until.get(index, 0) <= now:
+                    self._reads[index] += 1
+                    return pool
+                ## another replica could be further behind, the primary can't be
+                self._primary_reads += 1
+                return None
+            for i in range(len(self.pools)):
+                index = (self._next + i) % len(self.pools)
+                if self._down_until.get(index, 0) <= now:
+                    self._next = index + 1
+                    self._reads[index] += 1
+                    if getattr(_local, 'sticky', False):
+                        _local.pool = self.pools[index]
+                    return self.pools[index]
+            self._primary_reads += 1
+            return None
+
+    def mark_down(self, pool):
+        with self._lock:
+            self._down_until[self.pools.index(pool)] = self.clock() + self.retry_after
+            self._failures += 1
+
+    def getconn(self, person_ids=()):
+        """
+        A connection from a replica that is up, marking down any that
+        fail, or (None, None) if the read should go to the primary
+
+        :return: (pool, connection)
+        """
+        while True:
+            pool = self.choose(person_ids)
+            if pool is None:
+                return None, None
+            try:
+                return pool, pool.getconn()
+            except (psycopg2.Error, OSError):
+                self.mark_down(pool)
+
+    def stats(self):
+        now = self.clock()
+        with self._lock:
+            return {'replicas': len(self.pools),
+                    'healthy': sum(1 for i in range(len(self.pools)) if self._down_until.get(i, 0) <= now),
+                    'replica_reads': sum(self._reads),
+                    'primary_reads': self._primary_reads,
+                    'failures': self._failures}
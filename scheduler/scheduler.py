@@ -2,17 +2,28 @@
 Flask web service endpoints for the Scheduler app.
 """
 import json
+import math
 import os
 import psycopg2
 import time
 from psycopg2.extras import DictCursor
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-                  render_template, jsonify, send_from_directory, send_file
-from utils import week_window_to_show, ScheldulerJSONEncoder
-from events import PostgresDataStore, NonExistantIdError
+                  render_template, jsonify, send_from_directory, send_file, stream_with_context
+from utils import week_window_to_show, events_to_json, iter_events_json, iter_events_ndjson, calendar_etag, \
+                  ScheldulerJSONEncoder, ScheldulerJSONProvider
+from events import PostgresDataStore, NonExistantIdError, BookingConflictError
+from memory_store import InMemoryDataStore
+from pool import ConnectionPool
+from replicas import ReplicaRouter
+from cache import AvailabilityCache
+from prewarm import Prewarmer
+import instrumentation
+from instrumentation import Metrics, SlowRequestProfiler, TimingCursor, span
 
 app = Flask(__name__, static_url_path='/static/')
 app.json_encoder = ScheldulerJSONEncoder
+if ScheldulerJSONProvider is not None:
+    app.json = ScheldulerJSONProvider(app)
 
 
 ## read config file
@@ -20,21 +31,163 @@ config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.j
 with open(config_path) as f:
     config = json.loads(f.read())
 
-## initialize DB connectivity
-db = PostgresDataStore(config['db_connect'])
+## the data store is Postgres unless the config asks for an in-memory one,
+## for trying out the API and benchmarking without a database
+data_store = config.get('data_store', 'postgres')
+if data_store not in ('postgres', 'memory'):
+    raise ValueError("unknown data store %r" % data_store)
 
+## initialize DB connectivity, sharing one pool of connections
+## across all request threads if the config asks for one
+pool = None
+if data_store == 'postgres' and 'pool' in config:
+    pool = ConnectionPool(config['db_connect'], cursor_factory=DictCursor, **config['pool'])
+## optionally send reads to read replicas, each with a pool like the primary's
+replicas = None
+if data_store == 'postgres' and 'replicas' in config:
+    replicas = ReplicaRouter([ConnectionPool(dsn, cursor_factory=DictCursor, **config.get('pool', {}))
+                              for dsn in config['replicas']['db_connect']],
+                             pin_seconds=config['replicas'].get('pin_seconds', 5.0),
+                             retry_after=config['replicas'].get('retry_after', 30.0))
+## optionally cache coaches' availability in this process
+availability_cache = None
+if 'availability_cache' in config:
+    availability_cache = AvailabilityCache(**config['availability_cache'])
+
+## optionally time each request, for Server-Timing headers and /metrics,
+## and profile a sample of requests, keeping the profiles of slow ones
+instrumentation_config = config.get('instrumentation')
+metrics = Metrics()
+profiler = None
+if instrumentation_config is not None and 'slow_request_threshold' in instrumentation_config:
+    profiler = SlowRequestProfiler(instrumentation_config['slow_request_threshold'],
+                                   sample_rate=instrumentation_config.get('profile_sample_rate', 1.0),
+                                   directory=instrumentation_config.get('profile_dir'))
+
+if data_store == 'memory':
+    db = InMemoryDataStore(slot_engine=config.get('slot_engine', 'python'),
+                           availability_cache=availability_cache)
+    ## optionally start from people, events and availability rules in a JSON file
+    fixture = config.get('memory_store', {}).get('fixture')
+    if fixture:
+        with open(os.path.join(os.path.dirname(config_path), fixture)) as f:
+            db.load(json.loads(f.read()))
+    prepared = None
+else:
+    db = PostgresDataStore(config['db_connect'], pool=pool,
+                           cursor_factory=DictCursor if instrumentation_config is None else TimingCursor,
+                           slot_engine=config.get('slot_engine', 'python'),
+                           availability_cache=availability_cache,
+                           prepared_statements=config.get('prepared_statements', False),
+                           replicas=replicas)
+    prepared = db.prepared
+
+## optionally keep every coach's upcoming windows in the availability cache
+## from a background thread, so the first client to open a week finds them
+prewarmer = None
+if availability_cache is not None and 'prewarm' in config:
+    prewarmer = Prewarmer(db, availability_cache, **config['prewarm'])
+    prewarmer.start()
+
+
+if instrumentation_config is not None:
+    @app.before_request
+    def start_timing():
+        instrumentation.start_request()
+        g.profile = profiler.start() if profiler else None
+
+    def observe(timer, status_code):
+        elapsed = timer.elapsed()
+        if profiler:
+            profiler.finish(g.pop('profile', None), elapsed, request.path)
+        metrics.observe(request.url_rule.rule if request.url_rule else 'unmatched',
+                        request.method, status_code, timer,
+                        slow=profiler is not None and elapsed >= profiler.threshold)
+
+    @app.after_request
+    def finish_timing(response):
+        if g.get('streaming'):
+            ## timed once the body has been sent, in stop_timing
+            g.status_code = response.status_code
+            return response
+        timer = instrumentation.finish_request()
+        if timer is None:
+            return response
+        observe(timer, response.status_code)
+        if instrumentation_config.get('server_timing', True):
+            response.headers['Server-Timing'] = timer.server_timing()
+        return response
+
+    @app.teardown_request
+    def stop_timing(exc):
+        if g.get('streaming'):
+            return
+        timer = instrumentation.finish_request()
+        status_code = g.pop('status_code', None)
+        if timer is not None and status_code is not None:
+            observe(timer, status_code if exc is None else 500)
+        ## after_request is skipped when a request fails
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+
+
+if replicas is not None:
+    ## a client that wrote gets a cookie pinning its reads to the primary
+    ## until the replicas have caught up, even if its next request is
+    ## served by another process
+    PRIMARY_COOKIE = 'scheduler_primary'
+
+    @app.before_request
+    def route_reads():
+        replicas.begin(pinned=PRIMARY_COOKIE in request.cookies)
+
+    @app.after_request
+    def pin_writers(response):
+        if request.method in ('POST', 'PUT', 'DELETE') and response.status_code < 400:
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=int(math.ceil(replicas.pin_seconds)), httponly=True)
+        return response
+
+    @app.teardown_request
+    def stop_routing(exc):
+        if not g.get('streaming'):
+            replicas.end()
+
+
+def streamed(body, mimetype):
+    """
+    A response whose body is generated, reading from the DB, as it's sent.
+    That's after the view returns and, depending on the version of Flask,
+    after teardown_request has run once, so the replica routing and request
+    timer of the thread are carried over to the body and the teardown
+    functions leave them be until it's done. Its reads then go where the
+    rest of the request's did, to the primary if pinned or the same
+    replica, and are timed along with them.
+    """
+    routing = replicas.save() if replicas is not None else None
+    timer = instrumentation.current()
+
+    def generate():
+        if routing is not None:
+            replicas.restore(routing)
+        instrumentation.resume(timer)
+        try:
+            yield from body
+        finally:
+            g.streaming = False
+
+    g.streaming = True
+    return app.response_class(stream_with_context(generate()), mimetype=mimetype)
 
 
 ## hack for development purposes: serve static content via Flask
 @app.route('/', methods=['GET'])
 def root():
-    print('index.html requested')
     return send_file('static/index.html')
 
 ## hack for development purposes: serve static content via Flask
 @app.route('/js/<path:path>', methods=['GET'])
 def send_js(path):
-    print('%s requested'%path)
     return send_from_directory('static', path)
 
 
@@ -44,8 +197,11 @@ def api_coaches():
     Get the list of all coaches for populating menu
     """
     coaches = db.get_coaches()
-    print(coaches)
-    return jsonify(coaches)
+    response = jsonify(coaches)
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = config.get('coaches_max_age', 60)
+    return response.make_conditional(request)
 
 
 @app.route('/participants/<int:event_id>/', methods=['GET'])
@@ -59,10 +215,85 @@ def api_participants(event_id):
 @app.route('/calendar/<int:person_id>/<int:coach_id>/', methods=['GET'])
 def api_schedule_with_coach(person_id, coach_id):
     """
-    Client's view of a coach's schedule for browsing available appointments
+    Client's view of a coach's schedule for browsing available appointments.
+    With stream=json or stream=ndjson the events are streamed as they are
+    read from the DB, as a JSON array or one JSON object per line, which
+    keeps memory use flat for windows of many weeks.
+
+    The ETag changes whenever either person's events do, so a client
+    revalidating with If-None-Match gets a 304 without the slots being
+    computed again. The Sync-Token header is for getting later changes
+    from /sync/.
+    """
+    s,e = week_window_to_show(request.args)
+    stream = request.args.get('stream')
+    token, versions = db.get_sync_state((person_id, coach_id))
+    etag = calendar_etag(versions, person_id, coach_id, s, e, stream)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    elif stream == 'ndjson':
+        response = streamed(iter_events_ndjson(db.stream_calendar(person_id, coach_id, s, e)),
+                            mimetype='application/x-ndjson')
+    elif stream == 'json':
+        response = streamed(iter_events_json(db.stream_calendar(person_id, coach_id, s, e)),
+                            mimetype='application/json')
+    else:
+        events = db.get_calendar(person_id, coach_id, s, e)
+        with span('json'):
+            body = events_to_json(events)
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Sync-Token'] = str(token)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/sync/<int:person_id>/<int:coach_id>/', methods=['GET'])
+def api_sync(person_id, coach_id):
+    """
+    Changes to the client's view of a coach's schedule since the given
+    token, for the same from and to dates. See PostgresDataStore.get_changes.
+    Without a token, or with one that isn't valid, the whole calendar is
+    returned.
     """
     s,e = week_window_to_show(request.args)
-    return jsonify(db.get_calendar(person_id, coach_id, s, e))
+    token = request.args.get('token', type=int)
+    return jsonify(db.get_changes(person_id, coach_id, s, e, token=token))
+
+
+@app.route('/availability/search/', methods=['GET'])
+def api_search_availability():
+    """
+    The earliest open appointment slots with any coach, between the from
+    and to dates and limited to limit slots. If person_id is given, slots
+    that clash with that client's calendar are left out.
+    """
+    s,e = week_window_to_show(request.args)
+    limit = request.args.get('limit', 10, type=int)
+    person_id = request.args.get('person_id', type=int)
+    return app.response_class(events_to_json(db.search_availability(s, e, limit=limit, person_id=person_id)),
+                              mimetype='application/json')
+
+
+@app.route('/reports/utilization/', methods=['GET'])
+def api_utilization():
+    """
+    Coaches' open and booked appointment slots and the fraction booked, per
+    day, week or month between the from and to dates, for all coaches or
+    just coach_id. Read from pre-aggregated daily rollups, see
+    PostgresDataStore.get_utilization.
+    """
+    s,e = week_window_to_show(request.args)
+    period = request.args.get('period', 'day')
+    coach_id = request.args.get('coach_id', type=int)
+    try:
+        rows = db.get_utilization(s, e, period=period, coach_id=coach_id)
+    except ValueError as ex:
+        response = jsonify({'error-message':str(ex)})
+        response.status_code = 400
+        return response
+    return jsonify([dict(row, period=row['period'].isoformat()) for row in rows])
 
 
 @app.route('/event/', methods=['POST', 'PUT', 'DELETE'])
@@ -92,6 +323,50 @@ def api_event(event_id=None):
         raise ValueError('Unsupported method '+request.method)
 
 
+@app.route('/events/batch/', methods=['POST'])
+def api_events_batch():
+    """
+    Create many events at once from a JSON list of events, in one transaction.
+    Returns the new events with their IDs, in the order given.
+    """
+    return jsonify(db.create_events(request.get_json()))
+
+
+@app.route('/stats/', methods=['GET'])
+def api_stats():
+    """
+    Operational counters for sizing the connection pool and availability
+    cache, how far behind prewarming is and where reads went
+    """
+    return jsonify({'pool': pool.stats() if pool else None,
+                    'availability_cache': availability_cache.stats() if availability_cache else None,
+                    'prepared_statements': prepared.stats() if prepared else None,
+                    'prewarm': prewarmer.stats() if prewarmer else None,
+                    'replicas': replicas.stats() if replicas else None,
+                    'replica_pools': [replica_pool.stats() for replica_pool in replicas.pools] if replicas else None})
+
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    """
+    Request, query and span timings, with the pool and availability cache
+    stats, for Prometheus to scrape. Request timings are only collected if
+    the config has an instrumentation section.
+    """
+    gauges = {}
+    if pool:
+        gauges['pool'] = pool.stats()
+    if availability_cache:
+        gauges['availability_cache'] = availability_cache.stats()
+    if prepared:
+        gauges['prepared_statements'] = prepared.stats()
+    if prewarmer:
+        gauges['prewarm'] = prewarmer.stats()
+    if replicas:
+        gauges['replicas'] = replicas.stats()
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 @app.errorhandler(NonExistantIdError)
 def handle_bad_request(ex):
     """
@@ -102,6 +377,17 @@ def handle_bad_request(ex):
     return response
 
 
+@app.errorhandler(BookingConflictError)
+def handle_booking_conflict(ex):
+    """
+    The time asked for was taken in the meantime. The client can refresh
+    its calendar and try another slot.
+    """
+    response = jsonify({'error-message':str(ex), 'conflicts':ex.conflicts})
+    response.status_code = 409
+    return response
+
+
 
 if __name__ == "__main__":
     app.run(debug=True, use_debugger=True, use_reloader=True)
@@ -0,0 +1,159 @@
+"""
+Stand-ins for the clock, connections and pools the tests run against
+"""
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, args=None):
+        if self.connection.fail is not None:
+            ex, self.connection.fail = self.connection.fail, None
+            raise ex
+        self.connection.sent.append((query, args))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Stands in for a psycopg2 connection, recording the queries sent through
+    its cursors. Set lost to have commit fail as on a dropped connection and
+    fail to an exception for the next query to raise
+    """
+    def __init__(self, connect_string='', **kwargs):
+        self.connect_string = connect_string
+        self.kwargs = kwargs
+        self.sent = []
+        self.commits = 0
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.lost = False
+        self.fail = None
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.lost:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.commits += 1
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool:
+    """
+    Stands in for a psycopg2 pool; set down to have getconn fail as if the
+    server can't be reached
+    """
+    def __init__(self, name):
+        self.name = name
+        self.down = False
+        self.out = 0
+
+    def getconn(self):
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to %s" % self.name)
+        self.out += 1
+        return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        self.out -= 1
+
+
+class FakeTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.conn.outcome = 'commit' if exc_type is None else 'rollback'
+        return False
+
+
+class FakeAsyncConnection:
+    """
+    Stands in for an asyncpg connection. Records the queries sent, answering
+    those containing a fragment of SQL in results with its rows and any
+    others with none
+    """
+    def __init__(self, results):
+        self.results = results
+        self.sent = []
+        self.outcome = None
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def execute(self, query, *args):
+        self.sent.append((query, args))
+
+    async def executemany(self, query, args):
+        self.sent.extend((query, tuple(a)) for a in args)
+
+    async def fetch(self, query, *args):
+        self.sent.append((query, args))
+        for fragment, rows in self.results.items():
+            if fragment in query:
+                return rows
+        return []
+
+    async def fetchrow(self, query, *args):
+        rows = await self.fetch(query, *args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query, *args):
+        row = await self.fetchrow(query, *args)
+        return row[0] if row else None
+
+
+class FakeAsyncPool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class Row(dict):
+    """
+    A row that can be indexed by position as well as by name, as asyncpg's are
+    """
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return dict.__getitem__(self, key)
@@ -0,0 +1,70 @@
+"""
+Test the asyncpg data store against a local Postgres, comparing it with
+the synchronous PostgresDataStore
+"""
+import asyncio
+import os
+import json
+from datetime import datetime, timedelta
+from events import PostgresDataStore
+from async_events import AsyncPostgresDataStore, asyncpg_connect_args
+
+config = None
+
+def setup_module():
+    global config
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../config.json')
+    with open(config_path) as f:
+        config = json.loads(f.read())
+
+
+def test_connect_args():
+    args = asyncpg_connect_args("dbname='scheduler' user='me' host='localhost' port=5433 password='x y'")
+    assert args == {'database': 'scheduler', 'user': 'me', 'host': 'localhost', 'port': 5433, 'password': 'x y'}
+
+
+def test_event_crud():
+    async def crud():
+        db = await AsyncPostgresDataStore(config['db_connect']).open()
+        try:
+            event = await db.create_event(start_time=datetime(2017,4,28,12,00),
+                                          end_time=datetime(2017,4,28,14,00),
+                                          name="Chris's Birthday Party",
+                                          type='event',
+                                          participants=[1,2,3])
+            assert await db.get_event(event.id) == event
+
+            event3 = await db.update_event(id=event.id, start_time=event.start_time, end_time=event.end_time,
+                                           name="Chris's Huge Birthday Party", notes=None, type='event',
+                                           participants=[1,2,4])
+            assert event3.name == "Chris's Huge Birthday Party"
+            assert sorted(event3.participants) == [1,2,4]
+
+            await db.delete_event(event.id)
+            try:
+                await db.get_event(event.id)
+                assert False, "Should have raised ValueError"
+            except ValueError:
+                pass
+        finally:
+            await db.close()
+    asyncio.run(crud())
+
+
+def test_calendar_matches_sync_store():
+    sync_db = PostgresDataStore(config['db_connect'])
+    coach_id = sync_db.get_coaches()[0]['id']
+    with sync_db._cursor() as curs:
+        curs.execute("SELECT client_id FROM relationship WHERE coach_id=%s LIMIT 1", (coach_id,))
+        person_id = curs.fetchone()[0]
+    start_time = datetime.now()
+    end_time = start_time + timedelta(weeks=2)
+    expected = sync_db.get_calendar(person_id, coach_id, start_time, end_time)
+
+    async def calendar():
+        db = await AsyncPostgresDataStore(config['db_connect']).open()
+        try:
+            return await db.get_calendar(person_id, coach_id, start_time, end_time)
+        finally:
+            await db.close()
+    assert asyncio.run(calendar()) == expected
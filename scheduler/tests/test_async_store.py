@@ -0,0 +1,102 @@
+"""
+Test the asyncpg data store's writes against stand-in connections
+"""
+import asyncio
+from datetime import datetime
+from events import Event, BookingConflictError
+from async_events import AsyncPostgresDataStore, check_bookings
+from fakes import FakeAsyncConnection, FakeAsyncPool, Row
+
+
+def make_store(results):
+    conn = FakeAsyncConnection(results)
+    db = AsyncPostgresDataStore('dbname=test')
+    db.pool = FakeAsyncPool(conn)
+    return db, conn
+
+
+def sent(conn, fragment):
+    return [args for query, args in conn.sent if fragment in query]
+
+
+def test_create_event():
+    start_time, end_time = datetime(2017,5,4,10,00), datetime(2017,5,4,11,00)
+    db, conn = make_store({'INSERT INTO event': [(42, start_time)],
+                           'UPDATE person SET version': [{'id': 1, 'coach': True}, {'id': 3, 'coach': False}]})
+    event = asyncio.run(db.create_event(start_time=start_time, end_time=end_time, name='Session',
+                                        type='coaching', participants=[3, 1]))
+    assert (event.id, event.type, event.participants) == (42, 'coaching', [3, 1])
+    assert conn.outcome == 'commit'
+
+    ## the participants are locked before the booking is checked
+    assert 'FROM person' in conn.sent[0][0]
+    assert conn.sent[0][1] == ([1, 3],)
+    assert 'SELECT DISTINCT e.id' in conn.sent[1][0]
+
+    assert sent(conn, 'INSERT INTO participant') == [(42, 3, start_time), (42, 1, start_time)]
+    assert sent(conn, 'INSERT INTO event_change') == [(3, 42, 'create', start_time, end_time),
+                                                     (1, 42, 'create', start_time, end_time)]
+    assert sent(conn, 'UPDATE person SET version') == [([1, 3],)]
+    ## coach 1's utilization rollup is refreshed for the day around the event
+    assert [args[0] for args in sent(conn, 'DELETE FROM coach_daily_rollup')] == [1]
+
+
+def test_create_event_conflict():
+    db, conn = make_store({'SELECT DISTINCT e.id': [{'id': 7}]})
+    try:
+        asyncio.run(db.create_event(start_time=datetime(2017,5,4,10,00), end_time=datetime(2017,5,4,11,00),
+                                    type='coaching', participants=[1, 3]))
+        assert False, "double booked"
+    except BookingConflictError as ex:
+        assert ex.conflicts == [7]
+    assert conn.outcome == 'rollback'
+    assert sent(conn, 'INSERT INTO event') == []
+
+
+def test_update_event_locks():
+    start_time, end_time = datetime(2017,5,4,10,00), datetime(2017,5,4,11,00)
+    db, conn = make_store({
+        'FOR UPDATE': [(start_time,)],
+        'FROM event_start s': [{'id': 7, 'type': 'coaching', 'start_time': start_time, 'end_time': end_time,
+                                'name': None, 'notes': None}],
+        'FROM participant': [{'event_id': 7, 'person_id': 5}],
+        'UPDATE event': [(start_time,)]})
+    asyncio.run(db.update_event(7, start_time, end_time, None, None, 'coaching', participants=[3]))
+
+    ## the event is locked before it's read
+    assert 'FROM event_start WHERE id' in conn.sent[0][0]
+    assert 'FROM event_start s' in conn.sent[1][0]
+
+    ## the person taken off the event is locked with the new participant,
+    ## in ID order, before the booking check
+    assert 'FROM person' in conn.sent[3][0]
+    assert conn.sent[3][1] == ([3, 5],)
+    assert 'SELECT DISTINCT e.id' in conn.sent[4][0]
+
+    ## participants are deleted from the partition the event is in
+    assert sent(conn, 'DELETE FROM participant') == [(7, 5, start_time)]
+
+
+def test_check_bookings_locks():
+    start_time, end_time = datetime(2017,5,4,10,00), datetime(2017,5,4,11,00)
+    db, conn = make_store({})
+    events = [Event(id=1, start_time=start_time, end_time=end_time, type='coaching', participants=[4]),
+              Event(id=2, start_time=start_time, end_time=end_time, type='schedulable', participants=[6, 2])]
+    asyncio.run(check_bookings(conn, events))
+    ## everyone the batch touches, not just the bookings' participants
+    assert conn.sent[0][1] == ([2, 4, 6],)
+
+
+def test_sync_state_and_changes():
+    start_time, end_time = datetime(2017,5,1), datetime(2017,5,8)
+    db, conn = make_store({'txid_current_snapshot': [Row(token=9, id=1, version=3), Row(token=9, id=4, version=0)],
+                           'FROM event_change': [Row(person_id=1, event_id=7, op='delete',
+                                                     start_time=datetime(2017,5,9), end_time=datetime(2017,5,10))]})
+    assert asyncio.run(db.get_sync_state((1, 4))) == (9, {1: 3, 4: 0})
+    assert sent(conn, 'txid_current_snapshot') == [([1, 4],)]
+
+    ## a change to an event outside the window deletes it from the view
+    ## without any slots being recomputed
+    changes = asyncio.run(db.get_changes(1, 4, start_time, end_time, token=8))
+    assert changes == {'token': 9, 'reset': False, 'events': [], 'deleted': [7], 'ranges': [], 'slots': []}
+    assert sent(conn, 'FROM event_change') == [([1, 4], 8)]
@@ -0,0 +1,97 @@
+from datetime import date, datetime, timedelta
+from events import Event, divide_into_blocks
+from cache import AvailabilityCache
+from fakes import Clock
+
+
+def blocks_for(day, hours=4):
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=9)
+    return list(divide_into_blocks(Event(start_time=start, end_time=start+timedelta(hours=hours), type='schedulable')))
+
+
+def test_hit_and_miss():
+    cache = AvailabilityCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return blocks_for(date(2020,4,6))
+
+    first = cache.get_or_compute(1, date(2020,4,5), date(2020,4,12), compute)
+    second = cache.get_or_compute(1, datetime(2020,4,5), datetime(2020,4,12), compute)
+    assert first == second
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['blocks']) == (1, 1, 1, 4)
+
+
+def test_ttl():
+    clock = Clock()
+    cache = AvailabilityCache(ttl=10, clock=clock)
+    cache.put(1, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+    clock.now = 9
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is not None
+    clock.now = 11
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_containing_window():
+    cache = AvailabilityCache()
+    cache.put(1, date(2020,4,4), date(2020,4,13), blocks_for(date(2020,4,5)) + blocks_for(date(2020,4,12)))
+
+    ## a window inside a cached one gets the blocks overlapping it
+    blocks = cache.get(1, datetime(2020,4,5,10), datetime(2020,4,12,10))
+    assert [block.start_time for block in blocks] == [datetime(2020,4,5,10), datetime(2020,4,5,11),
+                                                      datetime(2020,4,5,12), datetime(2020,4,12,9)]
+    assert cache.get(1, date(2020,4,11), date(2020,4,14)) is None
+    assert cache.get(2, date(2020,4,5), date(2020,4,12)) is None
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+
+def test_lru_eviction():
+    cache = AvailabilityCache(max_blocks=10)
+    cache.put(1, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+    cache.put(2, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+    ## touch coach 1 so coach 2 is least recently used
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is not None
+    cache.put(3, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+    assert cache.get(2, date(2020,4,5), date(2020,4,12)) is None
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['blocks'] <= 10
+
+
+def test_invalidate_overlapping_only():
+    cache = AvailabilityCache()
+    cache.put(1, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+    cache.put(1, date(2020,4,12), date(2020,4,19), blocks_for(date(2020,4,13)))
+    cache.put(2, date(2020,4,5), date(2020,4,12), blocks_for(date(2020,4,6)))
+
+    cache.invalidate_event(Event(start_time=datetime(2020,4,6,10), end_time=datetime(2020,4,6,11),
+                                 type='coaching', participants=[1, 7]))
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is None
+    assert cache.get(1, date(2020,4,12), date(2020,4,19)) is not None
+    assert cache.get(2, date(2020,4,5), date(2020,4,12)) is not None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_invalidate_blocks_outside_window():
+    ## a schedulable event straddling the window end gives blocks past it
+    cache = AvailabilityCache()
+    cache.put(1, datetime(2020,4,6,0), datetime(2020,4,6,10), blocks_for(date(2020,4,6)))
+    cache.invalidate(1, '2020-04-06T11:30:00Z', '2020-04-06T12:30:00Z')
+    assert cache.get(1, datetime(2020,4,6,0), datetime(2020,4,6,10)) is None
+
+
+def test_stale_compute_not_stored():
+    cache = AvailabilityCache()
+
+    def compute():
+        ## a write lands while the blocks are being computed
+        cache.invalidate(1)
+        return blocks_for(date(2020,4,6))
+
+    cache.get_or_compute(1, date(2020,4,5), date(2020,4,12), compute)
+    assert cache.get(1, date(2020,4,5), date(2020,4,12)) is None
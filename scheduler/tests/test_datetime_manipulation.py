@@ -1,5 +1,9 @@
-from events import Event, divide_into_blocks, appointments
-from datetime import datetime, timedelta
+import random
+from events import Event, ConflictIndex, divide_into_blocks, appointments, has_conflicts, remove_conflicting, \
+                   earliest_open_slots, stream_appointments, merge_ranges, daily_slot_counts, affected_days, \
+                   batch_conflicts, rule_days
+from recurrence import AvailabilityRule
+from datetime import date, datetime, timedelta
 
 
 def test_divide_into_blocks():
@@ -31,3 +35,144 @@ def test_blocks():
     # print('\nblocks:')
     # for block in blocks:
     #     print(' ', block)
+
+
+def test_conflicts():
+    events = [Event(start_time=datetime(2020,4,2,10,0), end_time=datetime(2020,4,2,17,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,2,11,0), end_time=datetime(2020,4,2,12,0), type='coaching'),
+              Event(start_time=datetime(2020,4,2,13,0), end_time=datetime(2020,4,2,15,30), type='coaching')]
+    index = ConflictIndex(events)
+    assert len(index) == 2
+
+    def block(h1, m1, h2, m2):
+        return Event(start_time=datetime(2020,4,2,h1,m1), end_time=datetime(2020,4,2,h2,m2), type='open slot')
+
+    ## touching end points don't conflict
+    assert not has_conflicts(block(10,0,11,0), events)
+    assert not has_conflicts(block(12,0,13,0), index)
+    assert not has_conflicts(block(15,30,16,30), index)
+    assert has_conflicts(block(11,30,12,30), index)
+    assert has_conflicts(block(15,0,16,0), index)
+    assert has_conflicts(block(9,0,18,0), index)
+    assert not has_conflicts(block(9,0,10,0), ConflictIndex([]))
+
+
+def test_conflicts_match_linear_scan():
+    rng = random.Random(1234)
+    t0 = datetime(2020,4,1)
+
+    def random_event(type):
+        start = t0 + timedelta(minutes=15*rng.randrange(0, 400))
+        return Event(start_time=start, end_time=start+timedelta(minutes=15*rng.randrange(0, 16)), type=type)
+
+    events = [random_event(rng.choice(('schedulable', 'coaching', 'event'))) for _ in range(200)]
+    index = ConflictIndex(events)
+    for _ in range(500):
+        query = random_event('open slot')
+        expected = any(e.type != 'schedulable' and
+                       e.start_time < query.end_time and
+                       e.end_time > query.start_time for e in events)
+        assert index.conflicts(query) == expected
+        assert remove_conflicting([query], events) == ([] if expected else [query])
+
+
+def test_batch_conflicts():
+    def event(id, h1, h2, type, participants):
+        return Event(id=id, start_time=datetime(2020,4,2,h1,0), end_time=datetime(2020,4,2,h2,0),
+                     type=type, participants=participants)
+
+    events = [event(1, 9, 17, 'schedulable', [1]),
+              event(2, 10, 11, 'coaching', [1, 3]),
+              event(3, 11, 12, 'coaching', [1, 4]),
+              event(4, 10, 12, 'event', [4]),
+              event(5, 13, 14, 'event', [5]),
+              event(6, 13, 14, 'coaching', [2, 6])]
+    ## touching end points, schedulable events and other people's events don't clash
+    assert [(e.id, [o.id for o in others]) for e, others in batch_conflicts(events)] == [(3, [4])]
+
+    events.append(event(7, 10, 13, 'coaching', [1, 5]))
+    assert [(e.id, [o.id for o in others]) for e, others in batch_conflicts(events)] == \
+        [(2, [7]), (3, [4, 7]), (7, [2, 3])]
+    assert batch_conflicts([]) == []
+
+
+def test_stream_appointments_match_appointments():
+    rng = random.Random(4321)
+    t0 = datetime(2020,4,1)
+
+    def random_event(type):
+        start = t0 + timedelta(minutes=30*rng.randrange(0, 300))
+        return Event(start_time=start, end_time=start+timedelta(minutes=30*rng.randrange(1, 10)), type=type)
+
+    events = sorted((random_event(rng.choice(('schedulable', 'coaching', 'event'))) for _ in range(300)),
+                    key=lambda event: event.start_time)
+    streamed = list(stream_appointments(iter(events)))
+    assert [b.start_time for b in streamed] == sorted(b.start_time for b in streamed)
+    key = lambda b: (b.start_time, b.end_time, b.type)
+    assert sorted(map(key, streamed)) == sorted(map(key, appointments(events)))
+    assert list(stream_appointments([])) == []
+
+
+def test_merge_ranges():
+    assert merge_ranges([]) == []
+    assert merge_ranges([(5, 7), (1, 2), (2, 3), (6, 9), (10, 11), (6, 8)]) == [(1, 3), (5, 9), (10, 11)]
+
+
+def test_daily_slot_counts():
+    events = [
+        Event(start_time=datetime(2020,4,1,22,0), end_time=datetime(2020,4,2,2,0), type='schedulable'),
+        Event(start_time=datetime(2020,4,2,0,30), end_time=datetime(2020,4,2,1,0), type='coaching'),
+        Event(start_time=datetime(2020,4,3,9,0), end_time=datetime(2020,4,3,11,0), type='schedulable')]
+    ## slots count toward the day they start on, and only within the window
+    assert daily_slot_counts(events, datetime(2020,4,1), datetime(2020,4,3)) == \
+        {date(2020,4,1): (2, 0), date(2020,4,2): (1, 1)}
+    assert daily_slot_counts(events, datetime(2020,4,1,23,0), datetime(2020,4,4)) == \
+        {date(2020,4,1): (1, 0), date(2020,4,2): (1, 1), date(2020,4,3): (2, 0)}
+
+    ## a booking just after midnight can change a slot starting the day before
+    booking = Event(start_time=datetime(2020,4,2,0,30), end_time=datetime(2020,4,2,1,0), type='coaching')
+    assert affected_days(booking) == (date(2020,4,1), date(2020,4,3))
+
+
+def test_rule_days():
+    ## a rule that ends only changes the days around its occurrences
+    rule = AvailabilityRule(person_id=1, dtstart=datetime(2020,4,6,9,0), duration=timedelta(hours=4),
+                            rrule='FREQ=WEEKLY;COUNT=3')
+    assert rule_days(rule, today=date(2020,4,1)) == (date(2020,4,6), date(2020,4,21))
+
+    ## one that doesn't, up to the horizon
+    rule.rrule = 'FREQ=DAILY'
+    assert rule_days(rule, today=date(2020,4,1)) == (date(2020,4,6), date(2021,4,6))
+
+    ## and one whose occurrences are all excluded changes none
+    rule.dtstart = datetime(2022,4,6,9,0)
+    rule.rrule = 'FREQ=DAILY;UNTIL=20220410'
+    rule.exdates = [date(2022,4,d) for d in range(6, 11)]
+    assert rule_days(rule, today=date(2020,4,1)) is None
+
+
+def test_event_slots():
+    event = Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,12,0), type='open slot')
+    assert not hasattr(event, '__dict__')
+    ## participants default isn't shared between events
+    event.participants.append(1)
+    assert Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,12,0), type='open slot').participants == []
+    assert event != Event(**dict(event.as_dict(), participants=[2]))
+    assert event == Event(**event.as_dict())
+
+
+def test_earliest_open_slots():
+    calendars = {
+        7: [Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,15,0), type='schedulable'),
+            Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,12,0), type='coaching')],
+        3: [Event(start_time=datetime(2020,4,1,12,0), end_time=datetime(2020,4,1,14,0), type='schedulable')],
+        5: [Event(start_time=datetime(2020,4,1,9,0), end_time=datetime(2020,4,1,10,0), type='schedulable')]}
+    busy = [Event(start_time=datetime(2020,4,1,13,0), end_time=datetime(2020,4,1,14,0), type='event')]
+
+    slots = earliest_open_slots(calendars, datetime(2020,4,1,10,0), datetime(2020,4,2), limit=3, busy=busy)
+    assert [(s.start_time.hour, s.participants) for s in slots] == [(12, [3]), (12, [7]), (14, [7])]
+    assert all(s.type == 'open slot' for s in slots)
+
+    slots = earliest_open_slots(calendars, datetime(2020,4,1), datetime(2020,4,2))
+    assert [(s.start_time.hour, s.participants) for s in slots] == \
+        [(9, [5]), (12, [3]), (12, [7]), (13, [3]), (13, [7]), (14, [7])]
@@ -3,10 +3,23 @@ Test CRUD on Events
 """
 import os
 import json
-from events import Event, PostgresDataStore
-from datetime import datetime, timedelta
+from psycopg2.extras import DictCursor
+from events import Event, PostgresDataStore, BookingConflictError, NonExistantIdError
+from datetime import date, datetime, timedelta
 
 db = None
+counting_db = None
+
+
+class CountingCursor(DictCursor):
+    """
+    Cursor that counts the queries sent through it
+    """
+    queries = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.queries += 1
+        return super().execute(query, vars)
 
 def setup():
     global db
@@ -17,6 +30,8 @@ def setup():
 
     ## initialize DB connectivity
     db = PostgresDataStore(config['db_connect'])
+    global counting_db
+    counting_db = PostgresDataStore(config['db_connect'], cursor_factory=CountingCursor)
 
 def test_event():
     print("\ntest_event")
@@ -39,7 +54,7 @@ def test_event():
     event.notes = "Pizza and beer at Serious Pie Westlake, Seattle WA"
     event.name  = "Chris's Huge Birthday Party"
 
-    event3 = db.update_event(**event.__dict__)
+    event3 = db.update_event(**event.as_dict())
     print("updated:", event)
     assert event3.name == "Chris's Huge Birthday Party"
     assert event3.notes == "Pizza and beer at Serious Pie Westlake, Seattle WA"
@@ -55,3 +70,205 @@ def test_event():
         print("it's gone:", event)
 
 
+def test_events_between_query_count():
+    print("\ntest_events_between_query_count")
+    start = datetime(2017,5,1,9,00)
+    created = [db.create_event(start_time=start+timedelta(hours=i),
+                               end_time=start+timedelta(hours=i+1),
+                               name="Office hours %d" % i,
+                               type='event',
+                               participants=[1,2])
+               for i in range(10)]
+    try:
+        CountingCursor.queries = 0
+        events = counting_db.get_events_between(1, start, start+timedelta(hours=10))
+        assert [e.id for e in events] == [e.id for e in created]
+        assert all(e.participants == [1,2] for e in events)
+        ## one query for the events, one for all of their participants
+        assert CountingCursor.queries == 2
+
+        CountingCursor.queries = 0
+        event = counting_db.get_event(created[0].id)
+        assert event == created[0]
+        assert CountingCursor.queries == 2
+    finally:
+        for event in created:
+            db.delete_event(event.id)
+
+
+def test_create_events():
+    print("\ntest_create_events")
+    start = datetime(2017,5,2,9,00)
+    created = db.create_events(
+        [{'start_time': start+timedelta(hours=i), 'end_time': start+timedelta(hours=i+1),
+          'name': "Batch %d" % i, 'type': 'coaching', 'participants': [1, 2+i]} for i in range(5)] +
+        [Event(start_time=start, end_time=start+timedelta(hours=8), type='schedulable', participants=[1])])
+    try:
+        assert len(created) == 6
+        assert len({event.id for event in created}) == 6
+        for event in created:
+            assert db.get_event(event.id) == event
+        assert created[2].name == "Batch 2"
+        assert created[2].participants == [1, 4]
+    finally:
+        for event in created:
+            db.delete_event(event.id)
+
+
+def test_writes_bump_versions():
+    print("\ntest_writes_bump_versions")
+    before = db.get_versions([1, 2, 3])
+    event = db.create_event(start_time=datetime(2017,5,3,9,00), end_time=datetime(2017,5,3,10,00),
+                            type='coaching', participants=[1, 2])
+    created = db.get_versions([1, 2, 3])
+    assert created[1] > before[1] and created[2] > before[2]
+    assert created[3] == before[3]
+
+    db.update_event(**dict(event.as_dict(), participants=[1, 3]))
+    updated = db.get_versions([1, 2, 3])
+    assert all(updated[i] > created[i] for i in (1, 2, 3))
+
+    db.delete_event(event.id)
+    deleted = db.get_versions([1, 2, 3])
+    assert deleted[1] > updated[1] and deleted[3] > updated[3]
+    assert deleted[2] == updated[2]
+
+
+def test_get_changes():
+    print("\ntest_get_changes")
+    start, end = datetime(2017,5,7), datetime(2017,5,14)
+    coach_id, client_id = 1, 2
+    state = db.get_changes(client_id, coach_id, start, end)
+    assert state['reset']
+    assert db.get_changes(client_id, coach_id, start, end, token=state['token'])['events'] == []
+
+    schedulable = db.create_event(start_time=datetime(2017,5,8,9,00), end_time=datetime(2017,5,8,12,00),
+                                  type='schedulable', participants=[coach_id])
+    booked = db.create_event(start_time=datetime(2017,5,8,10,00), end_time=datetime(2017,5,8,11,00),
+                             type='coaching', participants=[coach_id, client_id])
+    try:
+        changes = db.get_changes(client_id, coach_id, start, end, token=state['token'])
+        assert not changes['reset']
+        assert changes['events'] == [booked]
+        assert changes['deleted'] == []
+        assert changes['ranges'] == [(datetime(2017,5,8,9,00), datetime(2017,5,8,12,00))]
+        assert [(slot.start_time.hour, slot.type) for slot in changes['slots']] == \
+            [(9, 'open slot'), (11, 'open slot')]
+
+        db.delete_event(booked.id)
+        changes = db.get_changes(client_id, coach_id, start, end, token=changes['token'])
+        assert changes['events'] == []
+        assert changes['deleted'] == [booked.id]
+        assert [slot.start_time.hour for slot in changes['slots']] == [10]
+    finally:
+        db.delete_event(schedulable.id)
+
+
+def test_utilization():
+    print("\ntest_utilization")
+    start, end = datetime(2017,5,15), datetime(2017,5,16)
+    coach_id, client_id = 1, 2
+    def counts():
+        rows = db.get_utilization(start, end, coach_id=coach_id)
+        return (rows[0]['open_slots'], rows[0]['booked_slots']) if rows else (0, 0)
+    before = counts()
+
+    schedulable = db.create_event(start_time=datetime(2017,5,15,9,00), end_time=datetime(2017,5,15,12,00),
+                                  type='schedulable', participants=[coach_id])
+    created = [schedulable]
+    try:
+        assert counts() == (before[0] + 3, before[1])
+        created.append(db.create_event(start_time=datetime(2017,5,15,10,00), end_time=datetime(2017,5,15,11,00),
+                                       type='coaching', participants=[coach_id, client_id]))
+        assert counts() == (before[0] + 2, before[1] + 1)
+
+        ## rebuilding from scratch gives the same numbers
+        db.rebuild_rollup(start, end, coach_ids=[coach_id])
+        assert counts() == (before[0] + 2, before[1] + 1)
+
+        months = db.get_utilization(datetime(2017,5,1), datetime(2017,6,1), period='month', coach_id=coach_id)
+        assert [row['period'] for row in months] == [date(2017,5,1)]
+        assert 0 < months[0]['utilization'] <= 1
+    finally:
+        for event in reversed(created):
+            db.delete_event(event.id)
+    assert counts() == before
+
+
+def test_partition_boundaries():
+    print("\ntest_partition_boundaries")
+    ## partitions for these months, unless events are already in the default ones
+    db.ensure_partitions(datetime(2017,8,1), datetime(2017,10,1))
+    event = db.create_event(start_time=datetime(2017,8,31,23,00), end_time=datetime(2017,9,1,1,00),
+                            type='coaching', participants=[1, 2])
+    try:
+        ## found from a window in the following month
+        assert [e.id for e in db.get_events_between(2, datetime(2017,9,1), datetime(2017,9,2))] == [event.id]
+
+        ## moving it to another month takes its participants along
+        moved = db.update_event(**dict(event.as_dict(), start_time=datetime(2017,10,2,9,00),
+                                       end_time=datetime(2017,10,2,10,00), participants=[1, 2, 3]))
+        assert sorted(moved.participants) == [1, 2, 3]
+        assert db.get_events_between(2, datetime(2017,9,1), datetime(2017,9,2)) == []
+        assert [e.id for e in db.get_events_between(3, datetime(2017,10,2), datetime(2017,10,3))] == [moved.id]
+        assert db.get_event(event.id).start_time == datetime(2017,10,2,9,00)
+
+        ## and back, dropping a participant, who's deleted from the new month
+        back = db.update_event(**dict(moved.as_dict(), start_time=datetime(2017,8,30,9,00),
+                                      end_time=datetime(2017,8,30,10,00), participants=[1, 2]))
+        assert sorted(back.participants) == [1, 2]
+        assert db.get_events_between(3, datetime(2017,8,30), datetime(2017,8,31)) == []
+    finally:
+        db.delete_event(event.id)
+    try:
+        db.get_event(event.id)
+        assert False, "Should have raised NonExistantIdError"
+    except NonExistantIdError:
+        pass
+
+
+def test_booking_conflicts():
+    print("\ntest_booking_conflicts")
+    booked = db.create_event(start_time=datetime(2017,5,4,10,00), end_time=datetime(2017,5,4,11,00),
+                             type='coaching', participants=[1, 2])
+    created = [booked]
+    try:
+        try:
+            db.create_event(start_time=datetime(2017,5,4,10,30), end_time=datetime(2017,5,4,11,30),
+                            type='coaching', participants=[1, 3])
+            assert False, "double booked"
+        except BookingConflictError as ex:
+            assert ex.conflicts == [booked.id]
+
+        ## touching end points don't clash and other types of event aren't checked
+        created.append(db.create_event(start_time=datetime(2017,5,4,11,00), end_time=datetime(2017,5,4,12,00),
+                                       type='coaching', participants=[1, 3]))
+        created.append(db.create_event(start_time=datetime(2017,5,4,10,00), end_time=datetime(2017,5,4,11,00),
+                                       type='event', participants=[2]))
+
+        try:
+            db.update_event(**dict(created[1].as_dict(), start_time=datetime(2017,5,4,10,00)))
+            assert False, "double booked"
+        except BookingConflictError:
+            pass
+        assert db.get_event(created[1].id) == created[1]
+
+        ## a batch is checked against the database and against itself
+        try:
+            db.create_events([Event(start_time=datetime(2017,5,4,10,30), end_time=datetime(2017,5,4,11,00),
+                                    type='coaching', participants=[1, 4])])
+            assert False, "double booked"
+        except BookingConflictError as ex:
+            assert ex.conflicts == [booked.id]
+        try:
+            db.create_events([Event(start_time=datetime(2017,5,4,14,00), end_time=datetime(2017,5,4,15,00),
+                                    type='coaching', participants=[1, 4]),
+                              Event(start_time=datetime(2017,5,4,14,30), end_time=datetime(2017,5,4,15,30),
+                                    type='event', participants=[4])])
+            assert False, "double booked"
+        except BookingConflictError:
+            pass
+        assert db.get_events_between(4, datetime(2017,5,4), datetime(2017,5,5)) == []
+    finally:
+        for event in created:
+            db.delete_event(event.id)
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import time
+import instrumentation
+from instrumentation import Metrics, SlowRequestProfiler, span
+
+
+def test_spans():
+    ## outside of a request spans do nothing
+    with span('db'):
+        pass
+    assert instrumentation.current() is None
+
+    timer = instrumentation.start_request()
+    try:
+        with span('db'):
+            time.sleep(0.01)
+        with span('db'):
+            pass
+        with span('json'):
+            pass
+        timer.queries, timer.rows = 2, 17
+    finally:
+        assert instrumentation.finish_request() is timer
+    assert instrumentation.current() is None
+    assert set(timer.spans) == {'db', 'json'}
+    assert timer.spans['db'] >= 0.01
+
+    header = timer.server_timing()
+    assert header.startswith('db;dur=')
+    assert 'queries;desc="2 queries, 17 rows"' in header
+    assert ', total;dur=' in header
+
+    ## a streamed response body adds to the timer of its request
+    instrumentation.resume(timer)
+    with span('stream'):
+        pass
+    assert instrumentation.finish_request() is timer
+    assert 'stream' in timer.spans
+
+
+def test_metrics():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    timer = instrumentation.RequestTimer()
+    timer.add('db', 0.25)
+    timer.queries = 3
+    metrics.observe('/coaches/', 'GET', 200, timer)
+    metrics.observe('/coaches/', 'GET', 200, timer)
+    metrics.observe('/event/', 'POST', 409, timer, slow=True)
+    text = metrics.render({'pool': {'in_use': 2, 'idle': 3}})
+    lines = text.splitlines()
+    assert 'scheduler_requests_total{endpoint="/coaches/",method="GET",status="200"} 2' in lines
+    assert 'scheduler_requests_total{endpoint="/event/",method="POST",status="409"} 1' in lines
+    assert 'scheduler_request_duration_seconds_bucket{endpoint="/coaches/",le="0.1"} 2' in lines
+    assert 'scheduler_request_duration_seconds_bucket{endpoint="/coaches/",le="+Inf"} 2' in lines
+    assert 'scheduler_request_duration_seconds_count{endpoint="/event/"} 1' in lines
+    assert 'scheduler_span_seconds_total{span="db"} 0.750000' in lines
+    assert 'scheduler_queries_total 9' in lines
+    assert 'scheduler_slow_requests_total 1' in lines
+    assert 'scheduler_pool_in_use 2' in lines
+
+
+def test_slow_request_profiler():
+    directory = tempfile.mkdtemp()
+    try:
+        profiler = SlowRequestProfiler(threshold=0.5, directory=directory)
+        profile = profiler.start()
+        assert profiler.finish(profile, 0.1, '/coaches/') is None
+        profile = profiler.start()
+        path = profiler.finish(profile, 0.6, '/calendar/12/3/')
+        assert os.path.exists(path)
+        assert os.path.basename(path).startswith('calendar_12_3-')
+
+        ## requests outside the sample aren't profiled
+        assert SlowRequestProfiler(sample_rate=0.0).start() is None
+    finally:
+        shutil.rmtree(directory)
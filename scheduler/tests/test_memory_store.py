@@ -0,0 +1,185 @@
+"""
+Test the in-memory data store, which runs without a database
+"""
+import threading
+from datetime import date, datetime, timedelta
+from events import Event, BookingConflictError, NonExistantIdError, appointments, remove_conflicting
+from memory_store import InMemoryDataStore
+
+
+def make_store(**kwargs):
+    db = InMemoryDataStore(**kwargs)
+    db.load({'people': [{'first_name': 'Coach', 'last_name': str(i), 'coach': True} for i in range(1, 3)] +
+                       [{'first_name': 'Client', 'last_name': str(i), 'client': True} for i in range(3, 11)]})
+    return db
+
+
+def test_event():
+    db = make_store()
+    event = db.create_event(start_time=datetime(2017,4,28,12,00),
+                            end_time=datetime(2017,4,28,14,00),
+                            name="Chris's Birthday Party",
+                            notes="Serious Pie Westlake, Seattle WA",
+                            type='event',
+                            participants=[1,2,3,4,5,6,7,8])
+    assert db.get_event(event.id) == event
+    assert [person['id'] for person in db.get_participants(event.id)] == [1,2,3,4,5,6,7,8]
+
+    event.participants.remove(8)
+    event.participants.remove(7)
+    event.participants.extend([9, 10])
+    event.name = "Chris's Huge Birthday Party"
+    updated = db.update_event(**event.as_dict())
+    assert updated.name == "Chris's Huge Birthday Party"
+    assert updated.participants == [1,2,3,4,5,6,9,10]
+    assert db.get_events_between(8, datetime(2017,4,28), datetime(2017,4,29)) == []
+
+    db.delete_event(event.id)
+    try:
+        db.get_event(event.id)
+        assert False, "Should have raised NonExistantIdError"
+    except NonExistantIdError:
+        pass
+    assert db.get_events_between(1, datetime(2017,4,28), datetime(2017,4,29)) == []
+
+
+def test_events_between():
+    db = make_store()
+    start = datetime(2017,5,1,9,00)
+    created = db.create_events([{'start_time': start+timedelta(hours=i), 'end_time': start+timedelta(hours=i+1),
+                                 'participants': [1, 3]} for i in range(10)] +
+                               [Event(start_time=start-timedelta(days=20), end_time=start+timedelta(days=1),
+                                      type='event', participants=[1])])
+    events = db.get_events_between(1, start+timedelta(hours=2), start+timedelta(hours=4))
+    assert [e.id for e in events] == [created[-1].id, created[2].id, created[3].id]
+    assert db.get_events_between(3, start+timedelta(hours=10), start+timedelta(hours=11)) == []
+
+    ## handed out events are copies
+    events[1].participants.append(4)
+    assert db.get_event(created[2].id).participants == [1, 3]
+
+    try:
+        db.create_event(start_time=start, end_time=start+timedelta(days=32), participants=[1])
+        assert False, "longer than MAX_EVENT_SPAN"
+    except ValueError:
+        pass
+
+    ## windows are half open, and an event with no duration is in none
+    empty = db.create_event(start_time=start+timedelta(hours=3), end_time=start+timedelta(hours=3), participants=[3])
+    assert [e.id for e in db.get_events_between(3, start+timedelta(hours=3), start+timedelta(hours=4))] == [created[3].id]
+    assert empty.id not in [e.id for e in db.get_events_between(3, start, start+timedelta(hours=10))]
+
+
+def test_booking_conflicts():
+    db = make_store()
+    booked = db.create_event(start_time=datetime(2017,5,4,10,00), end_time=datetime(2017,5,4,11,00),
+                             type='coaching', participants=[1, 3])
+    try:
+        db.create_event(start_time=datetime(2017,5,4,10,30), end_time=datetime(2017,5,4,11,30),
+                        type='coaching', participants=[1, 4])
+        assert False, "double booked"
+    except BookingConflictError as ex:
+        assert ex.conflicts == [booked.id]
+    later = db.create_event(start_time=datetime(2017,5,4,11,00), end_time=datetime(2017,5,4,12,00),
+                            type='coaching', participants=[1, 4])
+    try:
+        db.update_event(**dict(later.as_dict(), start_time=datetime(2017,5,4,10,00)))
+        assert False, "double booked"
+    except BookingConflictError:
+        pass
+    assert db.get_event(later.id) == later
+
+    ## a batch is checked against the stored events and against itself
+    try:
+        db.create_events([Event(start_time=datetime(2017,5,4,10,30), end_time=datetime(2017,5,4,11,00),
+                                type='coaching', participants=[1, 5])])
+        assert False, "double booked"
+    except BookingConflictError as ex:
+        assert ex.conflicts == [booked.id]
+    try:
+        db.create_events([{'start_time': datetime(2017,5,4,14,00), 'end_time': datetime(2017,5,4,15,00),
+                           'type': 'coaching', 'participants': [2, 5]},
+                          {'start_time': datetime(2017,5,4,14,30), 'end_time': datetime(2017,5,4,15,30),
+                           'participants': [5]}])
+        assert False, "double booked"
+    except BookingConflictError as ex:
+        assert len(ex.conflicts) == 1
+    assert db.get_events_between(5, datetime(2017,5,4), datetime(2017,5,5)) == []
+
+    ## of many threads racing for the same slot, one gets it
+    results = []
+    def book(client_id):
+        try:
+            results.append(db.create_event(start_time=datetime(2017,5,5,9,00), end_time=datetime(2017,5,5,10,00),
+                                           type='coaching', participants=[2, client_id]))
+        except BookingConflictError:
+            pass
+    threads = [threading.Thread(target=book, args=(client_id,)) for client_id in range(3, 11)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 1
+
+
+def test_calendar():
+    start, end = datetime(2017,5,7), datetime(2017,5,14)
+    for slot_engine in ('python', 'sql'):
+        db = make_store(slot_engine=slot_engine)
+        schedulable = db.create_event(start_time=datetime(2017,5,8,9,00), end_time=datetime(2017,5,8,13,00),
+                                      type='schedulable', participants=[1])
+        booked = db.create_event(start_time=datetime(2017,5,8,10,00), end_time=datetime(2017,5,8,11,00),
+                                 type='coaching', participants=[1, 4])
+        busy = db.create_event(start_time=datetime(2017,5,8,12,00), end_time=datetime(2017,5,8,13,00),
+                               type='event', participants=[3])
+        expected = remove_conflicting(appointments([schedulable, booked]), [busy]) + [busy]
+        assert [(e.start_time, e.type) for e in db.get_calendar(3, 1, start, end)] == \
+            [(e.start_time, e.type) for e in expected]
+        assert [(e.start_time, e.type) for e in db.stream_calendar(3, 1, start, end)] == \
+            [(e.start_time, e.type) for e in expected]
+        slots = db.search_availability(start, end, person_id=3)
+        assert [(slot.start_time.hour, slot.participants) for slot in slots] == [(9, [1]), (11, [1])]
+
+
+def test_get_changes():
+    db = make_store()
+    start, end = datetime(2017,5,7), datetime(2017,5,14)
+    coach_id, client_id = 1, 3
+    state = db.get_changes(client_id, coach_id, start, end)
+    assert state['reset']
+
+    db.create_event(start_time=datetime(2017,5,8,9,00), end_time=datetime(2017,5,8,12,00),
+                    type='schedulable', participants=[coach_id])
+    booked = db.create_event(start_time=datetime(2017,5,8,10,00), end_time=datetime(2017,5,8,11,00),
+                             type='coaching', participants=[coach_id, client_id])
+    changes = db.get_changes(client_id, coach_id, start, end, token=state['token'])
+    assert not changes['reset']
+    assert changes['events'] == [booked]
+    assert changes['ranges'] == [(datetime(2017,5,8,9,00), datetime(2017,5,8,12,00))]
+    assert [(slot.start_time.hour, slot.type) for slot in changes['slots']] == [(9, 'open slot'), (11, 'open slot')]
+
+    db.delete_event(booked.id)
+    changes = db.get_changes(client_id, coach_id, start, end, token=changes['token'])
+    assert changes['deleted'] == [booked.id]
+    assert [slot.start_time.hour for slot in changes['slots']] == [10]
+
+    versions = db.get_versions([coach_id, client_id, 4])
+    assert versions == {coach_id: 3, client_id: 2, 4: 0}
+    db.create_availability_rule(coach_id, dtstart=datetime(2017,5,8,14,00), duration=timedelta(hours=2),
+                                rrule='FREQ=DAILY;COUNT=3')
+    assert db.get_changes(client_id, coach_id, start, end, token=changes['token'])['reset']
+
+
+def test_utilization():
+    db = make_store()
+    db.create_event(start_time=datetime(2017,5,15,9,00), end_time=datetime(2017,5,15,12,00),
+                    type='schedulable', participants=[1])
+    db.create_event(start_time=datetime(2017,5,15,10,00), end_time=datetime(2017,5,15,11,00),
+                    type='coaching', participants=[1, 3])
+    db.create_availability_rule(2, dtstart=datetime(2017,5,16,9,00), duration=timedelta(hours=2),
+                                rrule='FREQ=DAILY;COUNT=2')
+    rows = db.get_utilization(datetime(2017,5,15), datetime(2017,5,22))
+    assert [(row['coach_id'], row['period'], row['open_slots'], row['booked_slots']) for row in rows] == \
+        [(1, date(2017,5,15), 2, 1), (2, date(2017,5,16), 2, 0), (2, date(2017,5,17), 2, 0)]
+    months = db.get_utilization(datetime(2017,5,1), datetime(2017,6,1), period='month', coach_id=2)
+    assert [(row['period'], row['open_slots'], row['utilization']) for row in months] == [(date(2017,5,1), 4, 0)]
@@ -0,0 +1,143 @@
+"""
+Test the connection pool against stand-in connections
+"""
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+from events import PostgresCursor
+from pool import ConnectionPool, PoolClosedError, PoolExhaustedError
+from fakes import FakeConnection
+
+
+def make_pool(**kwargs):
+    return ConnectionPool('dbname=test', connect=FakeConnection, **kwargs)
+
+
+def test_reuse():
+    pool = make_pool(max_size=2, cursor_factory='dict')
+    conn = pool.getconn()
+    assert conn.kwargs == {'cursor_factory': 'dict'}
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    stats = pool.stats()
+    assert stats['opened'] == 1
+    assert stats['in_use'] == 1
+    assert stats['idle'] == 0
+    assert stats['checkouts'] == 2
+
+
+def test_min_size():
+    pool = make_pool(min_size=3, max_size=5)
+    assert pool.stats()['idle'] == 3
+
+
+def test_bounded():
+    pool = make_pool(max_size=2, timeout=0.05)
+    pool.getconn()
+    pool.getconn()
+    try:
+        pool.getconn()
+        assert False, "Should have raised PoolExhaustedError"
+    except PoolExhaustedError:
+        pass
+    assert pool.stats()['size'] == 2
+
+
+def test_wait_for_return():
+    pool = make_pool(max_size=1, timeout=5)
+    conn = pool.getconn()
+
+    def give_back():
+        time.sleep(0.05)
+        pool.putconn(conn)
+
+    threading.Thread(target=give_back).start()
+    assert pool.getconn() is conn
+    stats = pool.stats()
+    assert stats['waits'] == 1
+    assert stats['wait_time_max'] >= 0.04
+
+
+def test_broken_connection_replaced():
+    pool = make_pool(max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.closed = 2
+    conn2 = pool.getconn()
+    assert conn2 is not conn
+    assert pool.stats()['discarded'] == 1
+
+
+def test_max_lifetime():
+    pool = make_pool(max_size=1, max_lifetime=0)
+    conn = pool.getconn()
+    time.sleep(0.01)
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.getconn() is not conn
+
+
+def test_idle_connection_pinged():
+    pool = make_pool(max_size=1, check_interval=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    time.sleep(0.01)
+    assert pool.getconn() is conn
+    assert len(conn.sent) == 1
+
+
+def test_open_transaction_rolled_back():
+    pool = make_pool(max_size=1)
+    conn = pool.getconn()
+    conn.status = TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.status == TRANSACTION_STATUS_IDLE
+
+
+def test_closeall():
+    pool = make_pool(max_size=2)
+    idle = pool.getconn()
+    out = pool.getconn()
+    pool.putconn(idle)
+    pool.closeall()
+    assert idle.closed
+    assert not out.closed
+
+    ## connections returned afterwards are closed, not handed out again
+    pool.putconn(out)
+    assert out.closed
+    assert pool.stats()['idle'] == 0
+    try:
+        pool.getconn()
+        assert False, "Should have raised PoolClosedError"
+    except PoolClosedError:
+        pass
+
+
+def test_cursor_returns_connection():
+    pool = make_pool(max_size=1)
+    with PostgresCursor('', pool=pool) as curs:
+        conn = curs.connection
+    assert pool.stats()['idle'] == 1
+
+    ## a connection lost at commit is closed, not pooled again
+    try:
+        with PostgresCursor('', pool=pool) as curs:
+            curs.connection.lost = True
+        assert False, "Should have raised OperationalError"
+    except psycopg2.OperationalError:
+        pass
+    assert conn.closed
+    stats = pool.stats()
+    assert (stats['in_use'], stats['idle']) == (0, 0)
+
+    ## as is one that broke inside the block
+    try:
+        with PostgresCursor('', pool=pool) as curs:
+            conn = curs.connection
+            raise psycopg2.InterfaceError("connection already closed")
+    except psycopg2.InterfaceError:
+        pass
+    assert conn.closed
+    assert pool.stats()['in_use'] == 0
@@ -0,0 +1,65 @@
+"""
+Test prepared statements against stand-in connections
+"""
+import psycopg2
+from psycopg2 import errorcodes
+from prepared import Statement, PreparedStatements
+from fakes import FakeConnection
+
+
+class StaleStatementError(psycopg2.Error):
+    pgcode = errorcodes.INVALID_SQL_STATEMENT_NAME
+
+
+def test_statement():
+    statement = Statement('scheduler_between', """\
+        SELECT * FROM event
+        WHERE person_id=%(person_id)s
+        AND start_time < %(end_time)s AND end_time > %(start_time)s
+        AND start_time > %(start_time)s::timestamp - %(max_span)s::interval;""")
+    assert statement.params == ['person_id', 'end_time', 'start_time', 'max_span']
+    assert statement.prepare_sql.startswith('PREPARE scheduler_between AS')
+    assert 'WHERE person_id=$1' in statement.prepare_sql
+    assert 'start_time > $3::timestamp - $4::interval' in statement.prepare_sql
+    assert not statement.prepare_sql.endswith(';')
+    assert statement.execute_sql == \
+        'EXECUTE scheduler_between (%(person_id)s, %(end_time)s, %(start_time)s, %(max_span)s)'
+    assert statement.prepare_sql == 'PREPARE scheduler_between AS ' + statement.positional
+    assert statement.positional_args({'start_time': 1, 'end_time': 2, 'max_span': 3, 'person_id': 4}) == [4, 2, 1, 3]
+    assert Statement('scheduler_all', 'SELECT 1').execute_sql == 'EXECUTE scheduler_all'
+
+
+def test_prepare_and_execute():
+    prepared = PreparedStatements({'event': "SELECT * FROM event WHERE id=%(id)s"})
+    conn = FakeConnection()
+
+    ## a connection that hasn't been prepared runs the query as is
+    prepared.execute(conn.cursor(), 'event', {'id': 3})
+    assert conn.sent.pop() == ("SELECT * FROM event WHERE id=%(id)s", {'id': 3})
+
+    prepared.prepare(conn)
+    assert conn.sent == [("DEALLOCATE ALL", None), ("PREPARE scheduler_event AS SELECT * FROM event WHERE id=$1", None)]
+    assert conn.commits == 1
+    prepared.prepare(conn)
+    assert len(conn.sent) == 2
+
+    prepared.execute(conn.cursor(), 'event', {'id': 3})
+    assert conn.sent[-1] == ("EXECUTE scheduler_event (%(id)s)", {'id': 3})
+
+    ## after invalidate the statements are prepared afresh
+    prepared.invalidate()
+    prepared.execute(conn.cursor(), 'event', {'id': 4})
+    assert conn.sent[-1][0] == "SELECT * FROM event WHERE id=%(id)s"
+    prepared.prepare(conn)
+    assert [query for query, _ in conn.sent[-2:]] == \
+        ["DEALLOCATE ALL", "PREPARE scheduler_event AS SELECT * FROM event WHERE id=$1"]
+
+    ## a connection whose statements have gone is forgotten
+    conn.fail = StaleStatementError()
+    try:
+        prepared.execute(conn.cursor(), 'event', {'id': 5})
+        assert False, "error swallowed"
+    except StaleStatementError:
+        pass
+    assert not prepared.is_prepared(conn)
+    assert prepared.stats() == {'connections': 0, 'prepares': 2, 'executes': 1, 'discards': 1}
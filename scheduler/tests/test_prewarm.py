@@ -0,0 +1,104 @@
+import time
+from datetime import date, datetime, timedelta
+from flask import Flask, request
+from events import Event, divide_into_blocks, as_datetime
+from cache import AvailabilityCache
+from prewarm import Prewarmer, upcoming_windows
+from utils import week_window_to_show
+from fakes import Clock
+
+
+class FakeDataStore:
+    def __init__(self, coach_ids):
+        self.coach_ids = coach_ids
+        self.computed = []
+
+    def get_coaches(self):
+        return [{'id': coach_id} for coach_id in self.coach_ids]
+
+    def compute_appointments(self, person_id, start_time, end_time):
+        self.computed.append((person_id, start_time))
+        start = datetime.combine(start_time, datetime.min.time()) + timedelta(days=1, hours=9)
+        return list(divide_into_blocks(Event(start_time=start, end_time=start+timedelta(hours=2), type='schedulable')))
+
+
+def window():
+    return date(2020,4,5), date(2020,4,12)
+
+
+def test_upcoming_windows():
+    assert upcoming_windows(2, window) == [(date(2020,4,4), date(2020,4,13)), (date(2020,4,11), date(2020,4,20))]
+    assert upcoming_windows(1, window, margin=timedelta(0)) == [(date(2020,4,5), date(2020,4,12))]
+
+
+def test_sweep_and_refresh():
+    clock = Clock()
+    cache = AvailabilityCache(ttl=100, clock=clock)
+    db = FakeDataStore([1, 2])
+    prewarmer = Prewarmer(db, cache, interval=30, clock=clock, window=window)
+
+    prewarmer.sweep()
+    assert sorted(db.computed) == [(1, date(2020,4,4)), (1, date(2020,4,11)), (2, date(2020,4,4)), (2, date(2020,4,11))]
+    assert cache.get(1, date(2020,4,12), date(2020,4,19)) is not None
+    assert cache.expires_in(2, date(2020,4,4), date(2020,4,13)) == 100
+
+    ## entries that will still be fresh at the next sweep are left alone
+    db.computed = []
+    clock.now = 60
+    prewarmer.sweep()
+    assert db.computed == []
+    clock.now = 75
+    prewarmer.sweep()
+    assert len(db.computed) == 4
+
+    ## a booking invalidates coach 2's first week, which is refreshed on its own
+    db.computed = []
+    cache.invalidate(2, datetime(2020,4,6,9), datetime(2020,4,6,10))
+    cache.invalidate(3, datetime(2020,4,6,9), datetime(2020,4,6,10))
+    clock.now = 80
+    assert prewarmer.stats()['pending'] == 1
+    assert prewarmer.stats()['pending_lag_s'] == 5
+    prewarmer.refresh_dirty()
+    assert db.computed == [(2, date(2020,4,4))]
+    stats = prewarmer.stats()
+    assert (stats['coaches'], stats['sweeps'], stats['refreshes'], stats['errors'], stats['pending']) == (2, 3, 9, 0, 0)
+    assert stats['last_lag_s'] == 5
+
+
+def test_client_windows_hit():
+    ## the warmed windows serve the weeks the web UI asks for, which start
+    ## at the client's local midnight, as /calendar parses them
+    cache = AvailabilityCache()
+    db = FakeDataStore([1])
+    Prewarmer(db, cache, window=window).sweep()
+    for query in ('from=2020-04-05T04:00:00.000Z&to=2020-04-12T04:00:00.000Z',     # New York
+                  'from=2020-04-04T14:00:00.000Z&to=2020-04-11T14:00:00.000Z',     # Sydney
+                  'from=2020-04-12T04:00:00.000Z&to=2020-04-19T04:00:00.000Z'):
+        with Flask(__name__).test_request_context('/calendar/12/1/?' + query):
+            s, e = week_window_to_show(request.args)
+        blocks = cache.get(1, s, e)
+        assert blocks, query
+        assert all(as_datetime(s) < block.end_time and block.start_time < as_datetime(e) for block in blocks)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (3, 0)
+    assert len(db.computed) == 2
+
+
+def test_background_thread():
+    cache = AvailabilityCache()
+    prewarmer = Prewarmer(FakeDataStore([1]), cache, interval=60, window=window)
+    prewarmer.start()
+    try:
+        deadline = time.monotonic() + 5
+        while prewarmer.stats()['refreshes'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get(1, date(2020,4,5), date(2020,4,12)) is not None
+
+        cache.invalidate(1)
+        deadline = time.monotonic() + 5
+        while prewarmer.stats()['refreshes'] < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get(1, date(2020,4,12), date(2020,4,19)) is not None
+    finally:
+        prewarmer.stop(timeout=5)
+    assert not prewarmer._thread.is_alive()
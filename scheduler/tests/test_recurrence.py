@@ -0,0 +1,49 @@
+from datetime import date, datetime, timedelta
+from events import Event, appointments, availability_events
+from recurrence import AvailabilityRule, expand_rules
+
+
+def test_weekly_rule():
+    rule = AvailabilityRule(person_id=1, dtstart=datetime(2017,3,6,8,0), duration=timedelta(hours=4),
+                            rrule='FREQ=WEEKLY;BYDAY=MO,WE', tzid='America/Los_Angeles',
+                            exdates=[date(2017,3,15)])
+    occurrences = list(rule.occurrences(datetime(2017,3,6), datetime(2017,3,21)))
+    ## daylight saving time started on March 12, 2017, moving 8 AM local from 16:00 to 15:00 UTC
+    assert occurrences == [(datetime(2017,3,6,16,0), datetime(2017,3,6,20,0)),
+                           (datetime(2017,3,8,16,0), datetime(2017,3,8,20,0)),
+                           (datetime(2017,3,13,15,0), datetime(2017,3,13,19,0)),
+                           (datetime(2017,3,20,15,0), datetime(2017,3,20,19,0))]
+
+
+def test_window_boundaries():
+    rule = AvailabilityRule(person_id=1, dtstart=datetime(2017,3,6,8,0), duration=timedelta(hours=4),
+                            rrule='FREQ=DAILY;COUNT=10')
+    ## occurrences that only partly overlap the window are included
+    assert list(rule.occurrences(datetime(2017,3,7,11,0), datetime(2017,3,8,9,0))) == \
+        [(datetime(2017,3,7,8,0), datetime(2017,3,7,12,0)),
+         (datetime(2017,3,8,8,0), datetime(2017,3,8,12,0))]
+    ## but not ones that merely touch it
+    assert list(rule.occurrences(datetime(2017,3,7,12,0), datetime(2017,3,8,8,0))) == []
+    ## nor any beyond the end of the rule
+    assert list(rule.occurrences(datetime(2017,4,1), datetime(2017,5,1))) == []
+
+
+def test_expand_rules_in_order():
+    rules = [AvailabilityRule(person_id=1, dtstart=datetime(2017,3,6,13,0), duration=timedelta(hours=4),
+                              rrule='FREQ=DAILY'),
+             AvailabilityRule(person_id=1, dtstart=datetime(2017,3,6,8,0), duration=timedelta(hours=4),
+                              rrule='FREQ=DAILY')]
+    starts = [s for s, e, person_id in expand_rules(rules, datetime(2017,3,6), datetime(2017,3,9))]
+    assert starts == sorted(starts)
+    assert len(starts) == 6
+
+
+def test_rules_match_materialized_events():
+    rule = AvailabilityRule(person_id=1, dtstart=datetime(2020,4,1,11,0), duration=timedelta(hours=4),
+                            rrule='FREQ=DAILY;COUNT=2')
+    materialized = [Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,15,0), type='schedulable'),
+                    Event(start_time=datetime(2020,4,2,11,0), end_time=datetime(2020,4,2,15,0), type='schedulable')]
+    booked = [Event(start_time=datetime(2020,4,2,13,0), end_time=datetime(2020,4,2,14,0), type='coaching')]
+    window = (date(2020,3,29), date(2020,4,5))
+    assert appointments(list(availability_events([rule], *window)) + booked) == \
+        appointments(materialized + booked)
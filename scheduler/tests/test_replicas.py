@@ -0,0 +1,74 @@
+"""
+Test routing reads to replicas with stand-in pools
+"""
+import psycopg2
+from events import PostgresCursor
+from replicas import ReplicaRouter
+from fakes import Clock, FakePool
+
+
+def test_round_robin_and_failover():
+    clock = Clock()
+    a, b = FakePool('a'), FakePool('b')
+    router = ReplicaRouter([a, b], retry_after=30, clock=clock)
+    assert [router.choose() for _ in range(4)] == [a, b, a, b]
+
+    b.down = True
+    assert [router.getconn()[0] for _ in range(3)] == [a, a, a]
+    assert router.stats()['healthy'] == 1
+
+    ## b is tried again once retry_after has passed
+    b.down = False
+    clock.now = 31
+    assert [router.choose() for _ in range(2)] == [b, a]
+
+    a.down = b.down = True
+    assert router.getconn() == (None, None)
+    stats = router.stats()
+    assert (stats['healthy'], stats['failures']) == (0, 3)
+
+
+def test_read_your_writes():
+    clock = Clock()
+    a, b = FakePool('a'), FakePool('b')
+    router = ReplicaRouter([a, b], pin_seconds=5, clock=clock)
+
+    router.wrote([1, 2])
+    assert router.choose((1, 3)) is None
+    assert router.choose((3,)) is a
+    clock.now = 6
+    assert router.choose((1, 3)) is b
+
+    ## a pinned request reads from the primary, others stick to one replica
+    router.begin(pinned=True)
+    assert router.choose() is None
+    router.end()
+    router.begin()
+    assert [router.choose() for _ in range(3)] == [a, a, a]
+    a.down = True
+    router.mark_down(a)
+    assert router.choose() is None
+    router.end()
+    assert router.choose() is b
+
+    ## a streamed response carries on where the request left off
+    router.begin()
+    chosen = router.choose()
+    state = router.save()
+    router.end()
+    router.restore(state)
+    assert [router.choose() for _ in range(2)] == [chosen, chosen]
+    router.end()
+
+
+def test_cursor_routing():
+    primary, replica = FakePool('primary'), FakePool('replica')
+    router = ReplicaRouter([replica])
+    with PostgresCursor('', pool=primary, replicas=router, person_ids=(1,)):
+        assert (primary.out, replica.out) == (0, 1)
+    router.wrote([1])
+    with PostgresCursor('', pool=primary, replicas=router, person_ids=(1,)):
+        assert (primary.out, replica.out) == (1, 0)
+    with PostgresCursor('', pool=primary):
+        assert (primary.out, replica.out) == (1, 0)
+    assert (primary.out, replica.out) == (0, 0)
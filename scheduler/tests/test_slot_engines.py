@@ -0,0 +1,49 @@
+"""
+Check that the SQL slot engine agrees with the Python one on the data
+made by scripts/populate_db.py
+"""
+import os
+import json
+from datetime import datetime, timedelta
+from events import PostgresDataStore
+
+python_db = None
+sql_db = None
+
+def setup_module():
+    global python_db, sql_db
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../config.json')
+    with open(config_path) as f:
+        config = json.loads(f.read())
+    python_db = PostgresDataStore(config['db_connect'], slot_engine='python')
+    sql_db = PostgresDataStore(config['db_connect'], slot_engine='sql')
+
+
+def as_tuples(events):
+    return sorted((e.start_time, e.end_time, e.type, e.name, e.id) for e in events)
+
+
+def test_calendar_parity():
+    with python_db._cursor() as curs:
+        curs.execute("SELECT client_id, coach_id FROM relationship ORDER BY client_id LIMIT 12")
+        pairs = [tuple(row) for row in curs]
+    assert pairs, "run scripts/populate_db.py first"
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    for start_time, end_time in ((today, today+timedelta(weeks=1)),
+                                 (today-timedelta(days=3), today+timedelta(weeks=8))):
+        for person_id, coach_id in pairs:
+            expected = python_db.get_calendar(person_id, coach_id, start_time, end_time)
+            actual = sql_db.get_calendar(person_id, coach_id, start_time, end_time)
+            assert as_tuples(actual) == as_tuples(expected)
+
+
+def test_search_availability():
+    start_time = datetime.combine(datetime.now().date(), datetime.min.time())
+    end_time = start_time + timedelta(weeks=2)
+    expected = sorted(((block.start_time, coach['id'])
+                       for coach in python_db.get_coaches()
+                       for block in python_db.get_appointments(coach['id'], start_time, end_time)
+                       if block.type == 'open slot' and block.start_time >= start_time))[:25]
+    slots = python_db.search_availability(start_time, end_time, limit=25)
+    assert [(slot.start_time, slot.participants[0]) for slot in slots] == expected
@@ -0,0 +1,40 @@
+import json
+from datetime import datetime
+from events import Event
+from utils import ScheldulerJSONEncoder, event_to_json, events_to_json, iter_events_json, \
+                  iter_events_ndjson, calendar_etag
+
+
+def test_events_to_json():
+    events = [Event(id=17, start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,12,0),
+                    type='coaching', name='Lesson', notes='Bring the étude "in E"', participants=[3,4]),
+              Event(start_time=datetime(2020,4,1,12,0), end_time=datetime(2020,4,1,13,0),
+                    type='open slot', name='Available'),
+              Event(start_time='2020-04-01T13:00:00', end_time='2020-04-01T14:00:00',
+                    type='event', participants=['5'])]
+    expected = json.dumps(events, cls=ScheldulerJSONEncoder)
+    assert json.loads(events_to_json(events)) == json.loads(expected)
+    assert json.loads(event_to_json(events[1])) == {'start_time': '2020-04-01T12:00:00Z',
+                                                    'end_time': '2020-04-01T13:00:00Z',
+                                                    'type': 'open slot',
+                                                    'name': 'Available'}
+    assert events_to_json([]) == '[]'
+
+
+def test_iter_events_json():
+    events = [Event(start_time=datetime(2020,4,1,h), end_time=datetime(2020,4,1,h+1), type='open slot')
+              for h in range(7)]
+    for chunk_size in (1, 3, 7, 100):
+        assert ''.join(iter_events_json(events, chunk_size=chunk_size)) == events_to_json(events)
+        lines = ''.join(iter_events_ndjson(events, chunk_size=chunk_size)).splitlines()
+        assert [json.loads(line) for line in lines] == json.loads(events_to_json(events))
+    assert ''.join(iter_events_json([])) == '[]'
+    assert list(iter_events_ndjson([])) == []
+
+
+def test_calendar_etag():
+    etag = calendar_etag({7: 3, 42: 1}, 42, 7, datetime(2020,4,5), datetime(2020,4,12), None)
+    assert etag == calendar_etag({42: 1, 7: 3}, 42, 7, datetime(2020,4,5), datetime(2020,4,12), None)
+    assert etag != calendar_etag({7: 4, 42: 1}, 42, 7, datetime(2020,4,5), datetime(2020,4,12), None)
+    assert etag != calendar_etag({7: 3, 42: 1}, 42, 7, datetime(2020,4,12), datetime(2020,4,19), None)
+    assert etag != calendar_etag({7: 3, 42: 1}, 42, 7, datetime(2020,4,5), datetime(2020,4,12), 'ndjson')
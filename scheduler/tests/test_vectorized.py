@@ -0,0 +1,54 @@
+import random
+from datetime import datetime, timedelta
+from events import Event, ConflictIndex, appointments, divide_into_blocks
+from utils import events_to_json
+import vectorized
+
+
+def test_blocks():
+    events = (Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,15,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,2,10,0), end_time=datetime(2020,4,2,12,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,2,13,0), end_time=datetime(2020,4,2,17,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,2,11,0), end_time=datetime(2020,4,2,12,0), type='coaching'),
+              Event(start_time=datetime(2020,4,2,13,0), end_time=datetime(2020,4,2,14,0), type='coaching'),
+              Event(start_time=datetime(2020,4,2,14,0), end_time=datetime(2020,4,2,15,0), type='coaching'))
+
+    blocks = vectorized.appointments(events)
+    assert blocks == appointments(events)
+    assert Event(start_time=datetime(2020,4,1,11,0), end_time=datetime(2020,4,1,12,0), type='open slot', name='Available') in blocks
+    assert Event(start_time=datetime(2020,4,2,11,0), end_time=datetime(2020,4,2,12,0), type='unavailable slot', name='Booked') in blocks
+
+    assert vectorized.appointments([]) == []
+    assert vectorized.appointments(events[:3]) == appointments(events[:3])
+
+
+def test_match_appointments():
+    rng = random.Random(2468)
+    t0 = datetime(2020,4,1)
+
+    def random_event(type):
+        start = t0 + timedelta(minutes=15*rng.randrange(0, 400))
+        return Event(start_time=start, end_time=start+timedelta(minutes=15*rng.randrange(0, 16)), type=type)
+
+    events = [random_event(rng.choice(('schedulable', 'coaching', 'event'))) for _ in range(300)]
+    assert vectorized.appointments(events) == appointments(events)
+    index = ConflictIndex(events)
+    assert [(b.start_time, b.end_time, b.type == 'unavailable slot')
+            for b in vectorized.appointments(events, timedelta(minutes=45))] == \
+        [(b.start_time, b.end_time, index.conflicts(b))
+         for event in events if event.type == 'schedulable'
+         for b in divide_into_blocks(event, timedelta(minutes=45))]
+
+    starts, ends, flags = vectorized.appointment_arrays(events)
+    assert vectorized.blocks_to_json(starts, ends, flags) == events_to_json(appointments(events))
+
+
+def test_count_by_day():
+    events = [Event(start_time=datetime(2020,4,1,9,0), end_time=datetime(2020,4,1,12,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,2,9,0), end_time=datetime(2020,4,2,11,0), type='schedulable'),
+              Event(start_time=datetime(2020,4,1,10,0), end_time=datetime(2020,4,1,11,0), type='coaching')]
+    starts, ends, flags = vectorized.appointment_arrays(events)
+    days, open_counts, booked_counts = vectorized.count_by_day(starts, flags)
+    assert vectorized.from_epoch(days) == [datetime(2020,4,1), datetime(2020,4,2)]
+    assert open_counts.tolist() == [2, 2]
+    assert booked_counts.tolist() == [1, 0]
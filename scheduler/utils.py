@@ -1,21 +1,134 @@
+import hashlib
+import json
+from operator import attrgetter
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta, SU, MO, TU, WE, TH, FR, SA
 from dateutil.parser import parse
-from flask.json import JSONEncoder
 from events import Event
 
+try:
+    from flask.json import JSONEncoder
+except ImportError:
+    ## Flask 2.3 dropped its JSONEncoder in favor of JSON providers
+    from json import JSONEncoder
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
+
 
 class ScheldulerJSONEncoder(JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Event):
             return {attr:getattr(obj,attr)
-                    for attr in ['id','start_time','end_time', 'name', 'type', 'notes', 'participants']
+                    for attr in Event.__slots__
                     if getattr(obj,attr)}
         elif isinstance(obj, datetime):
             return obj.isoformat()+'Z'
         return super(ScheldulerJSONEncoder, self).default(obj)
 
 
+if DefaultJSONProvider is not None:
+    class ScheldulerJSONProvider(DefaultJSONProvider):
+        """
+        Serialize events and datetimes the same way ScheldulerJSONEncoder
+        does, on versions of Flask that no longer use app.json_encoder
+        """
+        @staticmethod
+        def default(obj):
+            if isinstance(obj, (Event, datetime)):
+                return ScheldulerJSONEncoder().default(obj)
+            return DefaultJSONProvider.default(obj)
+else:
+    ScheldulerJSONProvider = None
+
+
+_encode_str = json.encoder.encode_basestring_ascii
+_encode_fallback = ScheldulerJSONEncoder(separators=(',', ':')).encode
+
+def _encode_participants(ids):
+    if all(type(i) is int for i in ids):
+        return '[' + ','.join(map(str, ids)) + ']'
+    return _encode_fallback(ids)
+
+_value_encoders = {
+    datetime: lambda dt: '"' + dt.isoformat() + 'Z"',
+    str: _encode_str,
+    int: str,
+    list: _encode_participants,
+}
+
+_event_keys = [_encode_str(attr) + ':' for attr in Event.__slots__]
+_event_values = attrgetter(*Event.__slots__)
+
+
+def event_to_json(event):
+    """
+    Serialize an event to a JSON object, giving the same result as
+    ScheldulerJSONEncoder but without building an intermediate dict.
+    As with the encoder, attributes with empty values are left out.
+    """
+    get_encoder = _value_encoders.get
+    return '{' + ','.join([key + get_encoder(type(value), _encode_fallback)(value)
+                           for key, value in zip(_event_keys, _event_values(event))
+                           if value]) + '}'
+
+
+def events_to_json(events):
+    """
+    Serialize a list of events to a JSON array
+    """
+    return '[' + ','.join(map(event_to_json, events)) + ']'
+
+
+def iter_events_json(events, chunk_size=500):
+    """
+    Serialize events to a JSON array in pieces of up to chunk_size events,
+    for streaming a response without building the whole body in memory
+    """
+    sep = '['
+    chunk = []
+    for event in events:
+        chunk.append(event_to_json(event))
+        if len(chunk) >= chunk_size:
+            yield sep + ','.join(chunk)
+            sep = ','
+            chunk = []
+    if chunk:
+        yield sep + ','.join(chunk)
+        sep = ','
+    yield ']' if sep == ',' else '[]'
+
+
+def iter_events_ndjson(events, chunk_size=500):
+    """
+    Serialize events as newline delimited JSON, one object per line, in
+    pieces of up to chunk_size events
+    """
+    chunk = []
+    for event in events:
+        chunk.append(event_to_json(event) + '\n')
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def calendar_etag(versions, *parts):
+    """
+    An ETag for a view of people's calendars, from their change versions
+    and whatever else picks out the view, such as the window shown. It
+    changes whenever one of the people's events is written.
+
+    :param versions: dict from person ID to change version
+    :param parts: other values the response depends on
+    """
+    key = repr((sorted(versions.items()), parts)).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
 def week_window_to_show(kwargs={}):
     """
     Figure out whether to show this week or next week
@@ -36,7 +149,3 @@ def week_window_to_show(kwargs={}):
     if not e:
         e = s + relativedelta(weeks=+1)
     return s, e
-
-
-
-
@@ -0,0 +1,129 @@
+"""
+A slot engine working on NumPy arrays, for wide windows and reports
+
+Schedulable periods and busy events are held as int64 arrays of
+microseconds since the epoch. Dividing periods into blocks and flagging
+the booked ones are done a whole calendar at a time with array
+operations, so no Python object is made per block until the results are
+turned into Event objects or JSON at the edge, if at all.
+"""
+from datetime import datetime, timedelta
+import numpy as np
+from events import Event
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch(times):
+    """
+    A sequence of naive datetimes to an int64 array of microseconds since
+    the epoch. Integer timedelta division is several times faster than
+    letting NumPy convert the datetime objects.
+    """
+    return np.fromiter(((t - EPOCH) // MICROSECOND for t in times), np.int64, len(times))
+
+
+def from_epoch(values):
+    """
+    An int64 array of microseconds since the epoch to a list of datetimes
+    """
+    return np.asarray(values).astype('datetime64[us]').tolist()
+
+
+def split_events(events):
+    """
+    :return: start and end arrays of the schedulable events, then of the others
+    """
+    schedulable, busy = [], []
+    for event in events:
+        (schedulable if event.type == 'schedulable' else busy).append((event.start_time, event.end_time))
+    def arrays(pairs):
+        if not pairs:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        starts, ends = zip(*pairs)
+        return to_epoch(starts), to_epoch(ends)
+    return arrays(schedulable) + arrays(busy)
+
+
+def divide_into_blocks(starts, ends, block_len=timedelta(hours=1)):
+    """
+    Divide schedulable periods into whole blocks, as events.divide_into_blocks
+    does one period at a time
+
+    :return: arrays of the blocks' starts and ends, period by period
+    """
+    step = block_len // MICROSECOND
+    counts = np.maximum((ends - starts) // step, 0)
+    owner = np.repeat(np.arange(len(starts)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    block_starts = starts[owner] + (np.arange(len(owner)) - first) * step
+    return block_starts, block_starts + step
+
+
+def booked(starts, ends, busy_starts, busy_ends):
+    """
+    Flag the blocks that overlap a busy interval, the way ConflictIndex
+    does: the busy intervals starting before a block ends are a prefix in
+    start order, which conflicts if the latest end in it is after the
+    block's start
+
+    :return: a boolean array
+    """
+    if len(busy_starts) == 0:
+        return np.zeros(len(starts), dtype=bool)
+    order = np.argsort(busy_starts, kind='stable')
+    sorted_starts = busy_starts[order]
+    max_ends = np.maximum.accumulate(busy_ends[order])
+    i = np.searchsorted(sorted_starts, ends, side='left')
+    return (i > 0) & (max_ends[np.maximum(i - 1, 0)] > starts)
+
+
+def appointment_arrays(events, block_len=timedelta(hours=1)):
+    """
+    The blocks of a calendar, as events.appointments computes them, as
+    arrays of starts and ends and a booked flag
+    """
+    sched_starts, sched_ends, busy_starts, busy_ends = split_events(events)
+    starts, ends = divide_into_blocks(sched_starts, sched_ends, block_len)
+    return starts, ends, booked(starts, ends, busy_starts, busy_ends)
+
+
+def appointments(events, block_len=timedelta(hours=1)):
+    """
+    A drop in for events.appointments, giving the same list of Events
+    """
+    starts, ends, flags = appointment_arrays(events, block_len)
+    return [Event(start_time=s, end_time=e, name='Booked', type='unavailable slot') if b else
+            Event(start_time=s, end_time=e, name='Available', type='open slot')
+            for s, e, b in zip(from_epoch(starts), from_epoch(ends), flags.tolist())]
+
+
+def _iso(values):
+    unit = 's' if not (values % 1000000).any() else 'us'
+    return np.datetime_as_string(values.astype('datetime64[us]'), unit=unit).tolist()
+
+
+def blocks_to_json(starts, ends, flags):
+    """
+    Serialize blocks straight from arrays to a JSON array, the same as
+    utils.events_to_json would give for the equivalent Events
+    """
+    open_slot = '","name":"Available","type":"open slot"}'
+    booked_slot = '","name":"Booked","type":"unavailable slot"}'
+    return '[' + ','.join(['{"start_time":"' + s + 'Z","end_time":"' + e + 'Z' + (booked_slot if b else open_slot)
+                           for s, e, b in zip(_iso(starts), _iso(ends), flags.tolist())]) + ']'
+
+
+def count_by_day(starts, flags, day=timedelta(days=1)):
+    """
+    Count open and booked blocks per day, by the day each block starts on
+
+    :return: arrays of the days, as microseconds since the epoch, and the
+             numbers of open and booked blocks on each
+    """
+    step = day // MICROSECOND
+    days, index = np.unique(starts // step, return_inverse=True)
+    booked_counts = np.bincount(index, weights=flags, minlength=len(days)).astype(np.int64)
+    total = np.bincount(index, minlength=len(days))
+    return days * step, total - booked_counts, booked_counts
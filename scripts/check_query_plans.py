@@ -0,0 +1,159 @@
+"""
+Check that Postgres plans the scheduler's window queries with indexes
+
+Runs EXPLAIN on the query behind PostgresDataStore.get_events_between for
+the busiest person in the database and fails if the plan sequentially
+scans event or participant, or reads partitions of them for months the
+window can't reach. The lookups of an event by ID and the deletion of a
+participant must likewise read only the event's month. Run it against a
+populated database, after the scripts in scripts/migrations have been
+applied:
+
+    python scripts/check_query_plans.py
+"""
+import json
+import os
+import re
+import sys
+import psycopg2
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scheduler'))
+from events import EVENTS_BETWEEN_QUERY, FETCH_EVENT_QUERY, DELETE_PARTICIPANT_QUERY, MAX_EVENT_SPAN, window_args
+
+## read config file
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+with open(config_path) as f:
+    config = json.loads(f.read())
+
+
+def plan_nodes(plan):
+    """
+    Walk an EXPLAIN (FORMAT JSON) plan tree depth first
+    """
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def partitioned_table(relation):
+    """
+    The table a monthly or default partition belongs to, e.g. event for event_p202405
+    """
+    return re.sub(r'_(p[0-9]{6}|default)$', '', relation)
+
+
+def month_partitions(table, start_time, end_time):
+    """
+    Names of the monthly partitions of a table from start_time's month to end_time's
+    """
+    month = date(start_time.year, start_time.month, 1)
+    names = set()
+    while month <= end_time.date():
+        names.add('%s_p%04d%02d' % (table, month.year, month.month))
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return names
+
+
+def parent_index(curs, index):
+    """
+    The index on the partitioned table that an index on a partition was made from
+    """
+    curs.execute("""\
+        SELECT coalesce((SELECT i.inhparent::regclass::text FROM pg_inherits i
+                         WHERE i.inhrelid = to_regclass(%s)), %s)""", (index, index))
+    return curs.fetchone()[0]
+
+
+def explain(curs, query, args, analyze=False):
+    """
+    The plan of a query. With analyze the query is run, so partitions
+    pruned only once the query runs, as when a join supplies the start
+    time, show as never executed.
+    """
+    curs.execute("EXPLAIN (%sFORMAT JSON) " % ('ANALYZE, ' if analyze else '') + query, args)
+    return curs.fetchone()[0][0]['Plan']
+
+
+def scanned_partitions(nodes, tables):
+    """
+    The partitions of the given tables that a plan reads, leaving out
+    those it never executed
+    """
+    return {node['Relation Name'] for node in nodes
+            if 'Relation Name' in node and partitioned_table(node['Relation Name']) in tables
+            and node.get('Actual Loops', 1) > 0}
+
+
+def check_pruned(name, plan, tables, start_time, end_time):
+    """
+    Check that a plan reads only the partitions of tables for the months
+    from start_time to end_time, or the default ones
+
+    :return: whether it does
+    """
+    reachable = {'%s_default' % table for table in tables}
+    for table in tables:
+        reachable |= month_partitions(table, start_time, end_time)
+    scanned = scanned_partitions(list(plan_nodes(plan)), tables)
+    if scanned - reachable:
+        print('FAIL: %s reads partitions %s' % (name, ', '.join(sorted(scanned - reachable))))
+        return False
+    print('OK: %s reads %s' % (name, ', '.join(sorted(scanned))))
+    return True
+
+
+def main():
+    conn = psycopg2.connect(config['db_connect'])
+    try:
+        with conn.cursor() as curs:
+            curs.execute("ANALYZE event; ANALYZE participant; ANALYZE event_start;")
+            curs.execute("""\
+                SELECT person_id, count(*)
+                FROM participant
+                GROUP BY person_id
+                ORDER BY count(*) DESC
+                LIMIT 1;""")
+            person_id, n = curs.fetchone()
+            start_time = datetime.now()
+            end_time = start_time + timedelta(weeks=1)
+
+            plan = explain(curs, EVENTS_BETWEEN_QUERY, window_args(start_time, end_time, person_id=person_id))
+            nodes = list(plan_nodes(plan))
+            for node in nodes:
+                print('%-20s %-22s %s' % (node['Node Type'], node.get('Relation Name', ''), node.get('Index Name', '')))
+
+            tables = ('event', 'participant')
+            seq_scans = [node['Relation Name'] for node in nodes
+                         if node['Node Type'] == 'Seq Scan' and partitioned_table(node['Relation Name']) in tables]
+            indexes = {parent_index(curs, node['Index Name']) for node in nodes if 'Index Name' in node}
+            if seq_scans:
+                print('FAIL: sequential scan of %s for person %s with %d events' % (', '.join(seq_scans), person_id, n))
+                return 1
+            if not indexes & {'participant_person_idx', 'event_time_range_idx'}:
+                print('FAIL: neither participant_person_idx nor event_time_range_idx was used')
+                return 1
+            print('OK: get_events_between uses %s' % ', '.join(sorted(indexes)))
+
+            ## only the partitions for months an event overlapping the window
+            ## can start in, or the default ones, should be read
+            ok = check_pruned('get_events_between', plan, tables, start_time - MAX_EVENT_SPAN, end_time)
+
+            ## looking an event up by ID, and deleting one of its
+            ## participants, should read just the event's month
+            curs.execute("SELECT event_id, person_id, start_time FROM participant WHERE person_id=%s LIMIT 1",
+                         (person_id,))
+            event_id, person_id, event_start_time = curs.fetchone()
+            plan = explain(curs, FETCH_EVENT_QUERY, {'id': event_id}, analyze=True)
+            ok = check_pruned('fetch_event', plan, ('event',), event_start_time, event_start_time) and ok
+            plan = explain(curs, DELETE_PARTICIPANT_QUERY,
+                           {'event_id': event_id, 'person_id': person_id, 'start_time': event_start_time})
+            ok = check_pruned('delete_participant', plan, ('participant',), event_start_time, event_start_time) and ok
+            return 0 if ok else 1
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,38 +2,192 @@
 
 DROP TABLE IF EXISTS event CASCADE;
 DROP TABLE IF EXISTS participant CASCADE;
+DROP TABLE IF EXISTS event_start CASCADE;
 DROP TABLE IF EXISTS person CASCADE;
 DROP TABLE IF EXISTS relationship CASCADE;
+DROP TABLE IF EXISTS availability_rule CASCADE;
+DROP TABLE IF EXISTS event_change CASCADE;
+DROP TABLE IF EXISTS coach_daily_rollup CASCADE;
 
+--event and participant are partitioned by month of the event's start_time,
+--see ensure_event_partitions below
 CREATE TABLE IF NOT EXISTS event (
-  id            bigserial PRIMARY KEY,
+  id            bigserial,
   start_time    timestamp NOT NULL,    -- UTC
   end_time      timestamp NOT NULL,    -- UTC
   name          varchar(120),
   type          varchar(20),
-  notes         text
-);
+  notes         text,
+  time_range    tsrange GENERATED ALWAYS AS (tsrange(start_time, end_time, '[)')) STORED,
+  PRIMARY KEY (id, start_time),
+  CONSTRAINT event_span_check CHECK (end_time - start_time <= interval '31 days')  -- events.MAX_EVENT_SPAN
+) PARTITION BY RANGE (start_time);
+
+CREATE TABLE IF NOT EXISTS event_default PARTITION OF event DEFAULT;
+
+CREATE INDEX IF NOT EXISTS event_time_range_idx ON event USING gist (time_range);
 
 CREATE TABLE IF NOT EXISTS person (
   id            bigserial PRIMARY KEY,
   first_name    varchar(120),
   last_name     varchar(120),
   client        boolean NOT NULL DEFAULT False,
-  coach         boolean NOT NULL DEFAULT False
+  coach         boolean NOT NULL DEFAULT False,
+  version       bigint NOT NULL DEFAULT 0    -- bumped whenever the person's calendar changes
 );
 
 CREATE TABLE IF NOT EXISTS participant (
-  event_id      integer NOT NULL REFERENCES event (id) ON DELETE CASCADE,
+  event_id      bigint NOT NULL,
   person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
-  CONSTRAINT participant_constraint UNIQUE (event_id,person_id)
+  start_time    timestamp NOT NULL,    -- the event's, which a change to cascades to
+  CONSTRAINT participant_constraint UNIQUE (event_id,person_id,start_time),
+  FOREIGN KEY (event_id, start_time) REFERENCES event (id, start_time) ON DELETE CASCADE ON UPDATE CASCADE
+) PARTITION BY RANGE (start_time);
+
+CREATE TABLE IF NOT EXISTS participant_default PARTITION OF participant DEFAULT;
+
+CREATE INDEX IF NOT EXISTS participant_person_idx ON participant (person_id, event_id);
+
+--the start time of each event by ID, so an event can be found by ID without
+--probing every partition, kept up to date by event_start_trigger
+CREATE TABLE IF NOT EXISTS event_start (
+  id            bigint PRIMARY KEY,
+  start_time    timestamp NOT NULL    -- the event's, UTC
 );
 
+--A change of start_time that moves an event to another partition may fire
+--as a delete and an insert, so an insert replaces any row for the ID and a
+--delete only removes it if the event is gone.
+CREATE OR REPLACE FUNCTION track_event_start()
+RETURNS trigger AS $body$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    DELETE FROM event_start s
+    WHERE s.id = OLD.id
+    AND NOT EXISTS (SELECT 1 FROM event e WHERE e.id = OLD.id);
+  ELSE
+    INSERT INTO event_start (id, start_time) VALUES (NEW.id, NEW.start_time)
+    ON CONFLICT (id) DO UPDATE SET start_time = EXCLUDED.start_time;
+  END IF;
+  RETURN NULL;
+END
+$body$ LANGUAGE plpgsql;
+
+CREATE TRIGGER event_start_trigger
+AFTER INSERT OR DELETE OR UPDATE OF id, start_time ON event
+FOR EACH ROW EXECUTE FUNCTION track_event_start();
+
 CREATE TABLE IF NOT EXISTS relationship (
   coach_id      integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
   client_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
   since         timestamp    -- UTC
 );
 
+CREATE TABLE IF NOT EXISTS availability_rule (
+  id            bigserial PRIMARY KEY,
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  dtstart       timestamp NOT NULL,               -- local time of the first occurrence
+  duration      interval NOT NULL,
+  rrule         text NOT NULL,                    -- RFC 5545 RRULE, e.g. FREQ=WEEKLY;BYDAY=MO,TU
+  tzid          varchar(64) NOT NULL DEFAULT 'UTC',
+  exdates       date[] NOT NULL DEFAULT '{}'      -- local dates with no occurrence
+);
+
+CREATE INDEX IF NOT EXISTS availability_rule_person_idx ON availability_rule (person_id);
+
+CREATE TABLE IF NOT EXISTS event_change (
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  event_id      bigint,                       -- NULL for availability rule changes
+  op            varchar(10) NOT NULL,         -- create, update, delete or rule
+  start_time    timestamp,                    -- UTC, time range of the event as written
+  end_time      timestamp,                    -- UTC
+  xid           bigint NOT NULL DEFAULT txid_current()
+);
+
+CREATE INDEX IF NOT EXISTS event_change_person_xid_idx ON event_change (person_id, xid);
+
+CREATE TABLE IF NOT EXISTS coach_daily_rollup (
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  day           date NOT NULL,                -- UTC day the slots start on
+  open_slots    integer NOT NULL DEFAULT 0,
+  booked_slots  integer NOT NULL DEFAULT 0,
+  PRIMARY KEY (person_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS coach_daily_rollup_day_idx ON coach_daily_rollup (day);
+
+--Create monthly partitions of event and participant, named event_pYYYYMM
+--and participant_pYYYYMM, for the months from first_month to last_month
+--that don't have them yet. A month with rows already in the default
+--partitions is skipped with a notice, as they would have to be moved
+--first. Returns the names of the event partitions created.
+CREATE OR REPLACE FUNCTION ensure_event_partitions(first_month date, last_month date)
+RETURNS SETOF text AS $body$
+DECLARE
+  m date := date_trunc('month', first_month);
+  next_m date;
+  suffix text;
+BEGIN
+  WHILE m <= last_month LOOP
+    next_m := m + interval '1 month';
+    suffix := to_char(m, '"p"YYYYMM');
+    IF to_regclass('event_' || suffix) IS NULL THEN
+      IF EXISTS (SELECT 1 FROM event_default WHERE start_time >= m AND start_time < next_m) THEN
+        RAISE NOTICE 'event_default has rows in %, not creating event_%', to_char(m, 'YYYY-MM'), suffix;
+      ELSE
+        EXECUTE format('CREATE TABLE %I PARTITION OF event FOR VALUES FROM (%L) TO (%L)',
+                       'event_' || suffix, m, next_m);
+        EXECUTE format('CREATE TABLE %I PARTITION OF participant FOR VALUES FROM (%L) TO (%L)',
+                       'participant_' || suffix, m, next_m);
+        RETURN NEXT 'event_' || suffix;
+      END IF;
+    END IF;
+    m := next_m;
+  END LOOP;
+END
+$body$ LANGUAGE plpgsql;
+
+--Detach the monthly partitions of event and participant for months ending
+--on or before the given date and move them to the archive schema, from
+--where they can be dumped and dropped. A detached participant partition
+--keeps a foreign key to event, which is dropped so the event partition can
+--be detached after it. The archived events' rows in event_start are
+--deleted. Returns the names of the event partitions archived.
+CREATE OR REPLACE FUNCTION archive_event_partitions(before date)
+RETURNS SETOF text AS $body$
+DECLARE
+  part record;
+  fk record;
+BEGIN
+  CREATE SCHEMA IF NOT EXISTS archive;
+  FOR part IN
+    SELECT c.relname AS event_part, 'participant_' || substr(c.relname, 7) AS participant_part
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'event'::regclass
+    AND c.relname ~ '^event_p[0-9]{6}$'
+    AND to_date(substr(c.relname, 8), 'YYYYMM') + interval '1 month' <= before
+    ORDER BY c.relname
+  LOOP
+    EXECUTE format('ALTER TABLE participant DETACH PARTITION %I', part.participant_part);
+    FOR fk IN
+      SELECT conname FROM pg_constraint
+      WHERE conrelid = part.participant_part::regclass AND confrelid = 'event'::regclass AND contype = 'f'
+    LOOP
+      EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', part.participant_part, fk.conname);
+    END LOOP;
+    EXECUTE format('ALTER TABLE event DETACH PARTITION %I', part.event_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.participant_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.event_part);
+    EXECUTE format('DELETE FROM event_start WHERE id IN (SELECT id FROM archive.%I)', part.event_part);
+    RETURN NEXT part.event_part;
+  END LOOP;
+END
+$body$ LANGUAGE plpgsql;
+
+--partitions for the past and coming year, later months are added by scripts/manage_partitions.py
+SELECT count(*) FROM ensure_event_partitions((now() - interval '1 year')::date, (now() + interval '1 year')::date);
+
 DO
 $body$
 BEGIN
@@ -0,0 +1,268 @@
+"""
+Generate fake scheduling data at scale
+
+Plans every coach's working hours and their clients' bookings in memory,
+then bulk loads them, along with the utilization rollup worked out from
+the same plan, with COPY, spreading the coaches across worker
+processes. Each coach's data comes from its own random number generator
+seeded from --seed and the coach's number, so the same seed gives the
+same data whatever the number of workers.
+
+Load into freshly created tables, with nothing else writing to them:
+
+    psql -f scripts/create_tables.sql scheduler
+    python scripts/generate_data.py --coaches 10000 --clients-per-coach 20 --weeks 26 --workers 8 --seed 1
+"""
+import argparse
+import io
+import json
+import os
+import random
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import psycopg2
+from dateutil.tz import gettz
+
+FIRST_NAMES = ['Lindsey', 'Alanna', 'Pearl', 'Virgil', 'Rebbeca', 'Sharri', 'Rea', 'Felecia', 'Malika', 'Gene',
+               'Denisse', 'Tyrell', 'Emogene', 'Bernadette', 'Beverley', 'Cheri', 'Milagros', 'Evon', 'Rayford',
+               'Mazie', 'Melynda', 'Angle', 'Rozella', 'Bea', 'Thao', 'Wanetta', 'Cathleen', 'Cheyenne', 'Nakia',
+               'Fernanda', 'Lai', 'Chiquita', 'Glayds', 'Sherrie', 'Eliana', 'Chad', 'Stanton', 'Hugo']
+LAST_NAMES = ['Lamphere', 'Atherton', 'Pedigo', 'Venable', 'Rowser', 'Shirkey', 'Roosa', 'Feuerstein',
+              'Mclendon', 'Gatewood', 'Downie', 'Tedesco', 'Ericsson', 'Banner', 'Boothe', 'Conway', 'Martines',
+              'Eriksen', 'Rolland', 'Mossey', 'Main', 'Ahmed', 'Rohlfing', 'Brandis', 'Turbeville', 'Whitmire']
+TIME_ZONES = ('America/Los_Angeles', 'America/New_York')
+
+## a coach works a four hour morning and afternoon block, with an hour for lunch
+BLOCKS = ((8, 4), (13, 4))
+
+## rows are sent to COPY in batches of about this many
+COPY_BATCH = 100000
+
+
+def copy_rows(curs, table, columns, rows):
+    """
+    Bulk load rows, tuples of values without tabs or newlines, with COPY
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if value is None else str(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    curs.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
+
+
+def reserve_ids(curs, sequence, n):
+    """
+    Take n IDs from a sequence. Each is drawn with nextval, so workers
+    reserving at the same time never get the same ones, but the IDs
+    needn't be contiguous.
+
+    :return: a list of the IDs in order
+    """
+    curs.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (sequence, n))
+    return [row[0] for row in curs.fetchall()]
+
+
+def work_schedule(rng, start, weeks, tzid):
+    """
+    A coach's schedulable blocks in UTC over a number of weeks, with two
+    randomly chosen blocks a week kept for admin
+
+    :param start: the Monday the schedule starts, a naive date
+    :return: a list of (start, end) pairs in order
+    """
+    admin = set(rng.sample([(day, block) for day in range(5) for block in range(len(BLOCKS))], 2))
+    return weekly_blocks(start, weeks, tzid, admin)
+
+
+def weekly_blocks(start, weeks, tzid, admin=()):
+    """
+    The working hours BLOCKS of every weekday in UTC, leaving out the
+    (day, block) pairs in admin
+
+    :return: a list of (start, end) pairs in order
+    """
+    tz = gettz(tzid)
+    schedule = []
+    for week in range(weeks):
+        for day in range(5):
+            date = start + timedelta(weeks=week, days=day)
+            for block, (hour, length) in enumerate(BLOCKS):
+                if (day, block) in admin:
+                    continue
+                local_start = datetime(date.year, date.month, date.day, hour)
+                local_end = local_start + timedelta(hours=length)
+                schedule.append((local_start - tz.utcoffset(local_start), local_end - tz.utcoffset(local_end)))
+    return schedule
+
+
+def plan_bookings(rng, schedule, client_ids, bookings_per_client, start):
+    """
+    Book each client into a free hour of the coach's schedule about once a
+    month, in a week picked at random
+
+    Free hours are kept in a sorted list, so the hours in a week are found
+    by bisection and taking one doesn't disturb the rest.
+
+    :return: a list of (start, end, client_id)
+    """
+    free = [s + timedelta(hours=i) for s, e in schedule for i in range((e - s) // timedelta(hours=1))]
+    booked = []
+    for client_id in client_ids:
+        day = start + timedelta(days=rng.randint(1, 30))
+        for _ in range(bookings_per_client):
+            lo = bisect_left(free, day)
+            hi = bisect_left(free, day + timedelta(days=7))
+            if lo < hi:
+                slot = free.pop(rng.randrange(lo, hi))
+                booked.append((slot, slot + timedelta(hours=1), client_id))
+            day += timedelta(days=rng.randint(25, 35))
+    return booked
+
+
+def daily_rollup(coach_id, schedule, bookings):
+    """
+    A coach's rows of the coach_daily_rollup table, counting the hours of
+    their schedule and the booked ones by the UTC day they start on
+    """
+    hours = {}
+    for s, e in schedule:
+        for i in range((e - s) // timedelta(hours=1)):
+            day = (s + timedelta(hours=i)).date()
+            hours[day] = hours.get(day, 0) + 1
+    booked = {}
+    for s, e, client_id in bookings:
+        booked[s.date()] = booked.get(s.date(), 0) + 1
+    return [(coach_id, day, n - booked.get(day, 0), booked.get(day, 0)) for day, n in sorted(hours.items())]
+
+
+def generate_coaches(task):
+    """
+    Plan and load the events of a share of the coaches, in a worker process
+
+    :param task: a tuple of the connection string, generation parameters
+                 and a list of (coach number, coach ID, client IDs)
+    :return: the number of events loaded
+    """
+    connect_string, params, coaches = task
+    start = datetime.strptime(params['start'], '%Y-%m-%d')
+    conn = psycopg2.connect(connect_string)
+    loaded = 0
+    try:
+        events, participants, rules, rollup = [], [], [], []
+
+        def flush():
+            with conn, conn.cursor() as curs:
+                event_ids = reserve_ids(curs, 'event_id_seq', len(events)) if events else []
+                copy_rows(curs, 'event', ('id', 'start_time', 'end_time', 'name', 'type'),
+                          ((event_ids[i],) + event for i, event in enumerate(events)))
+                copy_rows(curs, 'participant', ('event_id', 'person_id', 'start_time'),
+                          ((event_ids[i], person_id, events[i][0])
+                           for i, people in enumerate(participants) for person_id in people))
+                if rules:
+                    copy_rows(curs, 'availability_rule', ('person_id', 'dtstart', 'duration', 'rrule', 'tzid'), rules)
+                copy_rows(curs, 'coach_daily_rollup', ('person_id', 'day', 'open_slots', 'booked_slots'), rollup)
+            del events[:], participants[:], rules[:], rollup[:]
+
+        for number, coach_id, client_ids in coaches:
+            rng = random.Random('%s-%d' % (params['seed'], number))
+            tzid = rng.choice(TIME_ZONES)
+            schedule = work_schedule(rng, start, params['weeks'], tzid)
+            if params['recurring']:
+                ## the same working hours as rules, without admin blocks
+                until = (start + timedelta(weeks=params['weeks'])).strftime('%Y%m%dT%H%M%S')
+                for hour, length in BLOCKS:
+                    rules.append((coach_id, start + timedelta(hours=hour), '%d hours' % length,
+                                  'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR;UNTIL=%s' % until, tzid))
+            else:
+                for s, e in schedule:
+                    events.append((s, e, None, 'schedulable'))
+                    participants.append((coach_id,))
+            bookings = plan_bookings(rng, schedule, client_ids, params['bookings_per_client'], start)
+            for s, e, client_id in bookings:
+                events.append((s, e, 'Coaching session', 'coaching'))
+                participants.append((coach_id, client_id))
+            ## the rules' schedule includes the admin blocks
+            rollup.extend(daily_rollup(coach_id, weekly_blocks(start, params['weeks'], tzid) if params['recurring']
+                                       else schedule, bookings))
+            if len(events) >= COPY_BATCH:
+                loaded += len(events)
+                flush()
+        if events or rules:
+            loaded += len(events)
+            flush()
+    finally:
+        conn.close()
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--coaches', type=int, default=100)
+    parser.add_argument('--clients-per-coach', type=int, default=20)
+    parser.add_argument('--bookings-per-client', type=int, default=6)
+    parser.add_argument('--weeks', type=int, default=26, help="weeks of working hours to give each coach")
+    parser.add_argument('--start', help="Monday the coaches' schedules start, YYYY-MM-DD, by default this week's")
+    parser.add_argument('--recurring', action='store_true',
+                        help="store coaches' working hours as availability rules instead of one event per block")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of loading processes")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+    with open(config_path) as f:
+        config = json.loads(f.read())
+
+    if args.start is None:
+        today = datetime.now().date()
+        args.start = (today - timedelta(days=today.weekday())).isoformat()
+
+    t = time.perf_counter()
+    rng = random.Random(args.seed)
+    n_clients = args.coaches * args.clients_per_coach
+    conn = psycopg2.connect(config['db_connect'])
+    try:
+        with conn, conn.cursor() as curs:
+            ## partitions for the months the schedules cover, so rows are loaded straight into them
+            start = datetime.strptime(args.start, '%Y-%m-%d').date()
+            curs.execute("SELECT ensure_event_partitions(%s, %s)", (start, start + timedelta(weeks=args.weeks + 1)))
+            person_ids = reserve_ids(curs, 'person_id_seq', args.coaches + n_clients)
+            coach_ids, client_ids = person_ids[:args.coaches], person_ids[args.coaches:]
+            copy_rows(curs, 'person', ('id', 'first_name', 'last_name', 'client', 'coach'),
+                      [(person_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), False, True)
+                       for person_id in coach_ids] +
+                      [(person_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), True, False)
+                       for person_id in client_ids])
+            since = datetime.now().replace(microsecond=0)
+            copy_rows(curs, 'relationship', ('coach_id', 'client_id', 'since'),
+                      ((coach_ids[i // args.clients_per_coach], client_id, since)
+                       for i, client_id in enumerate(client_ids)))
+    finally:
+        conn.close()
+    print("%d coaches and %d clients loaded in %.1f s" % (args.coaches, n_clients, time.perf_counter() - t))
+
+    params = {'seed': args.seed, 'weeks': args.weeks, 'start': args.start, 'recurring': args.recurring,
+              'bookings_per_client': args.bookings_per_client}
+    coaches = [(i, coach_id, client_ids[i*args.clients_per_coach:(i+1)*args.clients_per_coach])
+               for i, coach_id in enumerate(coach_ids)]
+    ## a few tasks per worker to even out the load
+    n_tasks = max(1, min(len(coaches), args.workers * 4))
+    tasks = [(config['db_connect'], params, coaches[i::n_tasks]) for i in range(n_tasks)]
+    with Pool(args.workers) as pool:
+        loaded = sum(pool.imap_unordered(generate_coaches, tasks))
+
+    conn = psycopg2.connect(config['db_connect'])
+    try:
+        conn.autocommit = True
+        with conn.cursor() as curs:
+            curs.execute("ANALYZE")
+    finally:
+        conn.close()
+    print("%d events loaded in %.1f s" % (loaded, time.perf_counter() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Maintain the monthly partitions of event and participant
+
+Creates partitions for the coming months and archives old ones, by
+detaching them and moving them to the archive schema, from where they can
+be dumped with pg_dump and dropped. Run it from cron, say daily:
+
+    python scripts/manage_partitions.py --months-ahead 12 --archive-after 24
+
+Events in months without a partition go in the default partitions, where
+queries still find them but can't skip them, so keep --months-ahead
+beyond the furthest anyone books ahead.
+"""
+import argparse
+import json
+import os
+import sys
+import psycopg2
+from datetime import date
+
+## read config file
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+with open(config_path) as f:
+    config = json.loads(f.read())
+
+
+def add_months(d, months):
+    """
+    The first of the month a number of months after the month of d
+    """
+    month = d.year * 12 + d.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months-ahead', type=int, default=12,
+                        help="create partitions up to this many months after the current one")
+    parser.add_argument('--archive-after', type=int,
+                        help="archive partitions of months ending more than this many months ago, "
+                             "by default none are archived")
+    args = parser.parse_args()
+
+    this_month = add_months(date.today(), 0)
+    conn = psycopg2.connect(config['db_connect'])
+    try:
+        with conn, conn.cursor() as curs:
+            curs.execute("SELECT ensure_event_partitions(%s, %s)",
+                         (this_month, add_months(this_month, args.months_ahead)))
+            for row in curs.fetchall():
+                print('created %s' % row[0])
+            for notice in conn.notices:
+                print(notice.strip())
+
+            if args.archive_after is not None:
+                curs.execute("SELECT archive_event_partitions(%s)", (add_months(this_month, -args.archive_after),))
+                for row in curs.fetchall():
+                    print('archived %s' % row[0])
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+--Index event time windows and participants by person
+--
+--Adds a generated tsrange column covering [start_time, end_time) with a
+--GiST index, so window queries can use the && overlap operator, and an
+--index on participant leading with person_id. Needs PostgreSQL 12 or later.
+--Note that an event with start_time = end_time has an empty range, which
+--overlaps nothing.
+
+ALTER TABLE event
+  ADD COLUMN IF NOT EXISTS time_range tsrange
+  GENERATED ALWAYS AS (tsrange(start_time, end_time, '[)')) STORED;
+
+CREATE INDEX IF NOT EXISTS event_time_range_idx ON event USING gist (time_range);
+
+CREATE INDEX IF NOT EXISTS participant_person_idx ON participant (person_id, event_id);
+
+ANALYZE event;
+ANALYZE participant;
@@ -0,0 +1,20 @@
+--Store recurring availability as rules rather than one row per occurrence
+--
+--Each rule is an RFC 5545 RRULE anchored at dtstart in the tzid time zone,
+--with exdates listing local dates to skip. PostgresDataStore expands the
+--rules lazily for the window being viewed.
+
+CREATE TABLE IF NOT EXISTS availability_rule (
+  id            bigserial PRIMARY KEY,
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  dtstart       timestamp NOT NULL,               -- local time of the first occurrence
+  duration      interval NOT NULL,
+  rrule         text NOT NULL,                    -- RFC 5545 RRULE, e.g. FREQ=WEEKLY;BYDAY=MO,TU
+  tzid          varchar(64) NOT NULL DEFAULT 'UTC',
+  exdates       date[] NOT NULL DEFAULT '{}'      -- local dates with no occurrence
+);
+
+CREATE INDEX IF NOT EXISTS availability_rule_person_idx ON availability_rule (person_id);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON availability_rule TO scheduler_app;
+GRANT ALL PRIVILEGES ON SEQUENCE availability_rule_id_seq TO scheduler_app;
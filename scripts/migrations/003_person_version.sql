@@ -0,0 +1,7 @@
+--Track a change version per person for HTTP conditional requests
+--
+--PostgresDataStore bumps a person's version in the same transaction as
+--any write to their events or availability rules. The calendar endpoint
+--builds its ETag from the versions of the client and the coach.
+
+ALTER TABLE person ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
@@ -0,0 +1,20 @@
+--Log changes to people's calendars for incremental sync
+--
+--PostgresDataStore adds a row per participant in the same transaction as
+--each write to an event, and one for each change to an availability rule.
+--Rows are tagged with the writing transaction's ID. A sync token is the
+--oldest transaction running when it was handed out, so the changes since
+--a token are the rows whose xid is at least the token.
+
+CREATE TABLE IF NOT EXISTS event_change (
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  event_id      bigint,                       -- NULL for availability rule changes
+  op            varchar(10) NOT NULL,         -- create, update, delete or rule
+  start_time    timestamp,                    -- UTC, time range of the event as written
+  end_time      timestamp,                    -- UTC
+  xid           bigint NOT NULL DEFAULT txid_current()
+);
+
+CREATE INDEX IF NOT EXISTS event_change_person_xid_idx ON event_change (person_id, xid);
+
+GRANT SELECT, INSERT, DELETE ON event_change TO scheduler_app;
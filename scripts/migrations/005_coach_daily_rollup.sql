@@ -0,0 +1,19 @@
+--Pre-aggregated coach utilization, for the /reports/utilization/ endpoint
+--
+--One row per coach per UTC day with the number of open and booked
+--appointment slots starting that day. PostgresDataStore recomputes the
+--days an event write touches in the same transaction, and the days from a
+--changed availability rule's start up to a year ahead. Fill it for
+--existing data with PostgresDataStore.rebuild_rollup.
+
+CREATE TABLE IF NOT EXISTS coach_daily_rollup (
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  day           date NOT NULL,                -- UTC day the slots start on
+  open_slots    integer NOT NULL DEFAULT 0,
+  booked_slots  integer NOT NULL DEFAULT 0,
+  PRIMARY KEY (person_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS coach_daily_rollup_day_idx ON coach_daily_rollup (day);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON coach_daily_rollup TO scheduler_app;
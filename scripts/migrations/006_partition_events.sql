@@ -0,0 +1,148 @@
+--Partition event and participant by month of start_time
+--
+--Most requests look at the current and coming weeks, so with monthly
+--partitions a window query only touches the few partitions its window
+--can reach, and old months can be detached and archived without touching
+--the live tables, see scripts/manage_partitions.py.
+--
+--The primary key of event becomes (id, start_time), as it must include the
+--partition key, and participant gets the event's start_time to reference
+--it by and be partitioned on. Changing an event's start_time cascades to
+--its participants. Queries bound start_time by the longest an event may
+--last, so events are limited to 31 days by event_span_check; this
+--migration fails if any existing event is longer.
+--
+--Needs PostgreSQL 15 or later, which moves a row referenced by a foreign
+--key to another partition as an update rather than a delete and insert.
+
+BEGIN;
+
+ALTER TABLE participant RENAME TO participant_unpartitioned;
+ALTER TABLE participant_unpartitioned RENAME CONSTRAINT participant_constraint TO participant_unpartitioned_constraint;
+ALTER INDEX participant_person_idx RENAME TO participant_unpartitioned_person_idx;
+ALTER TABLE event RENAME TO event_unpartitioned;
+ALTER TABLE event_unpartitioned RENAME CONSTRAINT event_pkey TO event_unpartitioned_pkey;
+ALTER INDEX event_time_range_idx RENAME TO event_unpartitioned_time_range_idx;
+ALTER SEQUENCE event_id_seq OWNED BY NONE;
+
+CREATE TABLE event (
+  id            bigint NOT NULL DEFAULT nextval('event_id_seq'),
+  start_time    timestamp NOT NULL,    -- UTC
+  end_time      timestamp NOT NULL,    -- UTC
+  name          varchar(120),
+  type          varchar(20),
+  notes         text,
+  time_range    tsrange GENERATED ALWAYS AS (tsrange(start_time, end_time, '[)')) STORED,
+  PRIMARY KEY (id, start_time),
+  CONSTRAINT event_span_check CHECK (end_time - start_time <= interval '31 days')  -- events.MAX_EVENT_SPAN
+) PARTITION BY RANGE (start_time);
+
+CREATE TABLE event_default PARTITION OF event DEFAULT;
+
+CREATE INDEX event_time_range_idx ON event USING gist (time_range);
+
+ALTER SEQUENCE event_id_seq OWNED BY event.id;
+
+CREATE TABLE participant (
+  event_id      bigint NOT NULL,
+  person_id     integer NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+  start_time    timestamp NOT NULL,    -- the event's, which a change to cascades to
+  CONSTRAINT participant_constraint UNIQUE (event_id,person_id,start_time),
+  FOREIGN KEY (event_id, start_time) REFERENCES event (id, start_time) ON DELETE CASCADE ON UPDATE CASCADE
+) PARTITION BY RANGE (start_time);
+
+CREATE TABLE participant_default PARTITION OF participant DEFAULT;
+
+CREATE INDEX participant_person_idx ON participant (person_id, event_id);
+
+--Create monthly partitions of event and participant, named event_pYYYYMM
+--and participant_pYYYYMM, for the months from first_month to last_month
+--that don't have them yet. A month with rows already in the default
+--partitions is skipped with a notice, as they would have to be moved
+--first. Returns the names of the event partitions created.
+CREATE OR REPLACE FUNCTION ensure_event_partitions(first_month date, last_month date)
+RETURNS SETOF text AS $body$
+DECLARE
+  m date := date_trunc('month', first_month);
+  next_m date;
+  suffix text;
+BEGIN
+  WHILE m <= last_month LOOP
+    next_m := m + interval '1 month';
+    suffix := to_char(m, '"p"YYYYMM');
+    IF to_regclass('event_' || suffix) IS NULL THEN
+      IF EXISTS (SELECT 1 FROM event_default WHERE start_time >= m AND start_time < next_m) THEN
+        RAISE NOTICE 'event_default has rows in %, not creating event_%', to_char(m, 'YYYY-MM'), suffix;
+      ELSE
+        EXECUTE format('CREATE TABLE %I PARTITION OF event FOR VALUES FROM (%L) TO (%L)',
+                       'event_' || suffix, m, next_m);
+        EXECUTE format('CREATE TABLE %I PARTITION OF participant FOR VALUES FROM (%L) TO (%L)',
+                       'participant_' || suffix, m, next_m);
+        RETURN NEXT 'event_' || suffix;
+      END IF;
+    END IF;
+    m := next_m;
+  END LOOP;
+END
+$body$ LANGUAGE plpgsql;
+
+--Detach the monthly partitions of event and participant for months ending
+--on or before the given date and move them to the archive schema, from
+--where they can be dumped and dropped. A detached participant partition
+--keeps a foreign key to event, which is dropped so the event partition can
+--be detached after it. Returns the names of the event partitions archived.
+CREATE OR REPLACE FUNCTION archive_event_partitions(before date)
+RETURNS SETOF text AS $body$
+DECLARE
+  part record;
+  fk record;
+BEGIN
+  CREATE SCHEMA IF NOT EXISTS archive;
+  FOR part IN
+    SELECT c.relname AS event_part, 'participant_' || substr(c.relname, 7) AS participant_part
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'event'::regclass
+    AND c.relname ~ '^event_p[0-9]{6}$'
+    AND to_date(substr(c.relname, 8), 'YYYYMM') + interval '1 month' <= before
+    ORDER BY c.relname
+  LOOP
+    EXECUTE format('ALTER TABLE participant DETACH PARTITION %I', part.participant_part);
+    FOR fk IN
+      SELECT conname FROM pg_constraint
+      WHERE conrelid = part.participant_part::regclass AND confrelid = 'event'::regclass AND contype = 'f'
+    LOOP
+      EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', part.participant_part, fk.conname);
+    END LOOP;
+    EXECUTE format('ALTER TABLE event DETACH PARTITION %I', part.event_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.participant_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.event_part);
+    RETURN NEXT part.event_part;
+  END LOOP;
+END
+$body$ LANGUAGE plpgsql;
+
+--partitions for every month with events and the coming year, created
+--before the rows are copied so none land in the default partitions
+SELECT count(*) FROM ensure_event_partitions(
+  coalesce((SELECT min(start_time) FROM event_unpartitioned), now())::date,
+  greatest((SELECT max(start_time) FROM event_unpartitioned), now() + interval '1 year')::date);
+
+INSERT INTO event (id, start_time, end_time, name, type, notes)
+SELECT id, start_time, end_time, name, type, notes
+FROM event_unpartitioned;
+
+INSERT INTO participant (event_id, person_id, start_time)
+SELECT p.event_id, p.person_id, e.start_time
+FROM participant_unpartitioned p
+JOIN event_unpartitioned e ON e.id = p.event_id;
+
+DROP TABLE participant_unpartitioned;
+DROP TABLE event_unpartitioned;
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON event, participant TO scheduler_app;
+
+COMMIT;
+
+ANALYZE event;
+ANALYZE participant;
@@ -0,0 +1,84 @@
+--Look up an event's start time by ID
+--
+--event and participant are partitioned on start_time, so finding an event
+--by ID alone means probing every partition. event_start maps each event's
+--ID to its start time, kept up to date by a trigger on event, so
+--PostgresDataStore.get_event and the writes that start from an ID read
+--just the partition the event is in. Writes also lock the event's
+--event_start row, which stays put when the event moves to another
+--partition, see events.fetch_event.
+--
+--archive_event_partitions is replaced to delete the archived events' rows
+--from event_start as well.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS event_start (
+  id            bigint PRIMARY KEY,
+  start_time    timestamp NOT NULL    -- the event's, UTC
+);
+
+--A change of start_time that moves an event to another partition may fire
+--as a delete and an insert, so an insert replaces any row for the ID and a
+--delete only removes it if the event is gone.
+CREATE OR REPLACE FUNCTION track_event_start()
+RETURNS trigger AS $body$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    DELETE FROM event_start s
+    WHERE s.id = OLD.id
+    AND NOT EXISTS (SELECT 1 FROM event e WHERE e.id = OLD.id);
+  ELSE
+    INSERT INTO event_start (id, start_time) VALUES (NEW.id, NEW.start_time)
+    ON CONFLICT (id) DO UPDATE SET start_time = EXCLUDED.start_time;
+  END IF;
+  RETURN NULL;
+END
+$body$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS event_start_trigger ON event;
+CREATE TRIGGER event_start_trigger
+AFTER INSERT OR DELETE OR UPDATE OF id, start_time ON event
+FOR EACH ROW EXECUTE FUNCTION track_event_start();
+
+INSERT INTO event_start (id, start_time)
+SELECT id, start_time FROM event
+ON CONFLICT (id) DO UPDATE SET start_time = EXCLUDED.start_time;
+
+CREATE OR REPLACE FUNCTION archive_event_partitions(before date)
+RETURNS SETOF text AS $body$
+DECLARE
+  part record;
+  fk record;
+BEGIN
+  CREATE SCHEMA IF NOT EXISTS archive;
+  FOR part IN
+    SELECT c.relname AS event_part, 'participant_' || substr(c.relname, 7) AS participant_part
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'event'::regclass
+    AND c.relname ~ '^event_p[0-9]{6}$'
+    AND to_date(substr(c.relname, 8), 'YYYYMM') + interval '1 month' <= before
+    ORDER BY c.relname
+  LOOP
+    EXECUTE format('ALTER TABLE participant DETACH PARTITION %I', part.participant_part);
+    FOR fk IN
+      SELECT conname FROM pg_constraint
+      WHERE conrelid = part.participant_part::regclass AND confrelid = 'event'::regclass AND contype = 'f'
+    LOOP
+      EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', part.participant_part, fk.conname);
+    END LOOP;
+    EXECUTE format('ALTER TABLE event DETACH PARTITION %I', part.event_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.participant_part);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA archive', part.event_part);
+    EXECUTE format('DELETE FROM event_start WHERE id IN (SELECT id FROM archive.%I)', part.event_part);
+    RETURN NEXT part.event_part;
+  END LOOP;
+END
+$body$ LANGUAGE plpgsql;
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON event_start TO scheduler_app;
+
+COMMIT;
+
+ANALYZE event_start;
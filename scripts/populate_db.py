@@ -2,17 +2,32 @@
 """
 Create ridiculous fake scheduling data
 """
+import argparse
 import dateutil
 import json
 import os
 import psycopg2
 import random
+import sys
 from psycopg2.extras import NamedTupleCursor
 from itertools import product
 from datetime import datetime, timedelta, date
 from dateutil.relativedelta import relativedelta, SU, MO, TU, WE, TH, FR, SA
 from dateutil.parser import parse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scheduler'))
+from events import PostgresDataStore
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--recurring', action='store_true',
+                    help="store coaches' working hours as availability rules instead of one event per block")
+parser.add_argument('--coaches', type=int, help="number of coaches, by default one per name below")
+parser.add_argument('--clients', type=int, help="number of clients, by default one per name below")
+parser.add_argument('--weeks', type=int, default=26, help="weeks of working hours to give each coach")
+parser.add_argument('--seed', type=int, help="seed for the random choices, to make the same data again")
+args = parser.parse_args()
+random.seed(args.seed)
+
 ## read config file
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
 with open(config_path) as f:
@@ -54,6 +69,18 @@ clients = [
     'Rosaline Rhett', 'Shan Shults', 'Eugenia Eugene', 'Tiffani Turgeon',
     'Wanetta Winslett', 'Carlie Charboneau', 'Carri Cooks']
 
+def take_names(names, n):
+    """
+    The first n names, numbering repeats if more are wanted than there are
+    """
+    if n is None:
+        return names
+    return [names[i % len(names)] + ('' if i < len(names) else '-%d' % (i // len(names)))
+            for i in range(n)]
+
+coaches = take_names(coaches, args.coaches)
+clients = take_names(clients, args.clients)
+
 HOLIDAYS = [parse(d).date() for d in (
     "December 26, 2016",
     "January 02, 2017",
@@ -111,20 +138,51 @@ def make_work_schedule(weeks=1, tz=dateutil.tz.gettz('PST')):
     return schedule
 
 
-def slots_available(coach_id, date, tz=dateutil.tz.gettz('PST'), cursor=None):
+def make_availability_rules(weeks=1, tzid='PST'):
+    """
+    Make up working hours for a coach over a number of weeks, in the same
+    pattern as make_work_schedule but as a morning and an afternoon rule.
+
+    :returns: a list of dicts of arguments to PostgresDataStore.create_availability_rule
+    """
+    n = datetime.now()
+    ## 8 AM in the coach's local time zone
+    s0 = datetime(year=n.year, month=n.month, day=n.day, hour=8,minute=0,second=0,microsecond=0)
+    until = datetime(year=n.year, month=n.month, day=n.day) + timedelta(weeks=weeks)
+
+    admin_blocks = tuple((block, wd) for block,wd in product((MORNING,AFTERNOON), range(5)))
+    admin_blocks = random.sample(admin_blocks, 2)
+
+    rules = []
+    for block, start in ((MORNING, s0), (AFTERNOON, s0+timedelta(hours=5))):
+        days = [day for wd, day in enumerate(('MO', 'TU', 'WE', 'TH', 'FR')) if (block, wd) not in admin_blocks]
+        rules.append({'dtstart': start,
+                      'duration': timedelta(hours=4),
+                      'rrule': 'FREQ=WEEKLY;BYDAY=%s;UNTIL=%s' % (','.join(days), until.strftime('%Y%m%dT%H%M%S')),
+                      'tzid': tzid,
+                      'exdates': HOLIDAYS})
+    return rules
+
+
+def slots_available(coach_id, date, tz=dateutil.tz.gettz('PST'), cursor=None, booked=(), rules=()):
+    """
+    Free one hour slots in a coach's schedule on the given date, treating
+    the (start, end) pairs in booked as appointments too and the coach's
+    availability rules as schedulable time
+    """
     st = datetime(year=date.year,month=date.month,day=date.day)
     st -= tz.utcoffset(st)
     et = st + timedelta(hours=24)
     query = """\
         SELECT e.* 
-        FROM event e JOIN participant p ON e.id=p.event_id 
+        FROM event e JOIN participant p ON e.id=p.event_id AND e.start_time=p.start_time
         WHERE p.person_id=%s
         AND e.end_time>=%s and e.start_time<=%s;"""
     cursor.execute(query, (coach_id, st, et))
 
-    schedulable = []
-    appts = []
-    for row in curs:
+    schedulable = [(s, e) for rule in rules for s, e in rule.occurrences(st, et)]
+    appts = list(booked)
+    for row in cursor:
         if row.type == 'schedulable':
             schedulable.append((row.start_time, row.end_time))
         else:
@@ -145,19 +203,15 @@ def slots_available(coach_id, date, tz=dateutil.tz.gettz('PST'), cursor=None):
                 slots.append((slot_s, slot_e))
     return slots
 
-def create_event(start_time, end_time, event_type='appointment', name=None, participants=[], notes=None, cursor=None):
-    cursor.execute("INSERT INTO event (start_time, end_time, type, name, notes) VALUES (%s, %s, %s, %s, %s) RETURNING id;",\
-                   (start_time, end_time, event_type, name, notes))
-    event_id = curs.fetchone()[0]
-    for person_id in participants:
-        cursor.execute("INSERT INTO participant (event_id, person_id) VALUES (%s, %s);", (event_id, person_id))
-    return event_id
-
-
 coach_ids = []
 client_ids = []
 client_coaches = {} 
 
+db = PostgresDataStore(config['db_connect'])
+
+## give the months the schedules cover their own partitions
+db.ensure_partitions(date.today(), date.today() + timedelta(weeks=args.weeks + 1))
+
 try:
     conn = psycopg2.connect(config['db_connect'], cursor_factory=NamedTupleCursor)
 
@@ -180,37 +234,49 @@ try:
                 client_coaches[i] = j
                 curs.execute("INSERT INTO relationship (coach_id, client_id, since) VALUES (%s, %s, %s);",(j,i, datetime.now()))
 
-    with conn:
-        with conn.cursor() as curs:
-            ## a coach is schedulable during working hours
-            coach_tzs = {}
-            for coach_id in coach_ids:
-                coach_tzs[coach_id] = dateutil.tz.gettz(random.choice(('PST','EST')))
-                schedule = make_work_schedule(weeks=26, tz=coach_tzs[coach_id])
-                for s,e in schedule:
-                    curs.execute("INSERT INTO event (start_time, end_time, type) VALUES (%s, %s, %s) RETURNING id;", (s,e,'schedulable'))
-                    event_id = curs.fetchone()[0]
-                    curs.execute("INSERT INTO participant (event_id, person_id) VALUES (%s, %s);", (event_id, coach_id))
+    ## a coach is schedulable during working hours
+    coach_tzs = {}
+    coach_rules = {coach_id: [] for coach_id in coach_ids}
+    schedulable = []
+    for coach_id in coach_ids:
+        tzid = random.choice(('PST','EST'))
+        coach_tzs[coach_id] = dateutil.tz.gettz(tzid)
+        if args.recurring:
+            coach_rules[coach_id] = [db.create_availability_rule(coach_id, **rule)
+                                     for rule in make_availability_rules(weeks=args.weeks, tzid=tzid)]
+        else:
+            schedule = make_work_schedule(weeks=args.weeks, tz=coach_tzs[coach_id])
+            schedulable.extend({'start_time': s, 'end_time': e, 'type': 'schedulable', 'participants': [coach_id]}
+                               for s,e in schedule)
+    db.create_events(schedulable)
 
     with conn:
         with conn.cursor() as curs:
-            ## make some appointments over the next few weeks
+            ## make some appointments over the next few weeks, collecting
+            ## them to be created in one batch
+            appointments = []
+            booked = {coach_id: [] for coach_id in coach_ids}
             for client_id in client_ids:
                 coach_id = client_coaches[client_id]
                 coach_tz = coach_tzs[coach_id]
                 d = date.today() + timedelta(days=random.randint(1,30))
                 for i in range(6):
                     max_d = d + timedelta(days=7)
-                    slots = slots_available(coach_id, d, tz=coach_tz, cursor=curs)
+                    slots = slots_available(coach_id, d, tz=coach_tz, cursor=curs,
+                                            booked=booked[coach_id], rules=coach_rules[coach_id])
                     while not slots:
                         d += timedelta(days=1)
                         if d > max_d:
                             break
-                        slots = slots_available(coach_id, d, tz=coach_tz, cursor=curs)
+                        slots = slots_available(coach_id, d, tz=coach_tz, cursor=curs,
+                                                booked=booked[coach_id], rules=coach_rules[coach_id])
                     if slots:
                         slot = random.choice(slots)
-                        create_event(slot[0], slot[1], event_type='coaching', participants=[coach_id, client_id], cursor=curs)
+                        booked[coach_id].append(slot)
+                        appointments.append({'start_time': slot[0], 'end_time': slot[1], 'type': 'coaching',
+                                             'participants': [coach_id, client_id]})
                     d += timedelta(days=random.randint(25,35))
+    db.create_events(appointments)
 finally:
     conn.close()
 
@@ -341,7 +341,10 @@ class WeekCalendar extends React.Component {
       fetch("http://127.0.0.1:5000/calendar/"+this.state.user.id+'/'+coach.id+
                   "/?from=" + from.toISOString() + "&to=" + to.toISOString())
         .then(checkStatus)
-        .then((response)=>response.json())
+        .then((response)=>{
+            this.syncToken = response.headers.get('Sync-Token')
+            return response.json()
+          })
         .then((events) => {
             if (events && events.length) {
               console.log('fetched ' + events.length + ' events.')
@@ -361,6 +364,44 @@ class WeekCalendar extends React.Component {
           })
     }
   }
+  // apply the changes since the calendar was fetched rather than fetching it all again
+  syncAppointments() {
+    const coach = this.state.selected_coach
+    const from = this.state.calendarDate
+    const to = moment(this.state.calendarDate).add(1,'week')
+    if (!coach || !this.syncToken) {
+      this.fetchAppointments(coach, from, to)
+      return
+    }
+    fetch("http://127.0.0.1:5000/sync/"+this.state.user.id+'/'+coach.id+
+                "/?from=" + from.toISOString() + "&to=" + to.toISOString() + "&token=" + this.syncToken)
+      .then(checkStatus)
+      .then((response)=>response.json())
+      .then((changes) => {
+          this.syncToken = changes.token
+          var events = changes.events.concat(changes.slots || [])
+          for (var i=0; i<events.length; i++) {
+            events[i].start_time = moment(events[i].start_time).local()
+            events[i].end_time = moment(events[i].end_time).local()
+          }
+          if (!changes.reset) {
+            const changed = new Set(changes.deleted.concat(changes.events.map((event)=>event.id)))
+            const ranges = changes.ranges.map((range)=>[moment(range[0]), moment(range[1])])
+            const keep = this.state.events.filter((event) =>
+              event.id ? !changed.has(event.id) :
+                         !ranges.some((range)=>event.start_time < range[1] && event.end_time > range[0]))
+            events = keep.concat(events)
+          }
+          console.log('synced ' + events.length + ' events.')
+          for (var i=0; i<events.length; i++) {
+            events[i].key = i
+          }
+          this.setState({events:events})
+        })
+      .catch((error) => {
+          console.log("Error: "+error.message)
+        })
+  }
   appointmentDialogOpen(props) {
     console.log("scheduleAppointmentDialogOpen: ", props)
     const ap = props.appointment
@@ -402,12 +443,16 @@ class WeekCalendar extends React.Component {
         .then((json) => {
             //this.setState({status:status.status})
             console.log('created booking', json)
+            this.syncAppointments()
           })
         .catch((error) => {
             console.log("Error: "+error.message)
+            if (error.response && error.response.status == 409) {
+              // someone else booked the slot first, show what's free now
+              this.syncAppointments()
+            }
           })
     this.appointmentDialogClose()
-    this.fetchAppointments(this.state.selected_coach, this.state.calendarDate, moment(this.state.calendarDate).add(1,'week'))
   }
   updateAppointment(description) {
     const ap = this.state.appointment
@@ -432,12 +477,16 @@ class WeekCalendar extends React.Component {
         .then((json) => {
             //this.setState({status:status.status})
             console.log('created booking', json)
+            this.syncAppointments()
           })
         .catch((error) => {
             console.log("Error: "+error.message)
+            if (error.response && error.response.status == 409) {
+              // someone else booked the slot first, show what's free now
+              this.syncAppointments()
+            }
           })
     this.appointmentDialogClose()
-    this.fetchAppointments(this.state.selected_coach, this.state.calendarDate, moment(this.state.calendarDate).add(1,'week'))
   }
   cancelAppointment(id) {
     fetch("http://127.0.0.1:5000/event/"+id+"/", {method: 'DELETE'})
@@ -445,12 +494,12 @@ class WeekCalendar extends React.Component {
         .then((response)=>response.json())
         .then((json) => {
             console.log('deleted event', json)
+            this.syncAppointments()
           })
         .catch((error) => {
             console.log("Error: "+error.message)
           })
     this.appointmentDialogClose()
-    this.fetchAppointments(this.state.selected_coach, this.state.calendarDate, moment(this.state.calendarDate).add(1,'week'))
   }
   selectCoach(coach) {
     console.log('selectCoach to ', coach.id, coach.first_name, coach.last_name)